@@ -1,7 +1,7 @@
 """
 The methods here are mostly here to be patchable for unit testing
 
-Route all output via these fail() and output() methods.
+Route all output via these fail(), error(), output() and progress() methods.
 """
 
 __version__ = (0,1,0)
@@ -19,3 +19,10 @@ def error(message: str) -> None:
 
 def output(message: str) -> None:
 	print(message)
+
+
+def progress(message: str) -> None:
+	"""
+	Output without a newline, for progress lines that the next one overwrites
+	"""
+	print(message, end="", flush=True)
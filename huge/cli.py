@@ -5,9 +5,14 @@ from huge.testing import huge_test
 
 def run_command(*args: list[str]) -> None:
 	from huge import fail, output, __version__
+	from huge.repo import clear_caches
 	from huge.repo.paths import HUGE_DIRECTORY
+	from huge.repo.ssh import close_connections
 	from textwrap import wrap
 
+	# Every command starts with a fresh view of the repository
+	clear_caches()
+
 	COMMANDS = {
 		"init": (
 			"Initialize current folder with a .huge folder",
@@ -37,9 +42,14 @@ def run_command(*args: list[str]) -> None:
 		),
 		"log": (
 			"Show a list of revisions",
-			"Prints a list of all the commits that exists in the repository. "
+			"Prints a list of all the commits that exists in the repository, newest first. "
 			"Note that you will need to run 'huge pull' first to get up-to-date information on the "
-			"changes."
+			"changes.\n\n"
+			"Use -n to only show the newest commits, and --since and --until to only show commits "
+			"made in a time period. Dates are written like 2024-04-13 or '2024-04-13 15:35'.\n\n"
+			"If a path is given, only the commits that changed that file are shown, together with "
+			"the checksum of the version in that commit and how many copies exists of it. "
+			"L means that the version is stored locally."
 		),
 		"branches": (
 			"List branches",
@@ -80,11 +90,12 @@ def run_command(*args: list[str]) -> None:
 			"there are no other commits pointing at those files.\n\n"
 			"The files can be retrieved again if this commit exists on a remote. Use 'huge pull "
 			"<commit>' for that.\n\n"
-			"Command automatically does a fetch from repository to reduce the risk of loosing data "
-			"and will warn the user if it can't find copies of the files elsewhere.\n\n"
+			"Command automatically fetches the coverage of all the remotes to reduce the risk of "
+			"loosing data. Files that less than --copies remotes has (default 1) are kept, and the "
+			"user is told about them.\n\n"
+			"Use -n or --dry-run to only show how much would be deleted.\n\n"
 			"To delete files without doing any attempt at checking if any remote repositories are known "
 			"to have the data, use -f or --force.",
-			# TODO merayen this command should probably check if any other remotes has the data files
 		),
 		"drop-all": (
 			"Deletes all commit files, removing all local coverage",
@@ -93,7 +104,8 @@ def run_command(*args: list[str]) -> None:
 			"Same as drop command, but does not take any commit hashes.\n\n"
 			"This command is usually used when wanting to free up space locally and the data is "
 			"available elsewhere, or the data is not important and can be permanently deleted.\n\n"
-			"Command automatically does a fetch from repository to reduce the risk of loosing data.\n\n"
+			"Command automatically fetches the coverage of all the remotes to reduce the risk of "
+			"loosing data.\n\n"
 			"To delete files without doing any attempt at checking if any remote repositories are known "
 			"to have the data, use -f or --force.",
 		),
@@ -160,13 +172,46 @@ def run_command(*args: list[str]) -> None:
 			"Opposite of clone-command. Does not send the user files themselves, only the metadata. "
 			"Send data with 'huge push' afterwards to send files."
 		),
+		"config": (
+			"Show or change settings",
+			"Without arguments, all the settings are listed with their current values.\n\n"
+			"  huge config <setting>          Show a setting\n"
+			"  huge config <setting> <value>  Change a setting\n"
+			"  huge config <setting> ''        Reset a setting to its default value\n\n"
+			"Settings are stored in the .huge/config file, which can also be edited by hand."
+		),
+		"gc": (
+			"Clean up the local repository",
+			"Deletes temporary files left behind by interrupted commands, deletes stored files that "
+			"no commit points at and compacts the coverage information of the remotes.\n\n"
+			"Use --budget to limit how long it may run, e.g --budget 2h. Large repositories may then "
+			"need several runs to finish, and each run continues where the previous one stopped."
+		),
 		"verify": (
 			"Check this local repository's integrity",
-			"Verifies the structure of the .huge folder and that all the files stored are not corrupted."
+			"Verifies that all the files stored are not corrupted, by hashing them again, and that every "
+			"file used by a commit exists either locally or on a remote.\n\n"
+			"An interrupted verification continues where it stopped the next time it is run. The result "
+			"is written to .huge/verify.json, and the command exits with an error if problems were "
+			"found. Use --jobs to choose how many files to hash at the same time."
+		),
+		"scrub": (
+			"Verify the files that were verified the longest time ago",
+			"Like 'huge verify', but only hashes as many files as the budget allows, starting with "
+			"files that has never been verified and then the ones verified the longest time ago. Run "
+			"it regularly, e.g every night with --budget 2h, to have the whole storage verified over "
+			"time.\n\n"
+			"Use --max-bytes to limit how much is read, e.g --max-bytes 500G. The command exits with "
+			"an error if corrupt files were found."
+		),
+		"serve": (
+			"Serve this repository to another huge over stdin and stdout",
+			"Started by other huge instances over SSH to transfer commits and files in a single "
+			"session, when their remote.agent setting is set. Not meant to be run by hand."
 		),
 	}
 
-	COMMANDS_TODO = ["drop", "drop-all", "verify", "merge", "send", "add", "reset"]
+	COMMANDS_TODO = ["send", "add", "reset"]
 
 	assert not (set(COMMANDS_TODO) - set(COMMANDS))
 
@@ -181,7 +226,12 @@ def run_command(*args: list[str]) -> None:
 	parsers["add"].add_argument("file", nargs="+")
 	parsers["reset"].add_argument("file", nargs="+")
 	parsers["commit"].add_argument("-m", "--message")
+	parsers["log"].add_argument("-n", "--max-count", type=int)
+	parsers["log"].add_argument("--since", type=_parse_date)
+	parsers["log"].add_argument("--until", type=_parse_date)
+	parsers["log"].add_argument("path", nargs="?")
 	parsers["merge"].add_argument("commit_hash")
+	parsers["merge"].add_argument("-m", "--message")
 	parsers["checkout"].add_argument("commit_hash")
 	parsers["checkout"].add_argument("files", nargs="*")
 	parsers["pull"].add_argument("commit_hash", nargs="+")
@@ -189,17 +239,32 @@ def run_command(*args: list[str]) -> None:
 	parsers["push"].add_argument("commit_hash", nargs="*")
 	parsers["push"].add_argument("-r", "--remote", nargs="*")
 	parsers["drop"].add_argument("commit_hash", nargs="+")
-	parsers["drop"].add_argument(
-		"-f",
-		"--force",
-		action="store_true",
-	)
-	parsers["drop-all"].add_argument(
-		"-f",
-		"--force",
-		action="store_true",
-	)
+	for name in ["drop", "drop-all"]:
+		parsers[name].add_argument(
+			"-f",
+			"--force",
+			action="store_true",
+		)
+		parsers[name].add_argument(
+			"-n",
+			"--dry-run",
+			action="store_true",
+		)
+		parsers[name].add_argument(
+			"-c",
+			"--copies",
+			type=int,
+			default=1,
+		)
 	parsers["remote-add"].add_argument("remote")
+	parsers["gc"].add_argument("--budget", type=_parse_duration)
+	parsers["verify"].add_argument("-j", "--jobs", type=int)
+	parsers["scrub"].add_argument("--budget", type=_parse_duration)
+	parsers["scrub"].add_argument("--max-bytes", type=_parse_size)
+	parsers["scrub"].add_argument("-j", "--jobs", type=int)
+	parsers["serve"].add_argument("--stdio", action="store_true", required=True)
+	parsers["config"].add_argument("setting", nargs="?")
+	parsers["config"].add_argument("value", nargs="?")
 	parsers["clone"].add_argument("remote")
 	parsers["send"].add_argument("remote")
 
@@ -211,7 +276,10 @@ def run_command(*args: list[str]) -> None:
 
 	# Find method that represents the command and execute it
 	if opts.command and f"{opts.command.replace('-', '_')}_command" in globals():
-		eval(f"{opts.command.replace('-', '_')}_command(opts)")
+		try:
+			eval(f"{opts.command.replace('-', '_')}_command(opts)")
+		finally:
+			close_connections()
 	elif opts.command == "help":
 		if not opts.help_command:
 			output("usage: huge help <command>")
@@ -235,6 +303,36 @@ def run_command(*args: list[str]) -> None:
 		fail("Not implemented yet")
 
 
+def _parse_date(text: str) -> "datetime.datetime":
+	"""
+	Parse a date given by the user, in local time if no timezone is given
+	"""
+	import datetime
+
+	try:
+		return datetime.datetime.fromisoformat(text).astimezone(None)
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"invalid date: {text!r}")
+
+
+def _parse_duration(text: str) -> float:
+	from huge.repo.config import parse_duration
+
+	try:
+		return parse_duration(text)
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"invalid duration: {text!r}")
+
+
+def _parse_size(text: str) -> int:
+	from huge.repo.config import parse_size
+
+	try:
+		return parse_size(text)
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
+
+
 def require_repository(func):
 	def decorator(opts: argparse.Namespace) -> None:
 		from huge import fail
@@ -447,14 +545,16 @@ def test_status() -> None:
 
 @require_repository
 def log_command(opts: argparse.Namespace) -> None:
+	import itertools
 	from huge import output
-	from huge.repo.commit import get_commit_infos, CommitInfo
+	from huge.repo.commit import iter_commit_infos, CommitInfo
 
-	commit_infos: list[CommitInfo] = get_commit_infos()
-	commit_infos_by_hash: dict[str, CommitInfo] = {x.commit_hash: x for x in commit_infos}
+	if opts.path:
+		_log_path(opts)
+		return
 
 	commit_info: CommitInfo
-	for commit_info in reversed(commit_infos):
+	for commit_info in itertools.islice(iter_commit_infos(opts.since, opts.until), opts.max_count):
 		datas = [
 			commit_info.commit_hash,
 			commit_info.timestamp.strftime("%Y-%m-%d %H:%M"),
@@ -463,7 +563,7 @@ def log_command(opts: argparse.Namespace) -> None:
 
 		if len(commit_info.children) > 1:
 			datas.append(
-				f"B{commit_info.branch}->{','.join(f'B{x}' for x in sorted(commit_infos_by_hash[x].branch for x in commit_info.children))}"
+				f"B{commit_info.branch}->{','.join(f'B{x}' for x in sorted(commit_info.child_branches))}"
 			)
 		else:
 			datas.append(f"B{commit_info.branch}")
@@ -517,16 +617,223 @@ def test_log() -> None:
 		assert out.getvalue() == f"{commit_hash} {str(timestamp)[:16]} 100%/100% {message}\n"
 
 
+@require_repository
+def branches_command(opts: argparse.Namespace) -> None:
+	from huge.repo.graph import get_branches, get_commit_graph
+
+	_output_commits(get_branches(get_commit_graph()))
+
+
+@require_repository
+def heads_command(opts: argparse.Namespace) -> None:
+	from huge.repo.graph import get_commit_graph
+
+	_output_commits(get_commit_graph().heads)
+
+
+def _output_commits(commit_hashes: set[str]) -> None:
+	"""
+	Print one line per commit, newest first
+	"""
+	from huge import output
+	from huge.repo.commit import get_commit_message, parse_commit_timestamp
+	from huge.repo.graph import get_commit_graph
+
+	graph = get_commit_graph()
+
+	for commit_hash in sorted(commit_hashes, key=lambda x: graph.timestamps[x], reverse=True):
+		datas = [
+			commit_hash,
+			parse_commit_timestamp(graph.timestamps[commit_hash]).strftime("%Y-%m-%d %H:%M"),
+		]
+
+		if message := get_commit_message(commit_hash):
+			datas.append(message)
+
+		output(" ".join(datas))
+
+
+@huge_test
+def test_branches_and_heads() -> None:
+	from huge.testing import catch_output
+
+	run_command("init")
+
+	# No commits, no output
+	run_command("heads")
+	run_command("branches")
+
+	_create_test_file("a")
+	run_command("add", "a", ".hugeignore")
+	run_command("commit", "-m", "First")
+
+	with open(".huge/current") as f:
+		first_commit = f.read()
+
+	with catch_output() as out:
+		run_command("heads")
+		assert out.getvalue().startswith(first_commit) and out.getvalue().endswith(" First\n")
+
+	# No branches yet
+	run_command("branches")
+
+	_create_test_file("a", "Second")
+	run_command("add", "a")
+	run_command("commit", "-m", "Second")
+
+	run_command("checkout", first_commit)
+
+	_create_test_file("a", "Third")
+	run_command("add", "a")
+	run_command("commit", "-m", "Third")
+
+	with catch_output() as out:
+		run_command("heads")
+		assert [x.split()[-1] for x in out.getvalue().splitlines()] == ["Third", "Second"]
+
+	with catch_output() as out:
+		run_command("branches")
+		assert [x.split()[-1] for x in out.getvalue().splitlines()] == ["Third", "Second"]
+
+
+def _log_path(opts: argparse.Namespace) -> None:
+	"""
+	Print the versions of a single path
+	"""
+	import itertools
+	from huge import output
+	from huge.repo.commit import get_commit_message, parse_commit_timestamp
+	from huge.repo.coverage import get_remote_copies
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.history import get_path_history
+	from huge.repo.storage import get_stored_files
+
+	graph = get_commit_graph()
+
+	history = [
+		(commit_hash, file_hash, parse_commit_timestamp(graph.timestamps[commit_hash]))
+		for commit_hash, file_hash in get_path_history(opts.path)
+	]
+
+	history = [
+		x for x in history
+		if (opts.since is None or x[2] >= opts.since) and (opts.until is None or x[2] <= opts.until)
+	]
+
+	history = list(itertools.islice(history, opts.max_count))
+
+	remote_copies = get_remote_copies({file_hash for _, file_hash, _ in history if file_hash})
+	stored_files = get_stored_files()
+
+	for commit_hash, file_hash, timestamp in history:
+		datas = [commit_hash, timestamp.strftime("%Y-%m-%d %H:%M")]
+
+		if file_hash:
+			local = file_hash in stored_files
+			datas.append(f"{'L' if local else ' '} x{int(local) + remote_copies[file_hash]} {file_hash}")
+		else:
+			datas.append("deleted")
+
+		if message := get_commit_message(commit_hash):
+			datas.append(message)
+
+		output(" ".join(datas))
+
+
+@huge_test
+def test_log_path() -> None:
+	import re
+	from huge.testing import catch_output
+
+	run_command("init")
+
+	_create_test_file("a", "First")
+	_create_test_file("b")
+	run_command("add", "a", "b")
+	run_command("commit", "-m", "Added")
+
+	_create_test_file("b", "Changed")
+	run_command("add", "b")
+	run_command("commit")
+
+	os.remove("a")
+	run_command("add", "a")
+	run_command("commit", "-m", "Deleted")
+
+	with catch_output() as out:
+		run_command("log", "--", "a")
+		assert re.match(
+			"[0-9a-f]{32} [0-9-]{10} [0-9:]{5} deleted Deleted\n"
+			"[0-9a-f]{32} [0-9-]{10} [0-9:]{5} L x1 [0-9a-f]{32} Added\n$",
+			out.getvalue(),
+		)
+
+	with catch_output() as out:
+		run_command("log", "b", "-n", "1")
+		assert re.match(f"[0-9a-f]{{32}} [0-9-]{{10}} [0-9:]{{5}} L x1 {_get_test_hashes('b')[0][0]}\n$", out.getvalue())
+
+
+@huge_test
+def test_log_limits() -> None:
+	import datetime
+	from huge.testing import catch_output
+
+	run_command("init")
+
+	for i in range(3):
+		_create_test_file("a", str(i))
+		run_command("add", "a")
+		run_command("commit", "-m", f"Commit{i}")
+
+	with catch_output() as out:
+		run_command("log", "-n", "2")
+		assert [x.split()[-1] for x in out.getvalue().splitlines()] == ["Commit2", "Commit1"]
+
+	tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+	yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+
+	# Nothing has been committed in the future or in the past
+	run_command("log", "--since", tomorrow)
+	run_command("log", "--until", yesterday)
+
+	with catch_output() as out:
+		run_command("log", "--since", yesterday, "--until", tomorrow, "-n", "1")
+		assert out.getvalue().split()[-1] == "Commit2"
+
+
 @require_repository
 def merge_command(opts: argparse.Namespace) -> None:
-	assert opts.commit_hash
+	from huge import fail
+	from huge.repo.commit import create_commit, get_current_commit
+	from huge.repo.graph import get_commit_graph, is_ancestor
+	from huge.repo.stage import get_workspace_files, mark_as_staged
 
-	raise NotImplementedError("Implement merging")  # TODO merayen implement merging
+	commit_hash = get_current_commit()
+
+	if not commit_hash:
+		fail("No commit checked out to merge into")
+		return
+
+	graph = get_commit_graph()
+
+	if opts.commit_hash not in graph.parents:
+		fail(f"Commit not found: {opts.commit_hash}")
+		return
+
+	if is_ancestor(graph, opts.commit_hash, commit_hash):
+		fail(f"Commit {opts.commit_hash} has already been merged")
+		return
+
+	# Commit everything that is new, changed or deleted in the workspace
+	new, changed, deleted, unchanged = get_workspace_files()
+	mark_as_staged(sorted(set(new) | set(changed) | deleted))
+
+	create_commit(opts.message, merged_commit_hashes=(opts.commit_hash,))
 
 
 @huge_test
 def test_merge() -> None:
-	from huge.testing import catch_fail
+	from huge.testing import catch_fail, catch_output
 
 	with catch_fail() as out:
 		run_command("merge", "abcdef")
@@ -538,10 +845,53 @@ def test_merge() -> None:
 	with open("folder/first_file.txt", "w") as f:
 		f.write("Content")
 
+	run_command("add", "folder", ".hugeignore")
+	run_command("commit")
+
+	with open(".huge/current") as f:
+		first_commit = f.read()
+
+	with catch_fail() as out:
+		run_command("merge", first_commit)
+		assert out.getvalue() == f"Commit {first_commit} has already been merged\n"
+
+	# Create two diverging commits
+	_create_test_file("folder/first_file.txt", "Changed")
 	run_command("add", "folder")
 	run_command("commit")
 
-	# TODO merayen implement "checkout" to continue this path
+	with open(".huge/current") as f:
+		second_commit = f.read()
+
+	run_command("checkout", first_commit)
+
+	_create_test_file("other_file.txt")
+	run_command("add", "other_file.txt")
+	run_command("commit")
+
+	with open(".huge/current") as f:
+		third_commit = f.read()
+
+	# Bring the change from the other branch into the workspace and merge
+	run_command("checkout", second_commit, "folder/first_file.txt")
+	run_command("merge", second_commit, "-m", "Merged")
+
+	with open(".huge/current") as f:
+		merge_commit = f.read()
+
+	with open(f".huge/commits/{merge_commit}/parents") as f:
+		assert f.read() == f"{third_commit}\n{second_commit}\n"
+
+	# The merge commit has the files from both branches
+	with open(f".huge/commits/{merge_commit}/files") as f:
+		merged_files = set(f.read().splitlines())
+
+	for file_hash, path in _get_test_hashes("folder/first_file.txt", "other_file.txt"):
+		assert f"{file_hash}\t{path}" in merged_files
+
+	with catch_output() as out:
+		run_command("heads")
+		assert out.getvalue().startswith(merge_commit)
 
 
 @require_repository
@@ -1002,6 +1352,40 @@ def test_fetch():
 		# TODO merayen check that coverage information is put into .huge/remotes/coverage
 
 
+@huge_test
+def test_fetch_summary() -> None:
+	import re
+	import shutil
+	from huge.testing import catch_error, catch_output, cd
+
+	run_command("init")
+
+	_create_test_file("a")
+	run_command("add", "a")
+	run_command("commit")
+
+	os.mkdir("remote")
+	with cd("remote"):
+		run_command("init")
+
+	shutil.copy(".huge/id", "remote/.huge/id")
+
+	run_command("remote-add", "remote")
+	run_command("remote-add", "missing")
+
+	with catch_output() as out, catch_error() as err:
+		run_command("fetch")
+
+		assert sorted(out.getvalue().splitlines())[0] == "Fetching from missing: failed after 0.0s"
+		assert re.match(
+			"Fetching from remote: 0 commits received, 1 sent, \\d+ B in \\d+\\.\\ds$",
+			sorted(out.getvalue().splitlines())[1],
+		)
+		assert err.getvalue() == "Invalid address: missing. Skipped.\n"
+
+	assert os.listdir("remote/.huge/commits") == os.listdir(".huge/commits")
+
+
 @require_repository
 def push_command(opts: argparse.Namespace) -> None:
 	from huge import fail
@@ -1239,34 +1623,67 @@ def test_ignore_files():
 @require_repository
 def drop_command(opts: argparse.Namespace) -> None:
 	from huge import fail
-	from huge.repo.commit import get_commit_infos
-	from huge.repo.drop import drop_commit_files, get_removable_files, get_removable_commits
-	from huge.repo.fetch import fetch_repositories
+	from huge.repo.graph import get_commit_graph
 
-	if not opts.force:
-		fetch_repositories()
-		commit_infos = get_commit_infos()
-		removable_commits = get_removable_commits(opts.commit_hash, commit_infos)
-		dropable = get_removable_files(opts.commit_hash, commit_infos)
-
-		# TODO merayen rather allow dropping commits, but skip those with coverage < 200%
-		if set(dropable) != set(opts.commit_hash):
-			fail(
-				"The total coverage of the commits are less than 200%, meaning we could loose data.\n"
-				"If you really want to continue, run the command with --force."
-			)
-			return
+	graph = get_commit_graph()
+
+	if missing := [x for x in opts.commit_hash if x not in graph.parents]:
+		fail("Commits not found:\n  " + "\n  ".join(missing))
+		return
+
+	_drop(opts, opts.commit_hash)
+
+
+@require_repository
+def drop_all_command(opts: argparse.Namespace) -> None:
+	from huge.repo.graph import get_commit_graph
+
+	_drop(opts, list(get_commit_graph().parents))
+
+
+def _drop(opts: argparse.Namespace, commit_hashes: list[str]) -> None:
+	from huge import error, fail, output
+	from huge.repo import format_size
+	from huge.repo.drop import drop_commit_files, plan_drop
+	from huge.repo.fetch import fetch_coverages
+
+	# The coverage of remotes that can't be reached now may be outdated, so they are not counted
+	remotes = None if opts.force else fetch_coverages()
 
 	# TODO merayen we should probably in some way lock the remote repositories for changes when dropping
 
-	drop_commit_files(opts.commit_hash)
+	plan = plan_drop(commit_hashes, required_copies=None if opts.force else opts.copies, remotes=remotes)
+
+	if plan.kept_files and not plan.files:
+		fail(
+			f"None of the files are on at least {opts.copies} remotes that could be reached "
+			"(--copies), meaning we could loose data.\n"
+			"If you really want to continue, run the command with --force."
+		)
+		return
+
+	if plan.kept_files:
+		error(
+			f"Keeping {len(plan.kept_files)} files ({format_size(sum(plan.kept_files.values()))}) "
+			f"that has less than {opts.copies} copies on the remotes."
+		)
+
+	size = format_size(sum(plan.files.values()))
+
+	if opts.dry_run:
+		output(f"Would delete {len(plan.files)} files, freeing {size}")
+		return
+
+	drop_commit_files(set(plan.files))
+
+	output(f"Deleted {len(plan.files)} files, freeing {size}")
 
 	# TODO merayen should we do a fetch afterwards, and tell other repos about our coverage status that has us as our remote?
 
 
 @huge_test
 def test_drop() -> None:
-	from huge.testing import catch_fail, catch_output
+	from huge.testing import catch_fail, catch_output, temporary_repository
 
 	with catch_fail() as out:
 		run_command("drop", "invalid")
@@ -1297,12 +1714,85 @@ def test_drop() -> None:
 	with catch_fail() as out:
 		run_command("drop", repo_commits[0])
 		assert out.getvalue() == (
-			"The total coverage of the commits are less than 200%, meaning we could loose data.\n"
+			"None of the files are on at least 1 remotes that could be reached (--copies), meaning "
+			"we could loose data.\n"
 			"If you really want to continue, run the command with --force.\n"
 		)
 
-	# TODO merayen 'huge send' the repository and push the second commit and try drop again
-	# TODO merayen await implementation of 'huge send'
+	with temporary_repository() as remote_repo:
+		remote_repo = os.path.join(remote_repo, "huge")
+
+		with catch_output() as out:
+			run_command("send", remote_repo)
+			run_command("push")
+
+		with catch_output() as out:
+			run_command("drop", repo_commits[0], "--dry-run")
+			assert out.getvalue() == "Would delete 1 files, freeing 8 B\n"
+
+		assert len(os.listdir(".huge/storage")) == 2
+
+		with catch_output() as out:
+			run_command("drop", repo_commits[0])
+			assert out.getvalue() == "Deleted 1 files, freeing 8 B\n"
+
+		# Only the file in the second commit is gone, as the first commit also uses first_file.txt
+		assert set(os.listdir(".huge/storage")) == {_get_test_hashes("first_file.txt")[0][0]}
+
+		with catch_output() as out:
+			run_command("log")
+			# Second commit is not available locally anymore
+			assert [x[50] for x in out.getvalue().splitlines()] == [" ", "L"]
+
+		# Nothing more to drop in the second commit
+		with catch_output() as out:
+			run_command("drop", repo_commits[0])
+			assert out.getvalue() == "Deleted 0 files, freeing 0 B\n"
+
+		with catch_output() as out:
+			run_command("drop-all")
+			assert out.getvalue() == "Deleted 1 files, freeing 7 B\n"
+
+		assert not os.listdir(".huge/storage")
+
+
+@huge_test
+def test_drop_with_unreachable_remote() -> None:
+	import shutil
+	from huge.testing import catch_error, catch_fail, catch_output, temporary_repository
+
+	run_command("init")
+
+	_create_test_file("first_file.txt", "Content")
+	run_command("add", "first_file.txt")
+	run_command("commit")
+
+	with catch_output() as out:
+		run_command("log")
+		commit_hash = out.getvalue()[:32]
+
+	with temporary_repository() as remotes:
+		for name in ["first", "second"]:
+			with catch_output():
+				run_command("send", os.path.join(remotes, name))
+				run_command("push")
+
+		# The second remote had the file when we last fetched, but can't be reached now
+		shutil.rmtree(os.path.join(remotes, "second"))
+
+		with catch_fail() as out, catch_error():
+			run_command("drop", commit_hash, "--copies", "2")
+			assert out.getvalue() == (
+				"None of the files are on at least 2 remotes that could be reached (--copies), "
+				"meaning we could loose data.\n"
+				"If you really want to continue, run the command with --force.\n"
+			)
+
+		assert len(os.listdir(".huge/storage")) == 1
+
+		with catch_output() as out, catch_error():
+			run_command("drop", commit_hash, "--copies", "1")
+			assert out.getvalue() == "Deleted 1 files, freeing 7 B\n"
 
 
 @require_repository
@@ -1359,6 +1849,272 @@ def test_remotes():
 				)
 
 
+@require_repository
+def gc_command(opts: argparse.Namespace) -> None:
+	from huge import output
+	from huge.repo import format_size
+	from huge.repo.gc import collect_garbage
+
+	result = collect_garbage(opts.budget)
+
+	if result.temporary_paths_removed:
+		output(f"Removed {result.temporary_paths_removed} temporary files and folders")
+
+	if result.files_removed:
+		output(
+			f"Deleted {len(result.files_removed)} files that no commit uses, freeing "
+			f"{format_size(sum(result.files_removed.values()))}"
+		)
+
+	if result.coverage_lines_removed:
+		output(f"Removed {result.coverage_lines_removed} lines from coverage files")
+
+	if not result.finished:
+		output(
+			f"Time budget used up with {result.commits_remaining} commits left to check. "
+			"Run 'huge gc' again to continue."
+		)
+
+
+@huge_test
+def test_gc() -> None:
+	from huge.testing import catch_output
+
+	run_command("init")
+
+	_create_test_file("a")
+	run_command("add", "a")
+	run_command("commit")
+
+	# Nothing to clean up
+	run_command("gc")
+
+	with catch_output() as out:
+		run_command("gc", "--budget", "0s")
+		assert out.getvalue() == "Time budget used up with 1 commits left to check. Run 'huge gc' again to continue.\n"
+
+	run_command("gc")
+
+	assert len(os.listdir(".huge/storage")) == 1
+
+
+@require_repository
+def verify_command(opts: argparse.Namespace) -> None:
+	from huge import fail, output
+	from huge.repo.paths import VERIFY_REPORT_FILE
+	from huge.repo.verify import verify_repository
+
+	report = verify_repository(opts.jobs)
+
+	output(f"Verified {report.files_checked} files")
+
+	for file_hash, actual_hash in sorted(report.corrupt_files.items()):
+		output(f"Corrupt file {file_hash}, content has hash sum {actual_hash}")
+
+	for file_hash, commit_hashes in sorted(report.missing_files.items()):
+		output(f"Missing file {file_hash}, used by {len(commit_hashes)} commits")
+
+	for commit_hash in report.invalid_commits:
+		output(f"Invalid commit {commit_hash}")
+
+	if report.index_missing_from_storage or report.index_missing_files or report.index_wrong_sizes:
+		output("The storage index is outdated and will be brought up to date when used")
+
+	if not report.ok:
+		fail(f"Verification failed, see {VERIFY_REPORT_FILE}")
+
+
+@huge_test
+def test_verify() -> None:
+	from huge.repo.commit import get_commit_files, get_current_commit
+	from huge.testing import catch_fail, catch_output
+
+	run_command("init")
+
+	_create_test_file("a")
+	run_command("add", "a")
+	run_command("commit")
+
+	with catch_output() as out:
+		run_command("verify", "-j", "2")
+		assert out.getvalue() == "Verified 1 files\n"
+
+	file_hash = get_commit_files(get_current_commit())["a"]
+
+	with open(f".huge/storage/{file_hash}", "a") as f:
+		f.write("Damaged")
+
+	with catch_output() as out, catch_fail() as err:
+		run_command("verify")
+		assert out.getvalue().startswith(f"Verified 1 files\nCorrupt file {file_hash}, content has hash sum ")
+		assert f"Missing file {file_hash}, used by 1 commits\n" in out.getvalue()
+		assert err.getvalue() == "Verification failed, see .huge/verify.json\n"
+
+
+@require_repository
+def scrub_command(opts: argparse.Namespace) -> None:
+	import datetime
+	from huge import fail, output
+	from huge.repo import format_size
+	from huge.repo.verify import scrub_storage
+
+	result = scrub_storage(opts.budget, opts.max_bytes, opts.jobs)
+
+	output(f"Verified {result.files_checked} files, {format_size(result.bytes_checked)}")
+
+	for file_hash, actual_hash in sorted(result.corrupt_files.items()):
+		output(f"Corrupt file {file_hash}, content has hash sum {actual_hash}")
+
+	if result.unverified_files:
+		output(f"{result.unverified_files} files has never been verified")
+	elif result.oldest_verification:
+		oldest = datetime.datetime.fromtimestamp(result.oldest_verification)
+		output(f"All files has been verified since {oldest.strftime('%Y-%m-%d %H:%M')}")
+
+	if result.corrupt_files:
+		fail(f"Found {len(result.corrupt_files)} corrupt files")
+
+
+@huge_test
+def test_scrub() -> None:
+	from huge.testing import catch_output
+
+	run_command("init")
+
+	for x in "ab":
+		_create_test_file(x, f"Content of {x}")
+
+	run_command("add", "a", "b")
+	run_command("commit")
+
+	with catch_output() as out:
+		run_command("scrub", "--max-bytes", "1")
+		assert out.getvalue() == "Verified 1 files, 12 B\n1 files has never been verified\n"
+
+	with catch_output() as out:
+		run_command("scrub", "--budget", "1h", "-j", "2")
+		assert out.getvalue().startswith("Verified 2 files, 24 B\nAll files has been verified since ")
+
+
+@require_repository
+def serve_command(opts: argparse.Namespace) -> None:
+	import sys
+	from huge.repo.serve import serve
+
+	serve(sys.stdin.buffer, sys.stdout.buffer)
+
+
+@huge_test
+def test_serve() -> None:
+	import shutil
+	from unittest.mock import patch
+	from huge.repo.agent import connect_local
+	from huge.repo.commit import get_commit_files, get_current_commit
+	from huge.testing import catch_output, cd
+
+	run_command("init")
+
+	_create_test_file("a")
+	run_command("add", "a")
+	run_command("commit")
+
+	commit_hash = get_current_commit()
+	file_hash = get_commit_files(commit_hash)["a"]
+
+	# The remote is an empty copy of this repository
+	os.mkdir("remote")
+	with cd("remote"):
+		run_command("init")
+
+	shutil.copy(".huge/id", "remote/.huge/id")
+
+	run_command("remote-add", f"login@server:{os.path.abspath('remote')}")
+	run_command("config", "remote.agent", "huge serve --stdio")
+
+	agents = []
+
+	def connect_agent(address):
+		agents.append(connect_local(address.path))
+		return agents[-1]
+
+	# The agent is started over a pipe instead of SSH
+	with patch("huge.repo.ssh.connect_agent", new=connect_agent), catch_output():
+		run_command("push")
+
+		with cd("remote"):
+			assert os.listdir(".huge/commits") == [commit_hash]
+			assert os.listdir(".huge/storage") == [file_hash]
+
+		os.remove(f".huge/storage/{file_hash}")
+
+		run_command("pull", commit_hash)
+
+	for agent in agents:
+		agent.close()
+
+	assert os.listdir(".huge/storage") == [file_hash]
+
+
+@require_repository
+def config_command(opts: argparse.Namespace) -> None:
+	from huge import fail, output
+	from huge.repo.config import SETTINGS, get_config, set_config
+
+	if opts.setting is None:
+		for setting, (default, description) in SETTINGS.items():
+			output(f"{setting} = {get_config(setting)}")
+		return
+
+	if opts.setting not in SETTINGS:
+		fail(f"Unknown setting: {opts.setting}")
+		return
+
+	if opts.value is None:
+		output(get_config(opts.setting))
+		return
+
+	try:
+		set_config(opts.setting, opts.value)
+	except ValueError as exception:
+		fail(f"Invalid value for {opts.setting}: {opts.value!r}. {exception}")
+
+
+@huge_test
+def test_config() -> None:
+	from huge.testing import catch_fail, catch_output
+
+	run_command("init")
+
+	with catch_output() as out:
+		run_command("config", "storage.quota")
+		assert out.getvalue() == "\n"
+
+	run_command("config", "storage.quota", "10G")
+
+	with catch_output() as out:
+		run_command("config")
+		assert "storage.quota = 10G\n" in out.getvalue()
+
+	run_command("config", "storage.quota", "")
+
+	with catch_output() as out:
+		run_command("config", "storage.quota")
+		assert out.getvalue() == "\n"
+
+	# Invalid values are not stored
+	with catch_fail() as out:
+		run_command("config", "storage.quota", "banana")
+		assert out.getvalue().startswith("Invalid value for storage.quota: 'banana'.")
+
+	with catch_output() as out:
+		run_command("config", "storage.quota")
+		assert out.getvalue() == "\n"
+
+	with catch_fail() as out:
+		run_command("config", "nonsense")
+		assert out.getvalue() == "Unknown setting: nonsense\n"
+
+
 @require_repository
 def add_command(opts: argparse.Namespace) -> None:
 	from huge.repo.stage import mark_as_staged
@@ -1446,6 +2202,17 @@ def _create_ignore_file(paths: list[str]) -> None:
 		f.write("\n".join(paths) + "\n")
 
 
+def _get_test_hashes(*paths: str) -> list[tuple[str, str]]:
+	import hashlib
+
+	result: list[tuple[str, str]] = []
+	for path in paths:
+		with open(path, "rb") as f:
+			result.append((hashlib.md5(f.read()).hexdigest().lower(), path))
+
+	return result
+
+
 def _contains_contents(path: str, content: str) -> bool:
 	if not os.path.isfile(path):
 		return False
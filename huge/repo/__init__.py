@@ -2,6 +2,8 @@
 Repository
 """
 import os
+from contextlib import contextmanager
+from typing import Iterator, TextIO
 
 
 def is_repository() -> bool:
@@ -72,3 +74,52 @@ def create_repository_structure(path: str) -> None:
 	os.mkdir(os.path.join(path, COMMITS_DIRECTORY))
 	os.mkdir(os.path.join(path, FILES_DIRECTORY))
 	os.mkdir(os.path.join(path, REMOTES_FOLDER))
+
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[TextIO]:
+	"""
+	Write a text file in a way that readers either see the old or the new content
+
+	Content is written to a temporary file next to the target, which is then moved in place.
+	"""
+	import tempfile
+
+	fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+
+	try:
+		with os.fdopen(fd, "w") as f:
+			yield f
+
+		os.replace(temporary_path, path)
+	except BaseException:
+		os.remove(temporary_path)
+		raise
+
+
+def format_size(size: int) -> str:
+	"""
+	Format a number of bytes for humans, e.g "1.5 GB"
+	"""
+	for unit in ["B", "KB", "MB", "GB", "TB"]:
+		if size < 1024 or unit == "TB":
+			break
+
+		size /= 1024
+
+	return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def clear_caches() -> None:
+	"""
+	Forget everything cached in-process
+
+	Caches are only meant to live for the duration of a single command.
+	"""
+	from huge.repo.coverage import forget_remote_coverages
+	from huge.repo.graph import forget_commit_graph
+	from huge.repo.storage import forget_stored_files
+
+	forget_commit_graph()
+	forget_remote_coverages()
+	forget_stored_files()
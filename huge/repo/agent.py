@@ -0,0 +1,527 @@
+"""
+Talking to a remote repository through 'huge serve --stdio'
+
+Instead of running a new ssh or rsync for each thing we want from a server, a single agent is
+started on it and everything is done in one session over the agent's stdin and stdout.
+
+Everything sent is a frame: 4 bytes of big endian length followed by that many bytes. A message is
+a frame with a JSON object. Lists of hash sums and file contents are sent as streams, which are
+frames of data ended by an empty frame. Hash sums are sent as lines, many in each frame.
+
+Each request is a message with an "op" field, maybe followed by streams, see huge.repo.serve for the
+operations. The agent answers each request in the order they were sent, so requests can be sent
+before the previous answers have been read. An answer with an "error" field means the request
+failed, and the session can still be used. A request that fails in the middle of a stream ends the
+session instead.
+"""
+import os
+import subprocess
+from typing import BinaryIO, Iterable, Iterator
+from huge.repo.storage import StorageChanges
+from huge.testing import huge_test
+
+PROTOCOL_VERSION = 4
+
+# Size of the frames that file content is sent in
+CHUNK_SIZE = 2**20
+
+# Number of hash sums sent in each frame
+LINES_PER_FRAME = 10000
+
+
+class AgentError(Exception):
+	pass
+
+
+def write_frame(stream: BinaryIO, data: bytes) -> None:
+	stream.write(len(data).to_bytes(4, "big"))
+	stream.write(data)
+
+
+def read_frame(stream: BinaryIO) -> bytes | None:
+	"""
+	Read the next frame, or None if the other end has closed the connection
+	"""
+	header = stream.read(4)
+
+	if not header:
+		return None
+
+	if len(header) != 4:
+		raise AgentError("Connection closed in the middle of a frame")
+
+	size = int.from_bytes(header, "big")
+	data = stream.read(size)
+
+	if len(data) != size:
+		raise AgentError("Connection closed in the middle of a frame")
+
+	return data
+
+
+def write_message(stream: BinaryIO, message: dict) -> None:
+	import json
+
+	write_frame(stream, json.dumps(message).encode())
+
+
+def read_message(stream: BinaryIO) -> dict | None:
+	import json
+
+	data = read_frame(stream)
+
+	return None if data is None else json.loads(data)
+
+
+def write_lines(stream: BinaryIO, lines: Iterable[str]) -> None:
+	"""
+	Send a stream of lines, e.g hash sums
+	"""
+	batch: list[str] = []
+
+	for x in lines:
+		batch.append(x)
+
+		if len(batch) == LINES_PER_FRAME:
+			write_frame(stream, "\n".join(batch).encode())
+			batch.clear()
+
+	if batch:
+		write_frame(stream, "\n".join(batch).encode())
+
+	write_frame(stream, b"")
+
+
+def read_lines(stream: BinaryIO) -> Iterator[str]:
+	for data in read_stream(stream):
+		yield from data.decode().split("\n")
+
+
+def write_file(stream: BinaryIO, path: str, offset: int = 0) -> None:
+	"""
+	Send the content of a file as a stream, starting at offset
+	"""
+	with open(path, "rb") as f:
+		f.seek(offset)
+
+		while data := f.read(CHUNK_SIZE):
+			write_frame(stream, data)
+
+	write_frame(stream, b"")
+
+
+def read_stream(stream: BinaryIO) -> Iterator[bytes]:
+	while data := read_frame(stream):
+		yield data
+
+	if data is None:
+		raise AgentError("Connection closed in the middle of a stream")
+
+
+def receive_file(stream: BinaryIO, file_hash: str, offset: int, path: str = ".") -> bool:
+	"""
+	Read a file stream sent from offset into the staging area of a repository, see stage_stream()
+	"""
+	from huge.repo.staging import stage_stream
+
+	return stage_stream(file_hash, read_stream(stream), offset, path)
+
+
+class Agent:
+	"""
+	A session with an agent running 'huge serve --stdio'
+
+	Usage:
+		with Agent(ssh_command(address) + ["cd /repository && huge serve --stdio"]) as agent:
+			agent.check_repository()
+			file_hashes = agent.list_files()
+	"""
+
+	def __init__(self, command: list[str], cwd: str | None = None, env: dict[str, str] | None = None):
+		self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, env=env)
+		self.input: BinaryIO = self.process.stdout
+		self.output: BinaryIO = self.process.stdin
+
+	def __enter__(self) -> "Agent":
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+	def close(self) -> None:
+		if self.process.poll() is None:
+			self.output.close()
+			self.process.wait()
+
+	def send(self, op: str, **arguments) -> None:
+		"""
+		Send a request without waiting for the answer
+		"""
+		write_message(self.output, {"op": op, **arguments})
+
+	def receive(self) -> dict:
+		"""
+		Read the answer of the oldest request not answered yet
+		"""
+		self.output.flush()
+
+		message = read_message(self.input)
+
+		if message is None:
+			raise AgentError(f"Agent stopped unexpectedly with code {self.process.wait()}")
+
+		if "error" in message:
+			raise AgentError(message["error"])
+
+		return message
+
+	def get_repository_id(self) -> str:
+		self.send("hello", version=PROTOCOL_VERSION)
+		return self.receive()["repo_id"]
+
+	def check_repository(self) -> None:
+		"""
+		Make sure the agent serves the same repository as ours
+		"""
+		from huge.repo.paths import REPO_ID_FILE
+
+		with open(REPO_ID_FILE) as f:
+			if self.get_repository_id() != f.read().strip():
+				raise AgentError("remote repository id doesn't match local repository id")
+
+	def list_files(self) -> set[str]:
+		self.send("list_files")
+		self.receive()
+		return set(read_lines(self.input))
+
+	def list_changes(self, epoch: str, sequence: int) -> StorageChanges:
+		"""
+		Ask what the agent has stored and deleted since a position in its storage log, see
+		huge.repo.storage.get_storage_changes
+		"""
+		self.send("list_changes", epoch=epoch, sequence=sequence)
+		answer = self.receive()
+		lines = list(read_lines(self.input))
+
+		if answer["listed"]:
+			return StorageChanges(answer["epoch"], answer["sequence"], files=set(lines))
+
+		return StorageChanges(
+			answer["epoch"],
+			answer["sequence"],
+			added={x[1:] for x in lines if x.startswith("+")},
+			removed={x[1:] for x in lines if x.startswith("-")},
+		)
+
+	def list_commits(self) -> set[str]:
+		self.send("list_commits")
+		self.receive()
+		return set(read_lines(self.input))
+
+	def have(self, file_hashes: set[str]) -> set[str]:
+		"""
+		Ask which of the files the agent has, without listing all of its files
+		"""
+		self.send("have")
+		write_lines(self.output, file_hashes)
+		self.receive()
+		return set(read_lines(self.input))
+
+	def get_staged(self, file_hashes: set[str]) -> dict[str, int]:
+		"""
+		Ask how much the agent has received of files earlier, see huge.repo.staging
+
+		Returns: {"hash sum": offset}, for the files partly received
+		"""
+		self.send("staged")
+		write_lines(self.output, file_hashes)
+		return self.receive()["offsets"]
+
+	def get_files(self, file_hashes: set[str]) -> set[str]:
+		"""
+		Download files into FILES_DIRECTORY, continuing files partly received earlier
+
+		Returns the files received, which must be added to the storage index by the caller. Files the
+		agent does not have, or that was damaged on the way, are left out.
+		"""
+		from huge.repo.staging import get_staged_offsets
+
+		self.send("get_files", offsets=get_staged_offsets(file_hashes))
+		write_lines(self.output, file_hashes)
+		self.receive()
+
+		received: set[str] = set()
+
+		while "file" in (message := self.receive()):
+			if not message.get("missing") and receive_file(self.input, message["file"], message["offset"]):
+				received.add(message["file"])
+
+		return received
+
+	def put_files(self, file_hashes: set[str]) -> set[str]:
+		"""
+		Upload files from FILES_DIRECTORY, continuing files partly sent earlier
+
+		Returns the files the agent stored.
+		"""
+		from huge.repo.paths import FILES_DIRECTORY
+
+		offsets = self.get_staged(file_hashes)
+
+		self.send("put_files")
+
+		for file_hash in file_hashes:
+			write_message(self.output, {"file": file_hash, "offset": offsets.get(file_hash, 0)})
+			write_file(self.output, os.path.join(FILES_DIRECTORY, file_hash), offsets.get(file_hash, 0))
+
+		write_message(self.output, {"done": True})
+
+		self.receive()
+		return set(read_lines(self.input))
+
+	def put_delta(self, file_hash: str, base_hash: str) -> bool:
+		"""
+		Upload a file from FILES_DIRECTORY as a delta against a base both we and the agent has, see
+		huge.repo.delta
+
+		Returns whether the agent stored it.
+		"""
+		from huge.repo.delta import make_delta, write_delta
+		from huge.repo.paths import FILES_DIRECTORY
+
+		self.send("put_delta", file=file_hash, base=base_hash)
+		write_delta(self.output, make_delta(
+			os.path.join(FILES_DIRECTORY, base_hash),
+			os.path.join(FILES_DIRECTORY, file_hash),
+		))
+
+		return self.receive()["stored"]
+
+	def get_commits(self, commit_hashes: set[str]) -> None:
+		"""
+		Download commits into COMMITS_DIRECTORY
+		"""
+		self.send("get_commits")
+		write_lines(self.output, commit_hashes)
+		self.receive()
+
+		while "commit" in (message := self.receive()):
+			write_commit(message["commit"], message["files"])
+
+	def put_commits(self, commit_hashes: set[str]) -> None:
+		"""
+		Upload commits from COMMITS_DIRECTORY
+		"""
+		self.send("put_commits")
+
+		for commit_hash in commit_hashes:
+			write_message(self.output, {"commit": commit_hash, "files": read_commit(commit_hash)})
+
+		write_message(self.output, {"done": True})
+
+		self.receive()
+
+
+def connect_local(path: str) -> Agent:
+	"""
+	Start an agent on a local repository, talking to it over a pipe
+
+	Behaves the same as an agent started over SSH. Mostly useful for testing.
+	"""
+	import sys
+
+	package_folder = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join(x for x in [package_folder, env.get("PYTHONPATH")] if x)
+
+	return Agent([sys.executable, "-m", "huge", "serve", "--stdio"], cwd=path, env=env)
+
+
+def read_commit(commit_hash: str) -> dict[str, str]:
+	"""
+	Read the files of a commit folder, e.g {"files": "...", "parents": "...", "timestamp": "..."}
+	"""
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	result: dict[str, str] = {}
+
+	for name in os.listdir(os.path.join(COMMITS_DIRECTORY, commit_hash)):
+		with open(os.path.join(COMMITS_DIRECTORY, commit_hash, name)) as f:
+			result[name] = f.read()
+
+	return result
+
+
+def write_commit(commit_hash: str, files: dict[str, str]) -> None:
+	"""
+	Create a commit folder, if it does not exist already
+
+	The folder is written elsewhere first and then moved in place, so that an interrupted transfer
+	never leaves half a commit behind.
+	"""
+	import re
+	import shutil
+	import tempfile
+	from huge.repo.paths import COMMITS_DIRECTORY, HUGE_DIRECTORY
+
+	if not re.match("^[0-9a-f]{32}$", commit_hash) or any(os.sep in x or x.startswith(".") for x in files):
+		raise AgentError(f"Invalid commit {commit_hash!r}")
+
+	if os.path.isdir(os.path.join(COMMITS_DIRECTORY, commit_hash)):
+		return
+
+	d = tempfile.mkdtemp(dir=HUGE_DIRECTORY)
+
+	for name, content in files.items():
+		with open(os.path.join(d, name), "w") as f:
+			f.write(content)
+
+	try:
+		os.rename(d, os.path.join(COMMITS_DIRECTORY, commit_hash))
+	except OSError:
+		# Someone else wrote the commit in the meantime
+		shutil.rmtree(d)
+
+
+def test_frames() -> None:
+	import io
+
+	stream = io.BytesIO()
+
+	write_message(stream, {"op": "hello"})
+	write_lines(stream, (f"{x:032x}" for x in range(LINES_PER_FRAME + 1)))
+	write_lines(stream, [])
+
+	stream.seek(0)
+
+	assert read_message(stream) == {"op": "hello"}
+	assert len(list(read_lines(stream))) == LINES_PER_FRAME + 1
+	assert list(read_lines(stream)) == []
+	assert read_message(stream) is None
+
+
+@huge_test
+def test_receive_file() -> None:
+	import hashlib
+	import io
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.staging import StagedFile
+
+	create_repository()
+
+	content = b"0123456789"
+	file_hash = hashlib.md5(content).hexdigest()
+
+	def send(offset: int) -> io.BytesIO:
+		stream = io.BytesIO()
+		write_frame(stream, content[offset:offset + 3])
+		write_frame(stream, content[offset + 3:])
+		write_frame(stream, b"")
+		stream.seek(0)
+		return stream
+
+	with patch("huge.repo.staging.BLOCK_SIZE", 4):
+		with StagedFile(file_hash) as staged:
+			staged.write(content[:9])
+
+		# More than what is staged was expected to be there
+		assert not receive_file(send(12), file_hash, 12)
+
+		# Less was expected, so the start of the stream is skipped
+		assert receive_file(send(4), file_hash, 4)
+
+	with open(os.path.join(FILES_DIRECTORY, file_hash), "rb") as f:
+		assert f.read() == content
+
+
+@huge_test
+def test_agent() -> None:
+	import shutil
+	from huge.repo import create_repository
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.paths import COMMITS_DIRECTORY, FILES_DIRECTORY, REPO_ID_FILE
+	from huge.repo.stage import mark_as_staged
+	from huge.repo.storage import add_stored_files
+	from huge.testing import cd
+
+	create_repository()
+
+	with open("a", "w") as f:
+		f.write("Content")
+
+	mark_as_staged(["a"])
+	create_commit(None)
+
+	commit_hash = get_current_commit()
+	file_hash = get_commit_files(commit_hash)["a"]
+
+	# The remote is a copy of us, without any commits or files
+	os.mkdir("remote")
+	with cd("remote"):
+		create_repository()
+
+	with open(REPO_ID_FILE) as f, open(os.path.join("remote", REPO_ID_FILE), "w") as g:
+		g.write(f.read())
+
+	with connect_local("remote") as agent:
+		agent.check_repository()
+
+		assert agent.list_files() == set()
+		assert agent.list_commits() == set()
+
+		changes = agent.list_changes("", 0)
+		assert changes.files == set()
+
+		agent.put_commits({commit_hash})
+		assert agent.list_commits() == {commit_hash}
+
+		assert agent.put_files({file_hash}) == {file_hash}
+		assert agent.have({file_hash, "f" * 32}) == {file_hash}
+
+		# Only what happened since is sent
+		assert agent.list_changes(changes.epoch, changes.sequence).added == {file_hash}
+
+		# Requests can be sent before reading the answers of the previous ones
+		agent.send("hello", version=PROTOCOL_VERSION)
+		agent.send("list_files")
+		assert "repo_id" in agent.receive()
+		agent.receive()
+		assert set(read_lines(agent.input)) == {file_hash}
+
+		try:
+			agent.send("unknown")
+			agent.receive()
+			assert False
+		except AgentError as exception:
+			assert "unknown" in str(exception)
+
+		# A request that fails in the agent is answered with the error, and the agent keeps going
+		try:
+			agent.send("list_changes", epoch="", sequence="x")
+			agent.receive()
+			assert False
+		except AgentError as exception:
+			assert "ValueError" in str(exception)
+
+		assert agent.list_files() == {file_hash}
+
+		# Download the files and commit back again
+		os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+		shutil.rmtree(os.path.join(COMMITS_DIRECTORY, commit_hash))
+
+		assert agent.get_files({file_hash, "f" * 32}) == {file_hash}
+		add_stored_files({file_hash})
+
+		assert agent.get_staged({file_hash}) == {}
+
+		agent.get_commits({commit_hash})
+		assert get_commit_files(commit_hash) == {"a": file_hash}
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -67,18 +67,22 @@ def _clone_remote(address: SSHAddress) -> None:
 	"""
 	import subprocess
 	from huge.repo import create_repository
+	from huge.repo.compression import get_compression_level, rsync_compression
 	from huge.repo.paths import HUGE_DIRECTORY, REMOTES_FOLDER, REPO_ID_FILE
+	from huge.repo.ssh import rsync_address, rsync_command
 
 	# Create a new repository at current path that we will overwrite
 	create_repository()
 
 	process = subprocess.Popen(
+		rsync_command() +
+		rsync_compression(get_compression_level(None)) +
 		[
-			"rsync", "-ahz", "--info=progress2",
+			"-ah", "--info=progress2",
 
 			# Sources - only the files that are initially needed
-			f"{address.login}@{address.server}:{address.path}/{REPO_ID_FILE}",
-			f"{address.login}@{address.server}:{address.path}/{REMOTES_FOLDER}",
+			rsync_address(address, f"{address.path}/{REPO_ID_FILE}"),
+			rsync_address(address, f"{address.path}/{REMOTES_FOLDER}"),
 
 			# Target
 			HUGE_DIRECTORY,
@@ -4,6 +4,8 @@ Commits in a repo
 import datetime
 import os
 from dataclasses import dataclass, field
+from typing import Iterator
+from huge.repo.graph import CommitGraph
 
 
 def get_commit_hashes() -> list[str]:
@@ -31,83 +33,106 @@ class CommitInfo:
 	children: set[str] = field(default_factory=set)
 	branch: int = 0
 
+	# Branches of the children
+	child_branches: set[int] = field(default_factory=set)
+
 
 def get_commit_infos() -> list[CommitInfo]:
-	from huge.repo.paths import COMMITS_DIRECTORY, FILES_DIRECTORY
-	from huge.repo.coverage import analyze_repository_coverages
+	"""
+	Get all the commits, oldest first
+	"""
+	return list(reversed(list(iter_commit_infos())))
 
-	result: dict[str, CommitInfo] = {}
 
-	files: list[tuple[str, str]]
-	available_files = set(os.listdir(FILES_DIRECTORY))
+def iter_commit_infos(
+	since: datetime.datetime | None = None,
+	until: datetime.datetime | None = None,
+) -> Iterator[CommitInfo]:
+	"""
+	Go through the commits, newest first
 
-	branch_counter = 0
+	Only the commit graph is needed to find the order, so the files and coverage of a commit are not
+	read before the commit is asked for.
+	"""
+	from huge.repo.graph import get_branch_labels, get_commit_graph
 
-	for commit_hash in get_commit_hashes():
-		attributes = {}
-		for attribute in ["timestamp", "message", "parents"]:
-			if os.path.isfile(f"{COMMITS_DIRECTORY}/{commit_hash}/{attribute}"):
-				with open(os.path.join(COMMITS_DIRECTORY, commit_hash, attribute)) as f:
-					attributes[attribute] = f.read()
+	graph = get_commit_graph()
+	branch_labels = get_branch_labels(graph)
 
-			with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "files")) as f:
-				files = [tuple(x.split(maxsplit=1)) for x in f.readlines()]
+	for commit_hash in sorted(graph.parents, key=lambda x: graph.timestamps[x], reverse=True):
+		timestamp = parse_commit_timestamp(graph.timestamps[commit_hash])
 
-		if files:
-			coverage = sum(file_hash in available_files for file_hash, file_path in files) / len(files)
-		else:
-			coverage = 1
+		if until is not None and timestamp > until:
+			continue
 
-		result[commit_hash] = CommitInfo(
-			commit_hash=commit_hash,
+		if since is not None and timestamp < since:
+			break  # All the remaining commits are older
 
-			timestamp=datetime.datetime.fromisoformat(
-				attributes["timestamp"],
-			).replace(
-				tzinfo=datetime.timezone.utc,
-			).astimezone(None),
+		yield _create_commit_info(commit_hash, timestamp, graph, branch_labels)
 
-			message=attributes.get("message"),
 
-			parents={x.strip() for x in attributes["parents"].splitlines() if x.strip()},
+def _create_commit_info(
+	commit_hash: str,
+	timestamp: datetime.datetime,
+	graph: CommitGraph,
+	branch_labels: dict[str, int],
+) -> CommitInfo:
+	from huge.repo.paths import COMMITS_DIRECTORY
+	from huge.repo.coverage import analyze_repository_coverages
+	from huge.repo.storage import get_stored_files
+
+	files: list[tuple[str, str]]
+	with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "files")) as f:
+		files = [tuple(x.split(maxsplit=1)) for x in f.readlines()]
+
+	if files:
+		available_files = get_stored_files()
+		coverage = sum(file_hash in available_files for file_hash, file_path in files) / len(files)
+	else:
+		coverage = 1
 
-			files=files,
+	return CommitInfo(
+		commit_hash=commit_hash,
 
-			coverage=coverage,
+		timestamp=timestamp,
 
-			total_coverage=analyze_repository_coverages(commit_hash).coverage,
-		)
+		message=get_commit_message(commit_hash),
 
-	# Set children
-	for commit_hash, commit_info in result.items():
-		for parent_commit_hash in commit_info.parents:
-			result[parent_commit_hash].children.add(commit_hash)
+		parents=set(graph.parents[commit_hash]),
 
-	sorted_result = sorted(result.items(), key=lambda x:x[1].timestamp)
+		files=files,
 
-	# Add branch markers
-	for commit_hash, commit_info in sorted_result:
-		if len(commit_info.children) > 1 or len(commit_info.parents) > 1:
-			for child_commit_hash in sorted(commit_info.children, key=lambda x:result[x].timestamp):
-				# Add branch markers to all commits in that line
-				branch_counter += 1
-				todo = [child_commit_hash]
-				done = []
-				while todo:
-					commit_hash = todo.pop(-1)
+		coverage=coverage,
 
-					# Loops should not happen, but just in case. Such errors should probably be detected
-					# elsewhere.
-					if commit_hash in done: continue
+		total_coverage=analyze_repository_coverages(commit_hash).coverage,
 
-					# Commits that merges branches is the end of a branch line
-					if len(result[commit_hash].parents) > 1: continue
+		children=set(graph.children[commit_hash]),
 
-					result[commit_hash].branch = branch_counter
-					done.append(commit_hash)
-					todo.extend(result[commit_hash].children)
+		branch=branch_labels[commit_hash],
+
+		child_branches={branch_labels[x] for x in graph.children[commit_hash]},
+	)
 
-	return [v for k,v in sorted_result]
+
+def parse_commit_timestamp(timestamp: str) -> datetime.datetime:
+	"""
+	Convert the content of a commit's timestamp file to local time
+	"""
+	return datetime.datetime.fromisoformat(
+		timestamp,
+	).replace(
+		tzinfo=datetime.timezone.utc,
+	).astimezone(None)
+
+
+def get_commit_message(commit_hash: str) -> str | None:
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	if os.path.isfile(os.path.join(COMMITS_DIRECTORY, commit_hash, "message")):
+		with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "message")) as f:
+			return f.read()
+
+	return None
 
 
 def get_current_commit() -> str | None:
@@ -123,13 +148,25 @@ def get_current_commit() -> str | None:
 	return None
 
 
-def create_commit(message: str | None) -> None:
+def create_commit(message: str | None, merged_commit_hashes: tuple[str, ...] = ()) -> None:
+	"""
+	Store the staged files in a new commit on top of the current commit
+
+	Any merged_commit_hashes are added as parents after the current commit, making this a merge
+	commit.
+	"""
 	# TODO merayen make sure to only commit files in .huge/stage
 
 	import datetime
 	import shutil
 	from huge.repo import create_hash
 	from huge.repo.commit import get_current_commit
+	from huge.repo.encoding import compress_file
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.history import update_path_history
+	from huge.repo.metadata import record_access
+	from huge.repo.quota import enforce_quota
+	from huge.repo.references import update_references
 	from huge.repo.paths import (
 		COMMITS_DIRECTORY,
 		CURRENT_COMMIT_FILE,
@@ -140,6 +177,7 @@ def create_commit(message: str | None) -> None:
 		hash_workspace_files,
 		reset_staging,
 	)
+	from huge.repo.storage import add_stored_files, get_stored_files
 
 	current_commit_hash = get_current_commit()
 	previous_commit_files: dict[str, str] = {}
@@ -159,12 +197,16 @@ def create_commit(message: str | None) -> None:
 
 	# Copy files that doesn't exist into FILES_DIRECTORY
 	# TODO merayen rename all "hash_sum" to "path_sum"
+	stored_files = get_stored_files()
+	added_files: set[str] = set()
 	for path, hash_sum in workspace_files.items():
 		if path in staged_files:  # Only commit staged files
-			storage_path = os.path.join(FILES_DIRECTORY, hash_sum)
+			if hash_sum not in stored_files and hash_sum not in added_files:
+				shutil.copyfile(path, os.path.join(FILES_DIRECTORY, hash_sum))
+				compress_file(os.path.join(FILES_DIRECTORY, hash_sum), hash_sum)
+				added_files.add(hash_sum)
 
-			if not os.path.isfile(storage_path):
-				shutil.copyfile(path, storage_path)
+	add_stored_files(added_files)
 
 	# Files that should go/be forwarded into the commit we are making, minus the ones to remove
 	with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "files"), "w") as f:
@@ -189,6 +231,9 @@ def create_commit(message: str | None) -> None:
 		if current_commit_hash := get_current_commit():
 			f.write(f"{current_commit_hash}\n")
 
+		for merged_commit_hash in merged_commit_hashes:
+			f.write(f"{merged_commit_hash}\n")
+
 	# Write timestamp to commit
 	with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "timestamp"), "w") as f:
 		f.write(datetime.datetime.now(datetime.UTC).isoformat())
@@ -200,6 +245,14 @@ def create_commit(message: str | None) -> None:
 	# Remove the file that says which files are to be committed
 	reset_staging()
 
+	record_access({workspace_files[x] for x in set(workspace_files) & staged_files})
+	enforce_quota()
+
+	# Add the new commit to the commit graph and the indexes
+	get_commit_graph()
+	update_path_history()
+	update_references()
+
 
 def get_commit_files(commit_hash: str) -> dict[str, str]:
 	"""
@@ -231,7 +284,9 @@ def checkout_commit(commit_hash: str) -> None:
 	import pathlib
 	import shutil
 	from huge import fail
+	from huge.repo.encoding import copy_stored
 	from huge.repo.paths import CURRENT_COMMIT_FILE, FILES_DIRECTORY
+	from huge.repo.metadata import record_access
 	from huge.repo.stage import get_workspace_files
 
 	ensure_commit_exists(commit_hash)
@@ -273,7 +328,9 @@ def checkout_commit(commit_hash: str) -> None:
 		if folder_path := os.path.split(path)[0]:
 			pathlib.Path(folder_path).mkdir(parents=True, exist_ok=True)
 
-		shutil.copyfile(os.path.join(FILES_DIRECTORY, path_sum), path)
+		copy_stored(os.path.join(FILES_DIRECTORY, path_sum), path_sum, path)
+
+	record_access(set(commit_files.values()))
 
 	# Change the current commit
 	with open(CURRENT_COMMIT_FILE, "w") as f:
@@ -287,9 +344,10 @@ def checkout_files(commit_hash: str, files: list[str]) -> None:
 	Requires that the files are available.
 	"""
 	import pathlib
-	import shutil
 	from huge import fail
+	from huge.repo.encoding import copy_stored
 	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.metadata import record_access
 
 	ensure_commit_exists(commit_hash)
 
@@ -315,7 +373,9 @@ def checkout_files(commit_hash: str, files: list[str]) -> None:
 			pathlib.Path(folder_path).mkdir(parents=True, exist_ok=True)
 
 		# We overwrite changed files, in the same manner as git does
-		shutil.copyfile(os.path.join(FILES_DIRECTORY, path_sum), path)
+		copy_stored(os.path.join(FILES_DIRECTORY, path_sum), path_sum, path)
+
+	record_access({path_sum for path, path_sum in commit_files.items() if path in files})
 
 
 # TODO merayen make sure this one is catched
@@ -0,0 +1,179 @@
+"""
+Choosing how to compress what is sent to and from a remote
+
+Compression helps on slow links, but on a fast one the time spent compressing is more than what it
+saves, and content that is compressed already (video, images, archives) gets nothing out of it. With
+"remote.compression" set to auto, rsync is told to compress with zstd at a level picked from the
+measured bandwidth of the remote: the highest level that still compresses several times faster than
+the link, so that the CPU is never what holds the transfer back. On links too fast for even the
+lowest level nothing is compressed, and neither are transfers to remotes not added yet. rsync older
+than 3.2, like the one that comes with macOS, has no zstd, and compresses with its default instead.
+
+Before pushing a batch of files, a few samples of them are compressed to see whether the content
+compresses at all. Files being pulled can't be sampled before they arrive, and rely on zstd sending
+blocks that do not compress as they are.
+"""
+import os
+from huge.testing import huge_test
+
+# How fast zstd compresses at each level on one core, in bytes per second, roughly
+ZSTD_SPEEDS = [
+	(19, 3 * 2**20),
+	(15, 10 * 2**20),
+	(9, 60 * 2**20),
+	(6, 100 * 2**20),
+	(3, 250 * 2**20),
+	(1, 400 * 2**20),
+]
+
+# How many times faster than the link compression must be
+HEADROOM = 4
+
+# Level used for remotes that have not been measured yet
+DEFAULT_LEVEL = 1
+
+# Content that can not be compressed to less than this part of its size is sent as it is
+COMPRESSIBLE_RATIO = .9
+
+# Samples taken of files before deciding whether to compress them, and the size of each
+SAMPLES = 16
+SAMPLE_SIZE = 2**16
+
+# Whether the local rsync can compress with zstd, found out once per command
+_rsync_has_zstd: bool | None = None
+
+
+def get_compression_level(remote_hash: str | None) -> int:
+	"""
+	Get the zstd level to compress transfers with a remote with, or 0 to not compress
+
+	remote_hash is None for remotes that are not added yet, e.g when cloning, which are not
+	compressed unless told to.
+	"""
+	from huge.repo.config import get_config
+	from huge.repo.remote import get_remote_bandwidth
+
+	if (setting := get_config("remote.compression")) != "auto":
+		return int(setting)
+
+	if remote_hash is None:
+		return 0
+
+	if (bandwidth := get_remote_bandwidth(remote_hash)) is None:
+		return DEFAULT_LEVEL
+
+	return next((level for level, speed in ZSTD_SPEEDS if speed >= HEADROOM * bandwidth), 0)
+
+
+def is_compressible(paths: list[str]) -> bool:
+	"""
+	Sample files to see whether compressing them is worth it
+
+	The samples are taken from the middle of files spread over the list, and compressed with zlib at
+	its fastest level, as an estimate of what zstd will do.
+	"""
+	import zlib
+
+	raw = compressed = 0
+
+	for path in paths[::max(1, len(paths) // SAMPLES)][:SAMPLES]:
+		with open(path, "rb") as f:
+			f.seek(max(0, os.fstat(f.fileno()).st_size // 2 - SAMPLE_SIZE // 2))
+			data = f.read(SAMPLE_SIZE)
+
+		raw += len(data)
+		compressed += len(zlib.compress(data, 1))
+
+	return raw > 0 and compressed < raw * COMPRESSIBLE_RATIO
+
+
+def rsync_compression(level: int) -> list[str]:
+	"""
+	rsync options for compressing with zstd at a level, or none for 0
+
+	An rsync without zstd is only told to compress, as its levels are not the ones of zstd.
+	"""
+	if not level:
+		return []
+
+	if not _has_zstd():
+		return ["--compress"]
+
+	return ["--compress", "--compress-choice=zstd", f"--compress-level={level}"]
+
+
+def _has_zstd() -> bool:
+	import subprocess
+
+	global _rsync_has_zstd
+
+	if _rsync_has_zstd is None:
+		try:
+			process = subprocess.run(["rsync", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+			_rsync_has_zstd = b"zstd" in process.stdout
+		except OSError:
+			_rsync_has_zstd = False
+
+	return _rsync_has_zstd
+
+
+@huge_test
+def test_get_compression_level() -> None:
+	import subprocess
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.remote import add_remote, get_remotes, record_remote_bandwidth
+
+	create_repository()
+	add_remote("remote")
+
+	remote_hash = next(get_remotes()).remote_hash
+
+	assert get_compression_level(None) == 0
+	assert get_compression_level(remote_hash) == DEFAULT_LEVEL
+
+	# A thin WAN link gets a high level, and a gigabit LAN none
+	record_remote_bandwidth(remote_hash, 2**20, 1)
+	assert get_compression_level(remote_hash) == 15
+
+	record_remote_bandwidth(remote_hash, 2**30, 1)
+	record_remote_bandwidth(remote_hash, 2**30, 1)
+	assert get_compression_level(remote_hash) == 0
+
+	set_config("remote.compression", "5")
+	assert get_compression_level(remote_hash) == 5
+
+	assert get_compression_level(None) == 5
+
+	assert rsync_compression(0) == []
+
+	with patch("huge.repo.compression._rsync_has_zstd", True):
+		assert "--compress-level=5" in rsync_compression(5)
+
+	# Before rsync 3.2 there is no zstd
+	old_rsync = subprocess.CompletedProcess([], 0, b"rsync  version 2.6.9  protocol version 29\n")
+
+	with patch("huge.repo.compression._rsync_has_zstd", None), patch("subprocess.run", return_value=old_rsync):
+		assert rsync_compression(5) == ["--compress"]
+
+
+@huge_test
+def test_is_compressible() -> None:
+	import random
+
+	with open("text", "w") as f:
+		f.write("All work and no play makes Jack a dull boy\n" * 10000)
+
+	with open("random", "wb") as f:
+		f.write(random.Random(1).randbytes(SAMPLE_SIZE * 2))
+
+	assert is_compressible(["text"])
+	assert not is_compressible(["random"])
+	assert not is_compressible([])
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,297 @@
+"""
+Repository configuration
+
+Stored in CONFIG_FILE as lines of "key = value". Only the keys in SETTINGS are allowed, and keys
+that are not set in the file gets their default value.
+"""
+import os
+from typing import Callable
+
+# {"key": ("default value", "description")}
+SETTINGS: dict[str, tuple[str, str]] = {
+	"storage.quota": (
+		"",
+		"Maximum size of .huge/storage, e.g 500G. When exceeded after a commit or pull, the least "
+		"recently checked out files are deleted. Empty means no limit.",
+	),
+	"storage.eviction-copies": (
+		"2",
+		"How many remotes that needs to have a file before it can be deleted to stay within "
+		"storage.quota. Only remotes listed within remote.inventory-age are counted.",
+	),
+	"storage.compression": (
+		"0",
+		"zstd level from 1 to 19 to compress files with when they are committed, in long range mode. "
+		"Needs the zstd command, also in the repositories that check the files out. 0 means to store "
+		"files as they are.",
+	),
+	"storage.compression-ratio": (
+		"0.8",
+		"Compressed files are only stored compressed if they are smaller than this part of their "
+		"size.",
+	),
+	"remote.agent": (
+		"",
+		"Command that starts 'huge serve --stdio' on SSH remotes, e.g \"huge serve --stdio\". When "
+		"set, everything is transferred in a single session with the agent instead of with ssh and "
+		"rsync. Empty means not to use an agent.",
+	),
+	"remote.connect-timeout": (
+		"10s",
+		"How long to wait for SSH remotes to answer when connecting.",
+	),
+	"remote.fetch-timeout": (
+		"10m",
+		"How long fetching from a remote may take before it is skipped.",
+	),
+	"remote.retries": (
+		"3",
+		"How many times a failed transfer of files to or from a remote is tried again.",
+	),
+	"remote.retry-delay": (
+		"1s",
+		"How long to wait before trying a failed transfer again. Doubled for each retry.",
+	),
+	"remote.streams": (
+		"4",
+		"How many batches of files to transfer at the same time with each remote. Remotes with an "
+		"agent always use one.",
+	),
+	"remote.batch-files": (
+		"1000",
+		"Largest number of files in each batch transferred.",
+	),
+	"remote.batch-size": (
+		"1G",
+		"Largest total size of the files in each batch transferred. Larger files get a batch of "
+		"their own.",
+	),
+	"remote.pack-size": (
+		"1M",
+		"Batches of files smaller than this on average are sent to and from SSH remotes without an "
+		"agent as a single tar stream instead of with rsync. 0 means to always use rsync.",
+	),
+	"remote.range-size": (
+		"256M",
+		"Files larger than this are split into ranges of this size, and \"remote.streams\" ranges "
+		"transferred at the same time. Remotes with an agent always send whole files. 0 means to "
+		"always send whole files.",
+	),
+	"remote.delta-size": (
+		"16M",
+		"Changed files larger than this are pushed to SSH remotes as a delta against the version of "
+		"the same path in the parent commit, when the remote has it. 0 means to always send whole "
+		"files.",
+	),
+	"remote.compression": (
+		"auto",
+		"zstd level from 1 to 19 to compress rsync transfers with, or 0 to never compress. auto picks "
+		"a level from the measured bandwidth of each remote, and doesn't compress on fast links, "
+		"content that doesn't compress, or remotes not added yet. rsync before 3.2 compresses at its "
+		"own default level instead.",
+	),
+	"remote.inventory-age": (
+		"10m",
+		"How long pushes to SSH remotes trust the list of files fetched from the remote, instead of "
+		"listing its files again. Files the remote got from elsewhere since are skipped by the "
+		"remote, and files deleted on it since are found by a check after the push and sent then. 0 "
+		"means to always list the files, and forever to always trust the list once fetched.",
+	),
+	"gc.temporary-age": (
+		"1d",
+		"How old temporary files and folders in .huge must be before 'huge gc' deletes them.",
+	),
+}
+
+
+# How the value of each setting is read, raising ValueError for invalid values. Settings that are not
+# here can be any text.
+_PARSERS: dict[str, Callable[[str], object]] = {
+	"storage.quota": lambda x: parse_size(x),
+	"storage.eviction-copies": lambda x: _parse_int(x, 0),
+	"storage.compression": lambda x: _parse_int(x, 0, 19),
+	"storage.compression-ratio": lambda x: _parse_ratio(x),
+	"remote.connect-timeout": lambda x: parse_duration(x),
+	"remote.fetch-timeout": lambda x: parse_duration(x),
+	"remote.retries": lambda x: _parse_int(x, 0),
+	"remote.retry-delay": lambda x: parse_duration(x),
+	"remote.streams": lambda x: _parse_int(x, 1),
+	"remote.batch-files": lambda x: _parse_int(x, 1),
+	"remote.batch-size": lambda x: parse_size(x),
+	"remote.pack-size": lambda x: parse_size(x),
+	"remote.range-size": lambda x: parse_size(x),
+	"remote.delta-size": lambda x: parse_size(x),
+	"remote.compression": lambda x: x == "auto" or _parse_int(x, 0, 19),
+	"remote.inventory-age": lambda x: x == "forever" or parse_duration(x),
+	"gc.temporary-age": lambda x: parse_duration(x),
+}
+
+
+def get_config(key: str) -> str:
+	assert key in SETTINGS, f"Unknown setting {key!r}"
+
+	return _read_config().get(key, SETTINGS[key][0])
+
+
+def get_size_config(key: str) -> int | None:
+	"""
+	Get a setting that is a size in bytes, like "500G". None if empty.
+	"""
+	value = get_config(key)
+
+	return parse_size(value) if value else None
+
+
+def get_duration_config(key: str) -> float:
+	"""
+	Get a setting that is a duration, like "2h", in seconds
+	"""
+	return parse_duration(get_config(key))
+
+
+def get_int_config(key: str) -> int:
+	return int(get_config(key))
+
+
+def set_config(key: str, value: str) -> None:
+	"""
+	Change a setting. An empty value resets it to its default.
+	"""
+	from huge.repo import atomic_write
+	from huge.repo.paths import CONFIG_FILE
+
+	assert key in SETTINGS, f"Unknown setting {key!r}"
+
+	check_config(key, value)
+
+	config = _read_config()
+
+	if value.strip():
+		config[key] = value.strip()
+	else:
+		config.pop(key, None)
+
+	with atomic_write(CONFIG_FILE) as f:
+		f.writelines(f"{k} = {v}\n" for k, v in sorted(config.items()))
+
+
+def check_config(key: str, value: str) -> None:
+	"""
+	Raise ValueError if a value is not valid for a setting. An empty value is always valid.
+	"""
+	if value.strip() and key in _PARSERS:
+		_PARSERS[key](value.strip())
+
+
+def parse_size(text: str) -> int:
+	"""
+	Parse sizes like "1024", "10K", "500M", "2G" and "1.5T"
+
+	Units are powers of 1024.
+	"""
+	units = {"": 0, "B": 0, "K": 1, "M": 2, "G": 3, "T": 4, "P": 5}
+
+	text = text.strip().upper().removesuffix("IB").removesuffix("B")
+	number = text.rstrip("KMGTP")
+	unit = text[len(number):]
+
+	if not number or unit not in units:
+		raise ValueError(f"Invalid size: {text!r}")
+
+	return int(float(number) * 1024 ** units[unit])
+
+
+def parse_duration(text: str) -> float:
+	"""
+	Parse durations like "30", "30s", "15m", "2h" and "1d" into seconds
+	"""
+	units = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+	text = text.strip().lower()
+	number = text.rstrip("smhd")
+	unit = text[len(number):]
+
+	if not number or unit not in units:
+		raise ValueError(f"Invalid duration: {text!r}")
+
+	return float(number) * units[unit]
+
+
+def _parse_int(text: str, minimum: int, maximum: int | None = None) -> int:
+	value = int(text)
+
+	if value < minimum or (maximum is not None and value > maximum):
+		raise ValueError(f"Must be from {minimum}" + (f" to {maximum}" if maximum is not None else " and up"))
+
+	return value
+
+
+def _parse_ratio(text: str) -> float:
+	value = float(text)
+
+	if not 0 < value <= 1:
+		raise ValueError("Must be more than 0 and at most 1")
+
+	return value
+
+
+def _read_config() -> dict[str, str]:
+	from huge.repo.paths import CONFIG_FILE
+
+	if not os.path.isfile(CONFIG_FILE):
+		return {}
+
+	result: dict[str, str] = {}
+
+	with open(CONFIG_FILE) as f:
+		for x in f:
+			if x.split("#", maxsplit=1)[0].strip():
+				key, value = x.split("=", maxsplit=1)
+				result[key.strip()] = value.strip()
+
+	return result
+
+
+def test_parse_size() -> None:
+	assert parse_size("1024") == 1024
+	assert parse_size("10K") == 10240
+	assert parse_size("2g") == 2 * 1024**3
+	assert parse_size("1.5TB") == int(1.5 * 1024**4)
+	assert parse_size("3GiB") == 3 * 1024**3
+
+
+def test_check_config() -> None:
+	for key, value in [
+		("storage.quota", "banana"),
+		("storage.compression", "20"),
+		("storage.compression-ratio", "2"),
+		("remote.streams", "0"),
+		("remote.compression", "fast"),
+		("remote.inventory-age", "soon"),
+	]:
+		try:
+			check_config(key, value)
+			assert False, key
+		except ValueError:
+			pass
+
+	# Every default is valid
+	for key, (default, _) in SETTINGS.items():
+		check_config(key, default)
+
+	check_config("storage.quota", "")
+	check_config("remote.compression", "auto")
+	check_config("remote.agent", "anything")
+
+
+def test_parse_duration() -> None:
+	assert parse_duration("30") == 30
+	assert parse_duration("15m") == 900
+	assert parse_duration("2h") == 7200
+	assert parse_duration("0.5d") == 43200
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
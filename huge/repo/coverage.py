@@ -2,6 +2,12 @@
 Calculation of coverage of files
 """
 from dataclasses import dataclass
+from typing import Iterable
+from huge.repo.storage import StorageChanges
+from huge.testing import huge_test
+
+# {"/absolute/path/to/coverage": (mtime, {"hash sum", ...})}
+_cache: dict[str, tuple[int, set[str]]] = {}
 
 
 @dataclass
@@ -87,8 +93,9 @@ def analyze_repository_coverages(commit_hash: str) -> CoverageAnalysis:
 	"""
 	import os
 	from huge import error
-	from huge.repo.paths import FILES_DIRECTORY, REMOTES_FOLDER
+	from huge.repo.paths import REMOTES_FOLDER
 	from huge.repo.commit import get_commit_files, ensure_commit_exists
+	from huge.repo.storage import get_stored_files
 
 	ensure_commit_exists(commit_hash)
 
@@ -101,8 +108,10 @@ def analyze_repository_coverages(commit_hash: str) -> CoverageAnalysis:
 		with open(os.path.join(REMOTES_FOLDER, remote, "address")) as f:
 			address = f.read().strip()
 
+		remote_files = get_remote_coverage(remote)
+
 		# Check if we have coverage information
-		if not os.path.isfile(os.path.join(REMOTES_FOLDER, remote, "coverage")):
+		if remote_files is None:
 			repositories.append(
 				RepositoryCoverage(
 					available=False,
@@ -115,8 +124,7 @@ def analyze_repository_coverages(commit_hash: str) -> CoverageAnalysis:
 
 		# TODO merayen also read when the coverage file was last updated to inform the user
 
-		with open(os.path.join(REMOTES_FOLDER, remote, "coverage")) as f:
-			files_available: set[str] = {x.strip() for x in f if x.strip()} & commit_files
+		files_available: set[str] = remote_files & commit_files
 
 		files_unavailable = commit_files - files_available
 
@@ -130,7 +138,7 @@ def analyze_repository_coverages(commit_hash: str) -> CoverageAnalysis:
 		)
 
 	# Add ourselves to the resultset
-	files_available = set(os.listdir(FILES_DIRECTORY)) & commit_files
+	files_available = get_stored_files().keys() & commit_files
 
 	repositories.append(
 		RepositoryCoverage(
@@ -146,6 +154,168 @@ def analyze_repository_coverages(commit_hash: str) -> CoverageAnalysis:
 	)
 
 
+def get_remote_coverage(remote_hash: str) -> set[str] | None:
+	"""
+	Get the files a remote had when we last fetched from it
+
+	Returns None if we have never fetched from the remote. The returned set is shared for the whole
+	command and must not be modified by the caller.
+	"""
+	import os
+	from huge.repo.paths import REMOTES_FOLDER
+
+	path = os.path.abspath(os.path.join(REMOTES_FOLDER, remote_hash, "coverage"))
+
+	if not os.path.isfile(path):
+		return None
+
+	mtime = os.stat(path).st_mtime_ns
+
+	if path not in _cache or _cache[path][0] != mtime:
+		with open(path) as f:
+			_cache[path] = (mtime, {x.strip() for x in f if x.strip()})
+
+	return _cache[path][1]
+
+
+def write_remote_coverage(remote_hash: str, file_hashes: Iterable[str]) -> None:
+	"""
+	Replace the coverage of a remote with a complete list of its files, and note when it was listed
+	"""
+	import os
+	from huge.repo import atomic_write
+	from huge.repo.paths import REMOTES_FOLDER
+
+	with atomic_write(os.path.join(REMOTES_FOLDER, remote_hash, "coverage")) as f:
+		f.writelines(f"{file_hash}\n" for file_hash in file_hashes)
+
+	_mark_listed(remote_hash)
+
+
+def store_remote_changes(remote_hash: str, changes: StorageChanges) -> None:
+	"""
+	Bring the coverage of a remote up to date with what was stored and deleted on it, and remember
+	how far into its storage log we have read, see huge.repo.storage.get_storage_changes
+	"""
+	import os
+	from huge.repo import atomic_write
+	from huge.repo.paths import REMOTES_FOLDER
+
+	coverage_file = os.path.join(REMOTES_FOLDER, remote_hash, "coverage")
+
+	if changes.files is not None:
+		write_remote_coverage(remote_hash, changes.files)
+
+	elif changes.removed:
+		write_remote_coverage(remote_hash, (get_remote_coverage(remote_hash) or set()) - changes.removed | changes.added)
+
+	else:
+		# Appended without reading the coverage, like when pushing
+		if changes.added:
+			with open(coverage_file, "a") as f:
+				f.writelines(f"{file_hash}\n" for file_hash in changes.added)
+
+		_mark_listed(remote_hash)
+
+	with atomic_write(os.path.join(REMOTES_FOLDER, remote_hash, "position")) as f:
+		f.write(f"{changes.epoch}\t{changes.sequence}\n")
+
+
+def get_remote_position(remote_hash: str) -> tuple[str, int]:
+	"""
+	Get how far into the storage log of a remote we have read, as (epoch, sequence number)
+
+	The epoch is empty if we have not, or have lost the coverage of the remote.
+	"""
+	import os
+	from huge.repo.paths import REMOTES_FOLDER
+
+	path = os.path.join(REMOTES_FOLDER, remote_hash, "position")
+
+	if not os.path.isfile(path) or not os.path.isfile(os.path.join(REMOTES_FOLDER, remote_hash, "coverage")):
+		return "", 0
+
+	with open(path) as f:
+		epoch, sequence = f.read().split()
+
+	return epoch, int(sequence)
+
+
+def get_cached_remote_files(remote_hash: str) -> set[str] | None:
+	"""
+	Get the files of a remote from its coverage, if it was listed recently enough to be trusted
+
+	Returns None if the remote should be listed instead, see "remote.inventory-age". Files pushed
+	since the listing are in the coverage too, but files deleted on the remote since are not noticed
+	here, see huge.repo.push.
+	"""
+	if not _is_listed_recently(remote_hash):
+		return None
+
+	return get_remote_coverage(remote_hash)
+
+
+def get_recently_listed_remotes() -> set[str]:
+	"""
+	Get the remotes whose files were listed recently enough to be trusted, see "remote.inventory-age"
+	"""
+	import os
+	from huge.repo.paths import REMOTES_FOLDER
+
+	return {x for x in os.listdir(REMOTES_FOLDER) if _is_listed_recently(x)}
+
+
+def get_remote_copies(file_hashes: set[str], remotes: set[str] | None = None) -> dict[str, int]:
+	"""
+	Count how many remotes has each file, according to the last fetch
+
+	Only the remotes given are counted, or all of them if None.
+
+	Returns: {"hash sum": 2}
+	"""
+	import os
+	from huge.repo.paths import REMOTES_FOLDER
+
+	result = {x: 0 for x in file_hashes}
+
+	for remote in os.listdir(REMOTES_FOLDER) if remotes is None else remotes:
+		for file_hash in (get_remote_coverage(remote) or set()) & file_hashes:
+			result[file_hash] += 1
+
+	return result
+
+
+def forget_remote_coverages() -> None:
+	_cache.clear()
+
+
+def _is_listed_recently(remote_hash: str) -> bool:
+	import os
+	import time
+	from huge.repo.config import get_config, get_duration_config
+	from huge.repo.paths import REMOTES_FOLDER
+
+	path = os.path.join(REMOTES_FOLDER, remote_hash, "listed")
+
+	if not os.path.isfile(path):
+		return False
+
+	with open(path) as f:
+		listed = float(f.read())
+
+	return get_config("remote.inventory-age") == "forever" or time.time() - listed < get_duration_config("remote.inventory-age")
+
+
+def _mark_listed(remote_hash: str) -> None:
+	import os
+	import time
+	from huge.repo import atomic_write
+	from huge.repo.paths import REMOTES_FOLDER
+
+	with atomic_write(os.path.join(REMOTES_FOLDER, remote_hash, "listed")) as f:
+		f.write(f"{time.time()}\n")
+
+
 def test_coverage_calculation_less_than_1():
 	coverage_analysis = CoverageAnalysis(
 		repositories=[
@@ -212,6 +382,39 @@ def test_coverage_calculation_double_coverage():
 	assert coverage_analysis.coverage == 2.25
 
 
+@huge_test
+def test_get_cached_remote_files() -> None:
+	import os
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.paths import REMOTES_FOLDER
+	from huge.repo.remote import add_remote, get_remotes
+
+	create_repository()
+	add_remote("remote")
+
+	remote_hash = next(get_remotes()).remote_hash
+
+	assert get_cached_remote_files(remote_hash) is None
+
+	write_remote_coverage(remote_hash, {"a" * 32})
+	assert get_cached_remote_files(remote_hash) == {"a" * 32}
+
+	set_config("remote.inventory-age", "0")
+	assert get_cached_remote_files(remote_hash) is None
+
+	# A listing from long ago is only trusted when told to
+	with open(os.path.join(REMOTES_FOLDER, remote_hash, "listed"), "w") as f:
+		f.write("0\n")
+
+	set_config("remote.inventory-age", "1h")
+	assert get_cached_remote_files(remote_hash) is None
+
+	set_config("remote.inventory-age", "forever")
+
+	assert get_cached_remote_files(remote_hash) == {"a" * 32}
+
+
 if __name__ == '__main__':
 	for x in dir():
 		if x.startswith("test_"):
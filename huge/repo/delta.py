@@ -0,0 +1,393 @@
+"""
+Sending a changed file as a delta against its previous version
+
+When a large file changes a little, the remote usually has the version of the same path in the
+parent commit already, the base. Instead of the whole new file, only a delta is sent: which ranges of
+the base to copy, and the bytes that are new.
+
+The delta is found the way rsync does it. The base is split into blocks, and each block gets a weak
+checksum (adler32) and a strong one (md5). The new file is then searched for the blocks: the weak
+checksum of the window at every offset is checked against the ones of the base, rolling it one byte
+at a time where nothing matches, and the md5 is only calculated when the weak checksum matches. Where
+the file is unchanged, whole blocks match one after the other, so the search mostly runs at the
+speed of zlib and hashlib.
+
+The remote rebuilds the file from its base and the delta into its staging area, and only stores it
+if the content matches its hash sum, see huge.repo.staging.
+
+Agents rebuild the file themselves, see the "put_delta" operation in huge.repo.serve. SSH remotes
+without an agent get a copy of the base in their staging area instead, which rsync then uses as the
+basis of its own delta.
+"""
+import hashlib
+import os
+import shlex
+import subprocess
+import zlib
+from typing import BinaryIO, Callable, Iterable, Iterator
+from huge.repo.address import SSHAddress
+from huge.testing import huge_test
+
+MIN_BLOCK_SIZE = 2**11
+MAX_BLOCK_SIZE = 2**17
+
+# How much of the new file is read at a time
+READ_SIZE = 2**23
+
+# Either the (offset, length) of a range of the base to copy, or new bytes
+DeltaOp = tuple[int, int] | bytes
+
+# Run on the server with stdin lines of "hash sum<TAB>hash sum of base". Copies the base of each file
+# into the staging area as the file, unless something is staged for it already, and prints the files
+# that have something staged.
+_SEED_SCRIPT = """
+cd {path} || exit 1
+mkdir -p {staging}
+while read file base; do
+	[ -e {staging}/"$file" ] || {{
+		[ -f {storage}/"$base" ] &&
+		cp --reflink=auto {storage}/"$base" {staging}/"$file".seed &&
+		mv {staging}/"$file".seed {staging}/"$file"
+	}} && echo "$file"
+done
+true
+"""
+
+
+def get_delta_bases(commits: list[str]) -> dict[str, str]:
+	"""
+	Pick the base of each changed file in the commits: the version of the same path in a parent
+
+	Only files stored here, not compressed, and larger than "remote.delta-size" are given a base.
+
+	Returns: {"hash sum": "hash sum of base"}
+	"""
+	from huge.repo.commit import get_commit_files
+	from huge.repo.config import get_size_config
+	from huge.repo.encoding import is_compressed
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.storage import get_stored_files
+
+	delta_size = get_size_config("remote.delta-size") or 0
+
+	if not delta_size:
+		return {}
+
+	graph = get_commit_graph()
+	stored_files = get_stored_files()
+
+	result: dict[str, str] = {}
+
+	for commit in commits:
+		files = get_commit_files(commit)
+
+		for parent in graph.parents.get(commit, ()):
+			for path, base in get_commit_files(parent).items():
+				file_hash = files.get(path)
+
+				if file_hash and file_hash != base and file_hash not in result and stored_files.get(file_hash, 0) > delta_size:
+					# A small change moves everything after it in compressed content, see huge.repo.encoding
+					if not is_compressed(os.path.join(FILES_DIRECTORY, file_hash), file_hash):
+						result[file_hash] = base
+
+	return result
+
+
+def get_block_size(size: int) -> int:
+	"""
+	Size of the blocks to split a base of this size into, about the square root of it like rsync
+	"""
+	import math
+
+	return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, math.isqrt(size) // 1024 * 1024))
+
+
+def make_signature(path: str, block_size: int) -> dict[int, dict[bytes, int]]:
+	"""
+	Get the checksums of each whole block of a file
+
+	Returns: {adler32: {md5 digest: index of the block}}
+	"""
+	signature: dict[int, dict[bytes, int]] = {}
+
+	with open(path, "rb") as f:
+		index = 0
+
+		while len(data := f.read(block_size)) == block_size:
+			signature.setdefault(zlib.adler32(data), {}).setdefault(hashlib.md5(data).digest(), index)
+			index += 1
+
+	return signature
+
+
+def make_delta(base_path: str, path: str) -> Iterator[DeltaOp]:
+	"""
+	Find what of a file can be copied from a base, and what must be sent
+	"""
+	from huge.repo.agent import CHUNK_SIZE
+
+	block_size = get_block_size(os.path.getsize(base_path))
+	signature = make_signature(base_path, block_size)
+
+	# Only one of these is pending at a time, so the ops come out in the order of the file
+	literal = bytearray()
+	copy_offset = copy_length = 0
+
+	with open(path, "rb") as f:
+		buffer = f.read(READ_SIZE)
+		position = 0
+		weak: int | None = None
+
+		while True:
+			if len(buffer) - position < block_size:
+				if not (more := f.read(READ_SIZE)):
+					break
+
+				buffer = buffer[position:] + more
+				position = 0
+				continue
+
+			window = buffer[position:position + block_size]
+
+			if weak is None:
+				weak = zlib.adler32(window)
+
+			index = signature[weak].get(hashlib.md5(window).digest()) if weak in signature else None
+
+			if index is not None:
+				if literal:
+					yield bytes(literal)
+					literal.clear()
+
+				if copy_length and copy_offset + copy_length == index * block_size:
+					copy_length += block_size
+				else:
+					if copy_length:
+						yield copy_offset, copy_length
+
+					copy_offset, copy_length = index * block_size, block_size
+
+				position += block_size
+				weak = None
+				continue
+
+			if copy_length:
+				yield copy_offset, copy_length
+				copy_length = 0
+
+			literal.append(buffer[position])
+
+			if position + block_size < len(buffer):
+				weak = _roll(weak, buffer[position], buffer[position + block_size], block_size)
+			else:
+				weak = None
+
+			position += 1
+
+			if len(literal) >= CHUNK_SIZE:
+				yield bytes(literal)
+				literal.clear()
+
+	literal += buffer[position:]
+
+	if copy_length:
+		yield copy_offset, copy_length
+
+	if literal:
+		yield bytes(literal)
+
+
+def apply_delta(base_path: str, ops: Iterable[DeltaOp]) -> Iterator[bytes]:
+	"""
+	Rebuild the content of a file from a base and a delta
+
+	All the ops are read, even if the base turns out to be too short, which gives content that will
+	not match its hash sum.
+	"""
+	from huge.repo.agent import CHUNK_SIZE
+
+	with open(base_path, "rb") as f:
+		for op in ops:
+			if isinstance(op, bytes):
+				yield op
+				continue
+
+			offset, length = op
+			f.seek(offset)
+
+			while length and (data := f.read(min(CHUNK_SIZE, length))):
+				yield data
+				length -= len(data)
+
+
+def write_delta(stream: BinaryIO, ops: Iterable[DeltaOp]) -> None:
+	"""
+	Send a delta as a stream of frames: "C" and the offset and length to copy, or "D" and new bytes
+	"""
+	import struct
+	from huge.repo.agent import write_frame
+
+	for op in ops:
+		write_frame(stream, b"D" + op if isinstance(op, bytes) else b"C" + struct.pack(">QQ", *op))
+
+	write_frame(stream, b"")
+
+
+def read_delta(stream: BinaryIO) -> Iterator[DeltaOp]:
+	import struct
+	from huge.repo.agent import AgentError, read_stream
+
+	for frame in read_stream(stream):
+		if frame[:1] == b"D":
+			yield frame[1:]
+		elif frame[:1] == b"C" and len(frame) == 17:
+			yield struct.unpack(">QQ", frame[1:])
+		else:
+			raise AgentError("Invalid delta")
+
+
+def seed_bases(address: SSHAddress, bases: dict[str, str]) -> set[str]:
+	"""
+	Copy the base of each file into the staging area of a remote, for rsync to use as its basis
+
+	Returns the files that have a basis on the remote, either their base or what an earlier transfer
+	left behind.
+	"""
+	from huge.repo.ssh import ssh_shell_command
+
+	return _seed_bases(lambda x: ssh_shell_command(address, x), address.path, bases)
+
+
+def _seed_bases(command: Callable[[str], list[str]], repository_path: str, bases: dict[str, str]) -> set[str]:
+	from huge.repo.journal import TransferInterrupted
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+
+	if not bases:
+		return set()
+
+	process = subprocess.run(
+		command(_SEED_SCRIPT.format(path=shlex.quote(repository_path), staging=STAGING_FOLDER, storage=FILES_DIRECTORY)),
+		input="".join(f"{x}\t{y}\n" for x, y in sorted(bases.items())).encode(),
+		stdout=subprocess.PIPE,
+	)
+
+	if process.returncode:
+		raise TransferInterrupted("Could not copy the bases on the remote")
+
+	return set(process.stdout.decode().split()) & bases.keys()
+
+
+def _roll(weak: int, out: int, incoming: int, block_size: int) -> int:
+	"""
+	Move the adler32 of a window one byte forward
+	"""
+	a = weak & 0xffff
+	b = weak >> 16
+
+	a = (a - out + incoming) % 65521
+	b = (b - block_size * out + a - 1) % 65521
+
+	return b << 16 | a
+
+
+def test_delta() -> None:
+	import io
+	import random
+	import tempfile
+	from unittest.mock import patch
+
+	data = random.Random(1).randbytes(20000)
+	assert _roll(zlib.adler32(data[:100]), data[0], data[100], 100) == zlib.adler32(data[1:101])
+
+	# Bytes inserted, changed and removed
+	changed = data[:3000] + b"inserted" + data[3000:9000] + b"X" + data[9001:15000] + data[16000:]
+
+	with tempfile.TemporaryDirectory() as d, patch(f"{__name__}.READ_SIZE", 5000):
+		with open(os.path.join(d, "base"), "wb") as f:
+			f.write(data)
+
+		with open(os.path.join(d, "new"), "wb") as f:
+			f.write(changed)
+
+		ops = list(make_delta(os.path.join(d, "base"), os.path.join(d, "new")))
+
+		assert b"".join(apply_delta(os.path.join(d, "base"), ops)) == changed
+
+		# Only a little more than the changes are sent
+		assert sum(len(x) for x in ops if isinstance(x, bytes)) < 4 * MIN_BLOCK_SIZE
+
+		stream = io.BytesIO()
+		write_delta(stream, ops)
+		stream.seek(0)
+		assert list(read_delta(stream)) == ops
+
+
+@huge_test
+def test_put_delta() -> None:
+	import random
+	import shutil
+	from huge.repo import create_repository
+	from huge.repo.agent import connect_local
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, REPO_ID_FILE, STAGING_FOLDER
+	from huge.repo.stage import mark_as_staged
+	from huge.testing import cd
+
+	create_repository()
+	set_config("remote.delta-size", "1K")
+
+	data = random.Random(1).randbytes(20000)
+	commits = []
+
+	# Both files change, but only the large one gets a base
+	for content in [data, data[:5000] + b"changed" + data[5000:]]:
+		with open("a", "wb") as f:
+			f.write(content)
+
+		with open("small", "w") as f:
+			f.write(str(len(content)))
+
+		mark_as_staged(["a", "small"])
+		create_commit(None)
+		commits.append(get_current_commit())
+
+	base = get_commit_files(commits[0])["a"]
+	file_hash = get_commit_files(commits[1])["a"]
+
+	assert get_delta_bases([commits[1]]) == {file_hash: base}
+
+	os.mkdir("remote")
+
+	with cd("remote"):
+		create_repository()
+
+	shutil.copy(REPO_ID_FILE, os.path.join("remote", REPO_ID_FILE))
+
+	with connect_local("remote") as agent:
+		# Without the base nothing is stored
+		assert not agent.put_delta(file_hash, base)
+		assert agent.have({file_hash}) == set()
+
+		assert agent.put_files({base}) == {base}
+		assert agent.put_delta(file_hash, base)
+		assert agent.have({file_hash}) == {file_hash}
+
+	with open(os.path.join("remote", FILES_DIRECTORY, file_hash), "rb") as f:
+		assert f.read() == data[:5000] + b"changed" + data[5000:]
+
+	# The remote copies the base into its staging area for rsync
+	def command(script: str) -> list[str]:
+		return ["sh", "-c", script]
+
+	assert _seed_bases(command, os.path.abspath("remote"), {"f" * 32: base, "e" * 32: "d" * 32}) == {"f" * 32}
+
+	with open(os.path.join("remote", FILES_DIRECTORY, base), "rb") as f, open(os.path.join("remote", STAGING_FOLDER, "f" * 32), "rb") as g:
+		assert f.read() == g.read()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -1,16 +1,78 @@
 """
 Dropping commit data from local repository
 """
+from dataclasses import dataclass
 from huge.repo.commit import CommitInfo
 
 
-def drop_commit_files(commit_hashes: list[str]) -> None:
+@dataclass
+class DropPlan:
+	# Files that will be deleted: {"hash sum": size}
+	files: dict[str, int]
+
+	# Files that are kept as there are too few copies of them on the remotes: {"hash sum": size}
+	kept_files: dict[str, int]
+
+
+def plan_drop(commit_hashes: list[str], required_copies: int | None, remotes: set[str] | None = None) -> DropPlan:
+	"""
+	Figure out which local files to delete to drop the commits
+
+	Files used by other commits are never deleted. If required_copies is given, only files that
+	at least that many remotes has, according to the last fetch, are deleted. Only the remotes given
+	are counted, e.g the ones that could be reached just now, or all of them if None.
+	"""
+	from huge.repo.coverage import get_remote_copies
+	from huge.repo.storage import get_stored_files
+
+	stored_files = get_stored_files()
+
+	files = {
+		file_hash: stored_files[file_hash]
+		for file_hash in get_removable_files(commit_hashes)
+		if file_hash in stored_files
+	}
+
+	kept_files: dict[str, int] = {}
+
+	if required_copies:
+		for file_hash, copies in get_remote_copies(set(files), remotes).items():
+			if copies < required_copies:
+				kept_files[file_hash] = files.pop(file_hash)
+
+	return DropPlan(files=files, kept_files=kept_files)
+
+
+def drop_commit_files(file_hashes: set[str], batch_size: int = 1000, workers: int = 8) -> None:
 	"""
 	Delete local files that the commits represents
 
-	This is mainly meant for saving space or get rid of unwanted data.
+	This is mainly meant for saving space or get rid of unwanted data. Use plan_drop() to figure out
+	which files are safe to delete. Files are deleted in batches by several threads, as deleting
+	many files is mostly waiting for the file system.
 	"""
-	raise NotImplementedError("drop commit files")  # TODO merayen drop commit files
+	from concurrent.futures import ThreadPoolExecutor
+	from huge.repo.storage import remove_stored_files
+
+	file_list = list(file_hashes)
+	batches = [file_list[i:i + batch_size] for i in range(0, len(file_list), batch_size)]
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		# Consume the results to have any exceptions raised here
+		list(executor.map(_delete_files, batches))
+
+	remove_stored_files(file_hashes)
+
+
+def _delete_files(file_hashes: list[str]) -> None:
+	import os
+	from huge.repo.paths import FILES_DIRECTORY
+
+	for file_hash in file_hashes:
+		try:
+			os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+		except FileNotFoundError:
+			pass  # Already gone, which is what we want
 
 
 def get_removable_commits(
@@ -35,38 +97,17 @@ def get_removable_commits(
 	return result
 
 
-def get_removable_files(
-		commit_hashes: list[str],
-		commit_infos: list[CommitInfo],
-	) -> list[CommitInfo]:
+def get_removable_files(commit_hashes: list[str]) -> set[str]:
 	"""
 	Calculates which files can be deleted without causing dataloss for other commits
 
 	This requires a newly "huge fetch" from all repositories to not risk
 	calculation on outdated data.
 	"""
-	from huge.repo.commit import get_commit_infos
+	from huge.repo.references import get_exclusive_files
 
 	assert isinstance(commit_hashes, list)
 	assert all(isinstance(commit_hash, str) for commit_hash in commit_hashes)
 
-	assert isinstance(commit_infos, list)
-	assert all(isinstance(commit_info, CommitInfo) for commit_info in commit_infos)
-
-	# Get the files we want to try to delete
-	to_drop: set[str] = {
-		file_hash
-		for commit_info in commit_infos
-		if commit_info.commit_hash in commit_hashes
-		for file_hash, path in commit_info.files
-	}
-
-	# Remove files that are pointed at by commits not in commit_hashes
-	to_drop -= {
-		file_hash
-		for commit_info in commit_infos
-		if commit_info.commit_hash not in commit_hashes
-		for file_hash, path in commit_info.files
-	}
-
-	return to_drop
+	# Files that are pointed at by commits not in commit_hashes are kept
+	return get_exclusive_files(set(commit_hashes))
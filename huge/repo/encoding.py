@@ -0,0 +1,236 @@
+"""
+Storing files compressed
+
+When "storage.compression" is set, files are compressed with zstd in long range mode as they are
+committed, and kept compressed when that makes them small enough to be worth it. The file in
+FILES_DIRECTORY is still named by the hash sum of its content, so nothing else needs to know:
+transfers send the stored bytes as they are, and the receiver stores them without compressing
+again. Only checking the content against the name, and checking the file out, decompresses it, as a
+stream through the zstd command.
+
+A compressed file starts with a zstd skippable frame holding "huge" and the hash sum of the content,
+followed by the zstd frames. zstd ignores the first frame, and a file that is not compressed by us
+can not start with it unless it contains its own hash sum.
+"""
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
+from huge.testing import huge_test
+
+# Window of the long range matching, as a power of 2. zstd decompresses up to 2**27 without being
+# told.
+LONG_WINDOW = 27
+
+
+def is_compressed(path: str, file_hash: str) -> bool:
+	header = _header(file_hash)
+
+	with open(path, "rb") as f:
+		return f.read(len(header)) == header
+
+
+def compress_file(path: str, file_hash: str) -> bool:
+	"""
+	Compress a file in FILES_DIRECTORY, if "storage.compression" is set and it is worth it
+
+	Returns whether the file was compressed. Without the zstd command the file is kept as it is.
+	"""
+	from huge.repo.compression import is_compressible
+	from huge.repo.config import get_config, get_int_config
+	from huge.repo.paths import STAGING_FOLDER
+
+	if not (level := get_int_config("storage.compression")):
+		return False
+
+	ratio = float(get_config("storage.compression-ratio"))
+
+	# Sampled first, so that zstd is not run over content that is compressed already
+	if not is_compressible([path]) or is_compressed(path, file_hash):
+		return False
+
+	# Not next to the file, where it would be taken for a stored file
+	os.makedirs(STAGING_FOLDER, exist_ok=True)
+	temporary_path = os.path.join(STAGING_FOLDER, f"{file_hash}.zst")
+
+	with open(temporary_path, "wb") as f:
+		f.write(_header(file_hash))
+		f.flush()
+
+		try:
+			process = subprocess.run(
+				["zstd", "-q", f"-{level}", f"--long={LONG_WINDOW}", "-T0", "-c", path],
+				stdout=f,
+			)
+		except FileNotFoundError:
+			process = None
+
+	if process is None or process.returncode or os.path.getsize(temporary_path) >= os.path.getsize(path) * ratio:
+		os.remove(temporary_path)
+		return False
+
+	os.replace(temporary_path, path)
+
+	return True
+
+
+@contextmanager
+def open_stored(path: str, file_hash: str) -> Iterator[BinaryIO]:
+	"""
+	Read the content of a stored file, decompressing it if needed
+	"""
+	from huge import fail
+
+	if not is_compressed(path, file_hash):
+		with open(path, "rb") as f:
+			yield f
+
+		return
+
+	try:
+		process = subprocess.Popen(
+			["zstd", "-d", "-q", f"--long={LONG_WINDOW}", "-c", path],
+			stdout=subprocess.PIPE,
+		)
+	except FileNotFoundError:
+		fail(f"zstd is needed to read {path}, which is stored compressed")
+		raise
+
+	try:
+		yield process.stdout
+	finally:
+		process.stdout.close()
+
+		if process.wait() not in (0, -13):  # Not read to the end is fine
+			raise OSError(f"Could not decompress {path}")
+
+
+def copy_stored(path: str, file_hash: str, destination: str) -> None:
+	"""
+	Copy the content of a stored file, e.g to the workspace
+	"""
+	from huge import fail
+
+	if not is_compressed(path, file_hash):
+		shutil.copyfile(path, destination)
+		return
+
+	try:
+		process = subprocess.run(["zstd", "-d", "-q", "-f", f"--long={LONG_WINDOW}", "-o", destination, path])
+	except FileNotFoundError:
+		fail(f"zstd is needed to check out {destination}, which is stored compressed")
+		return
+
+	if process.returncode:
+		raise OSError(f"Could not decompress {path}")
+
+
+def hash_stored(path: str, file_hash: str) -> str:
+	"""
+	Get the hash sum of the content of a stored file
+	"""
+	md5sum = hashlib.md5()
+
+	with open_stored(path, file_hash) as f:
+		while data := f.read(2**20):
+			md5sum.update(data)
+
+	return md5sum.hexdigest().lower()
+
+
+def check_content(path: str, file_hash: str, md5: str) -> bool:
+	"""
+	Whether a file received has the content of file_hash, given the md5 of the bytes received
+	"""
+	return md5.lower() == file_hash or (is_compressed(path, file_hash) and hash_stored(path, file_hash) == file_hash)
+
+
+def _header(file_hash: str) -> bytes:
+	payload = b"huge" + file_hash.encode()
+
+	return struct.pack("<II", 0x184D2A5E, len(payload)) + payload
+
+
+@huge_test
+def test_compress_file() -> None:
+	import random
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.commit import checkout_files, create_commit, get_commit_files, get_current_commit
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+	from huge.repo.stage import mark_as_staged
+	from huge.repo.storage import get_stored_files
+	from huge.testing import catch_fail
+
+	create_repository()
+	set_config("storage.compression", "3")
+
+	content = "".join(f"{x},{x * x}\n" for x in range(100000))
+	noise = random.Random(1).randbytes(2**18)
+
+	with open("data.csv", "w") as f:
+		f.write(content)
+
+	with open("noise", "wb") as f:
+		f.write(noise)
+
+	mark_as_staged(["data.csv", "noise"])
+	create_commit(None)
+
+	commit_files = get_commit_files(get_current_commit())
+	path = os.path.join(FILES_DIRECTORY, commit_files["data.csv"])
+
+	# Only the file that compresses well is stored compressed, and the index has its stored size
+	assert is_compressed(path, commit_files["data.csv"])
+	assert not is_compressed(os.path.join(FILES_DIRECTORY, commit_files["noise"]), commit_files["noise"])
+	assert get_stored_files()[commit_files["data.csv"]] == os.path.getsize(path) < len(content) / 2
+
+	assert hash_stored(path, commit_files["data.csv"]) == commit_files["data.csv"]
+	assert check_content(path, commit_files["data.csv"], "0" * 32)
+	assert not check_content(path, "f" * 32, "0" * 32)
+
+	os.remove("data.csv")
+	checkout_files(get_current_commit(), ["data.csv"])
+
+	with open("data.csv") as f:
+		assert f.read() == content
+
+	# Without zstd the file is stored as it is
+	with open("more.csv", "w") as f:
+		f.write(content + "more\n")
+
+	with patch("subprocess.run", side_effect=FileNotFoundError("zstd")):
+		mark_as_staged(["more.csv"])
+		create_commit(None)
+
+	more_hash = get_commit_files(get_current_commit())["more.csv"]
+
+	assert not is_compressed(os.path.join(FILES_DIRECTORY, more_hash), more_hash)
+	assert os.listdir(STAGING_FOLDER) == []
+
+	# Compressed files can not be checked out without zstd
+	os.remove("data.csv")
+
+	with patch("subprocess.run", side_effect=FileNotFoundError("zstd")), catch_fail() as failed:
+		checkout_files(get_current_commit(), ["data.csv"])
+
+	assert failed.getvalue() == "zstd is needed to check out data.csv, which is stored compressed\n"
+
+	with patch("subprocess.Popen", side_effect=FileNotFoundError("zstd")), catch_fail() as failed:
+		try:
+			hash_stored(path, commit_files["data.csv"])
+			assert False
+		except FileNotFoundError:
+			pass  # Only reached when fail() does not exit
+
+	assert "zstd is needed to read" in failed.getvalue()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -1,94 +1,288 @@
 """
 Fecthing metadata to and from remote repositories
 """
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, TypeVar
 from huge.repo.address import PathAddress, SSHAddress
+from huge.repo.agent import Agent
+from huge.repo.remote import RemoteInfo
+from huge.repo.storage import StorageChanges
+from huge.testing import huge_test
+
+# Run on the server with the path of the repository. Prints the epoch and size of its storage log,
+# followed by the entries of the log from offset if it is still in the same epoch and its storage
+# index is up to date, or else by a listing of all the stored files. See huge.repo.storage. The
+# nanosecond mtime of the storage needs GNU stat, other servers always get their files listed.
+_CHANGES_SCRIPT = """
+cd {path}/.huge || exit 1
+e=$(head -c 32 storage_log 2>/dev/null)
+s=$(stat -c %s storage_log 2>/dev/null || echo 0)
+echo "$e $s"
+if [ -n "$e" ] && [ "$e" = {epoch} ] && [ "$s" -ge {offset} ] && [ -f storage_index ] &&
+	[ "$(stat -c %.9Y storage 2>/dev/null | tr -d .)" = "$(head -n 1 storage_index 2>/dev/null)" ]; then
+	echo changes
+	tail -c +{start} storage_log | head -c $((s - {offset}))
+else
+	echo files
+	ls storage
+fi
+"""
+
+T = TypeVar("T")
+
+
+@dataclass
+class FetchSummary:
+	commits_received: int = 0
+	commits_sent: int = 0
+
+	# Size of the commits and file lists transferred
+	bytes_transferred: int = 0
 
 
 def fetch_repositories() -> None:
-	import os
-	import shutil
+	"""
+	Synchronize commits with all the remotes at the same time, and refresh their coverage
+
+	Each remote has "remote.fetch-timeout" to finish. Remotes that fail or time out are skipped.
+	"""
+	import subprocess
+	import time
 	from huge import error, output
+	from huge.repo import format_size
 	from huge.repo.address import parse_address
-	from huge.repo.paths import COMMITS_DIRECTORY, REMOTES_FOLDER, REPO_ID_FILE
+	from huge.repo.agent import AgentError
+	from huge.repo.config import get_duration_config
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.history import update_path_history
+	from huge.repo.references import update_references
 	from huge.repo.remote import get_remotes
 
-	local_commits = set(os.listdir(COMMITS_DIRECTORY))
+	remotes = list(get_remotes())
 
-	for remote in get_remotes():
-		# TODO merayen verify that we verify the remote repository id, and that it is equal
+	started = time.monotonic()
+	deadline = started + get_duration_config("remote.fetch-timeout")
 
+	for remote, summary, exception in _run_until(lambda x: _fetch_remote(x, deadline), remotes, deadline):
 		address = parse_address(remote.address)
+		elapsed = time.monotonic() - started
 
-		output(f"Fetching from {address}")
-		if isinstance(address, PathAddress):
-			if not os.path.isdir(address.path):
-				error(f"Invalid address: {remote.address}. Skipped.")
-				continue
-
-			remote_commits = set(os.listdir(os.path.join(address.path, COMMITS_DIRECTORY)))
-
-			# Verify that the remote has the same repository id as we do
-			with open(os.path.join(address.path, REPO_ID_FILE)) as f:
-				remote_id = f.read().strip()
-
-			with open(os.path.join(REPO_ID_FILE)) as f:
-				local_id = f.read().strip()
-
-			if remote_id != local_id:
-				error(f"Remote repository is another repository: '{address.path}'. Skipped")
-				continue
-
-			# Send commit metadata to remote
-			for commit_hash in remote_commits - local_commits:
-				shutil.copytree(
-					os.path.join(address.path, COMMITS_DIRECTORY, commit_hash),
-					os.path.join(COMMITS_DIRECTORY, commit_hash),
-				)
-
-			# Retrieve commit data from local remote
-			for commit_hash in local_commits - remote_commits:
-				shutil.copytree(
-					os.path.join(COMMITS_DIRECTORY, commit_hash),
-					os.path.join(address.path, COMMITS_DIRECTORY, commit_hash),
-				)
-
-			# Get and write coverage from remote
-			with open(os.path.join(REMOTES_FOLDER, remote.remote_hash, "coverage"), "w") as f:
-				for file_hash in _fetch_local_coverage_information(address):
-					f.write(f"{file_hash}\n")
-
-		elif isinstance(address, SSHAddress):
-			try:
-				_remote_fetch(address, remote.remote_hash)
-			except InvalidRemoteData as exception:
-				error(str(exception))
-
+		if isinstance(exception, (InvalidRemoteData, AgentError, OSError, subprocess.SubprocessError)):
+			output(f"Fetching from {address}: failed after {elapsed:.1f}s")
+			error(str(exception))
+		elif exception is not None:
+			raise exception
 		else:
-			raise NotImplementedError
+			output(
+				f"Fetching from {address}: {summary.commits_received} commits received, "
+				f"{summary.commits_sent} sent, {format_size(summary.bytes_transferred)} in "
+				f"{elapsed:.1f}s"
+			)
 
+	# Add the commits we received to the commit graph and the indexes
+	get_commit_graph()
+	update_path_history()
+	update_references()
 
-def _remote_fetch(address: SSHAddress, remote_hash: str) -> None:
+
+def _fetch_remote(remote: RemoteInfo, deadline: float) -> FetchSummary:
 	import os
-	import subprocess
-	from huge.repo.paths import COMMITS_DIRECTORY, REPO_ID_FILE, REMOTES_FOLDER
+	from huge.repo.address import parse_address
+	from huge.repo.paths import COMMITS_DIRECTORY, REPO_ID_FILE
+
+	address = parse_address(remote.address)
+
+	if isinstance(address, SSHAddress):
+		return _remote_fetch(address, remote.remote_hash, deadline)
+
+	if not isinstance(address, PathAddress):
+		raise NotImplementedError
+
+	if not os.path.isdir(address.path):
+		raise InvalidRemoteData(f"Invalid address: {remote.address}. Skipped.")
+
+	# Verify that the remote has the same repository id as we do
+	with open(os.path.join(address.path, REPO_ID_FILE)) as f:
+		remote_id = f.read().strip()
+
+	with open(os.path.join(REPO_ID_FILE)) as f:
+		local_id = f.read().strip()
+
+	if remote_id != local_id:
+		raise InvalidRemoteData(f"Remote repository is another repository: '{address.path}'. Skipped")
+
+	local_commits = set(os.listdir(COMMITS_DIRECTORY))
+	remote_commits = set(os.listdir(os.path.join(address.path, COMMITS_DIRECTORY)))
 
-	ssh = ["ssh", f"{address.login}@{address.server}"]
+	summary = FetchSummary()
 
-	process = subprocess.Popen(
-		ssh +
-		[
-			"cat",
-			f"{address.path}/{REPO_ID_FILE}",
-		],
-		stdout=subprocess.PIPE,
+	# Retrieve commit data from local remote
+	summary.commits_received, size = _copy_commits(
+		os.path.join(address.path, COMMITS_DIRECTORY),
+		COMMITS_DIRECTORY,
+		remote_commits - local_commits,
 	)
+	summary.bytes_transferred += size
 
-	stdout, _ = process.communicate()
+	# Send commit metadata to remote
+	summary.commits_sent, size = _copy_commits(
+		COMMITS_DIRECTORY,
+		os.path.join(address.path, COMMITS_DIRECTORY),
+		local_commits - remote_commits,
+	)
+	summary.bytes_transferred += size
 
-	repo_id: str = stdout.decode().strip()
+	# Get and write coverage from remote
+	summary.bytes_transferred += _store_changes(remote.remote_hash, _fetch_local_changes(address, remote.remote_hash))
 
-	if process.returncode:
-		raise InvalidRemoteData("Not able to list files from remote")
+	return summary
+
+
+def fetch_coverages() -> set[str]:
+	"""
+	Refresh the coverage information from all the remotes at the same time
+
+	Does not synchronize any commits. Remotes that can not be reached keeps their previous coverage
+	information.
+
+	Returns the hashes of the remotes that were reached.
+	"""
+	import subprocess
+	import time
+	from huge import error
+	from huge.repo.agent import AgentError
+	from huge.repo.config import get_duration_config
+	from huge.repo.remote import get_remotes
+
+	remotes = list(get_remotes())
+	reached: set[str] = set()
+
+	if not remotes:
+		return reached
+
+	deadline = time.monotonic() + get_duration_config("remote.fetch-timeout")
+
+	for remote, _, exception in _run_until(lambda x: _fetch_coverage(x, deadline), remotes, deadline):
+		if isinstance(exception, (InvalidRemoteData, AgentError, OSError, subprocess.SubprocessError)):
+			error(f"Could not fetch coverage from {remote.address}: {exception}")
+		elif exception is not None:
+			raise exception
+		else:
+			reached.add(remote.remote_hash)
+
+	return reached
+
+
+def _run_until(
+	function: Callable[[RemoteInfo], T],
+	remotes: list[RemoteInfo],
+	deadline: float,
+) -> Iterator[tuple[RemoteInfo, T | None, Exception | None]]:
+	"""
+	Run function for each remote on its own thread, giving the result or exception of each as it
+	finishes
+
+	SSH remotes are stopped at the deadline, but a local remote on e.g a hung network mount can not
+	be. Remotes still running at the deadline are given a TimeoutError instead, and their threads are
+	left behind. They are daemons, so they don't keep the command from exiting.
+	"""
+	import queue
+	import threading
+	import time
+
+	results: queue.Queue = queue.Queue()
+
+	def run(remote: RemoteInfo) -> None:
+		try:
+			results.put((remote, function(remote), None))
+		except Exception as exception:
+			results.put((remote, None, exception))
+
+	for remote in remotes:
+		threading.Thread(target=run, args=(remote,), daemon=True).start()
+
+	pending = list(remotes)
+
+	while pending:
+		try:
+			remote, result, exception = results.get(timeout=max(0, deadline - time.monotonic()))
+		except queue.Empty:
+			break
+
+		pending.remove(remote)
+		yield remote, result, exception
+
+	for remote in pending:
+		yield remote, None, TimeoutError("Timed out, see remote.fetch-timeout")
+
+
+def _fetch_coverage(remote: RemoteInfo, deadline: float) -> None:
+	import os
+	from huge.repo.address import parse_address
+	from huge.repo.agent import AgentError
+	from huge.repo.paths import REPO_ID_FILE
+	from huge.repo.ssh import connect_agent, ssh_command
+
+	address = parse_address(remote.address)
+
+	with open(REPO_ID_FILE) as f:
+		local_id = f.read().strip()
+
+	if isinstance(address, PathAddress):
+		if not os.path.isfile(os.path.join(address.path, REPO_ID_FILE)):
+			raise InvalidRemoteData("Not a repository")
+
+		with open(os.path.join(address.path, REPO_ID_FILE)) as f:
+			remote_id = f.read().strip()
+
+	elif isinstance(address, SSHAddress) and (agent := connect_agent(address)):
+		try:
+			with _kill_at(agent, deadline):
+				remote_id = agent.get_repository_id()
+		except AgentError as exception:
+			raise InvalidRemoteData(str(exception))
+
+	elif isinstance(address, SSHAddress):
+		stdout = _run(
+			ssh_command(address) + ["cat", f"{address.path}/{REPO_ID_FILE}"],
+			deadline,
+			"Not able to read repository id",
+		)
+
+		remote_id = stdout.decode().strip()
+
+	else:
+		raise NotImplementedError
+
+	if remote_id != local_id:
+		raise InvalidRemoteData("remote repository id doesn't match local repository id")
+
+	if isinstance(address, PathAddress):
+		changes = _fetch_local_changes(address, remote.remote_hash)
+	else:
+		changes = _fetch_remote_changes(address, remote.remote_hash, deadline)
+
+	_store_changes(remote.remote_hash, changes)
+
+
+def _remote_fetch(address: SSHAddress, remote_hash: str, deadline: float) -> FetchSummary:
+	import os
+	import tempfile
+	from huge.repo.compression import get_compression_level, rsync_compression
+	from huge.repo.paths import COMMITS_DIRECTORY, HUGE_DIRECTORY, REPO_ID_FILE
+	from huge.repo.ssh import connect_agent, rsync_address, rsync_command, ssh_command
+
+	if agent := connect_agent(address):
+		return _agent_fetch(agent, remote_hash, deadline)
+
+	compression = rsync_compression(get_compression_level(remote_hash))
+
+	ssh = ssh_command(address)
+
+	stdout = _run(ssh + ["cat", f"{address.path}/{REPO_ID_FILE}"], deadline, "Not able to list files from remote")
+
+	repo_id: str = stdout.decode().strip()
 
 	if len(repo_id) != 32:
 		raise InvalidRemoteData("Invalid remote repository id detected")
@@ -101,106 +295,278 @@ def _remote_fetch(address: SSHAddress, remote_hash: str) -> None:
 	local_commits: set[str] = set(os.listdir(COMMITS_DIRECTORY))
 
 	# Get list of commits on remote
-	process = subprocess.Popen(
-		ssh +
-		[
-			"ls",
-			f"{address.path}/{COMMITS_DIRECTORY}",
-		],
-		stdout=subprocess.PIPE,
-	)
-
-	stdout, _ = process.communicate()
-
-	if process.returncode:
-		raise InvalidRemoteData
+	stdout = _run(ssh + ["ls", f"{address.path}/{COMMITS_DIRECTORY}"], deadline, "Not able to list commits from remote")
 
 	remote_commits: set[str] = {x.strip() for x in stdout.decode().splitlines() if x.strip()}
 
+	summary = FetchSummary()
+
 	# Send commits we have that remote is missing
 	if missing_commits := local_commits - remote_commits:
-		process = subprocess.Popen(
-			["rsync", "-ahz", "--info=progress2"] +
+		_run(
+			rsync_command() +
+			["-ah"] + compression +
 
 			# Source files
 			[f"{COMMITS_DIRECTORY}/{x}" for x in missing_commits] +
 
 			# Destination
-			[f"{address.login}@{address.server}:{address.path}/{COMMITS_DIRECTORY}/"],
+			[rsync_address(address, f"{address.path}/{COMMITS_DIRECTORY}/")],
+			deadline,
+			"Not able to send commits to remote",
 		)
 
-		process.wait()
+		summary.commits_sent = len(missing_commits)
+		summary.bytes_transferred += sum(_get_commit_size(COMMITS_DIRECTORY, x) for x in missing_commits)
 
-		if process.returncode:
-			raise InvalidRemoteData
-
-	# Retrieve commits from remote that we are missing
+	# Retrieve commits from remote that we are missing. Received into a temporary folder first, as
+	# other remotes might be giving us the same commits at the same time.
 	if missing_commits := remote_commits - local_commits:
-		process = subprocess.Popen(
-			["rsync", "-ahz", "--info=progress2"] +
+		with tempfile.TemporaryDirectory(dir=HUGE_DIRECTORY) as d:
+			_run(
+				rsync_command() +
+				["-ah"] + compression +
+
+				# Source files
+				[
+					rsync_address(address, f"{address.path}/{COMMITS_DIRECTORY}/{x}")
+					for x in
+					missing_commits
+				] +
+
+				# Destination
+				[f"{d}/"],
+				deadline,
+				"Not able to retrieve commits from remote",
+			)
+
+			summary.commits_received, summary.bytes_transferred = _copy_commits(
+				d,
+				COMMITS_DIRECTORY,
+				missing_commits,
+				summary.bytes_transferred,
+			)
 
-			# Source files
-			[
-				f"{address.login}@{address.server}:{address.path}/{COMMITS_DIRECTORY}/{x}"
-				for x in
-				missing_commits
-			] +
+	# Get and store the remote coverage information locally so that we have it easily available.
+	# E.g when being offline.
+	summary.bytes_transferred += _store_changes(remote_hash, _fetch_remote_changes(address, remote_hash, deadline))
 
-			# Destination
-			[f"{COMMITS_DIRECTORY}/"],
-		)
+	return summary
 
-		process.wait()
 
-		if process.returncode:
-			raise InvalidRemoteData
+def _agent_fetch(agent: Agent, remote_hash: str, deadline: float) -> FetchSummary:
+	"""
+	Synchronize commits and get the coverage in a single session with the agent of the remote
+	"""
+	import os
+	from huge.repo.agent import AgentError
+	from huge.repo.coverage import get_remote_position
+	from huge.repo.paths import COMMITS_DIRECTORY
 
-	# Get and store the remote coverage information locally so that we have it easily available.
-	# E.g when being offline.
-	with open(os.path.join(REMOTES_FOLDER, remote_hash, "coverage"), "w") as f:
-		for file_hash in _fetch_remote_coverage_information(address):
-			f.write(f"{file_hash}\n")
+	summary = FetchSummary()
+
+	try:
+		with _kill_at(agent, deadline):
+			agent.check_repository()
+
+			local_commits: set[str] = set(os.listdir(COMMITS_DIRECTORY))
+			remote_commits = agent.list_commits()
+
+			if missing_commits := local_commits - remote_commits:
+				agent.put_commits(missing_commits)
+				summary.commits_sent = len(missing_commits)
+				summary.bytes_transferred += sum(_get_commit_size(COMMITS_DIRECTORY, x) for x in missing_commits)
+
+			if missing_commits := remote_commits - local_commits:
+				agent.get_commits(missing_commits)
+				summary.commits_received = len(missing_commits)
+				summary.bytes_transferred += sum(_get_commit_size(COMMITS_DIRECTORY, x) for x in missing_commits)
+
+			changes = agent.list_changes(*get_remote_position(remote_hash))
+
+	except AgentError as exception:
+		raise InvalidRemoteData(str(exception))
+
+	summary.bytes_transferred += _store_changes(remote_hash, changes)
+
+	return summary
+
+
+def _copy_commits(
+	source_folder: str,
+	target_folder: str,
+	commit_hashes: set[str],
+	bytes_transferred: int = 0,
+) -> tuple[int, int]:
+	"""
+	Copy commit folders that the target does not have already
+
+	Each commit is copied next to the target first and then renamed in place, so that commits
+	arriving from several remotes at the same time, or an interrupted copy, never leaves half a
+	commit behind.
+
+	Returns: (commits copied, bytes_transferred plus the size of the copied commits)
+	"""
+	import os
+	import shutil
+	import tempfile
+
+	copied = 0
+
+	for commit_hash in commit_hashes:
+		if os.path.isdir(os.path.join(target_folder, commit_hash)):
+			continue
+
+		d = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(target_folder)))
+
+		try:
+			shutil.copytree(os.path.join(source_folder, commit_hash), os.path.join(d, commit_hash))
+			os.rename(os.path.join(d, commit_hash), os.path.join(target_folder, commit_hash))
+		except OSError:
+			if not os.path.isdir(os.path.join(target_folder, commit_hash)):
+				raise
+
+			continue  # Someone else got it first
+
+		finally:
+			shutil.rmtree(d)
+
+		copied += 1
+		bytes_transferred += _get_commit_size(target_folder, commit_hash)
+
+	return copied, bytes_transferred
+
+
+def _get_commit_size(commits_folder: str, commit_hash: str) -> int:
+	import os
+
+	return sum(x.stat().st_size for x in os.scandir(os.path.join(commits_folder, commit_hash)))
+
+
+def _run(command: list[str], deadline: float, message: str) -> bytes:
+	"""
+	Run a command and get its output, killing it if the deadline passes
+	"""
+	import subprocess
+	import time
+
+	process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+	try:
+		stdout, _ = process.communicate(timeout=max(0, deadline - time.monotonic()))
+	except subprocess.TimeoutExpired:
+		process.kill()
+		process.communicate()
+		raise InvalidRemoteData(f"{message}: timed out")
+
+	if process.returncode:
+		raise InvalidRemoteData(message)
+
+	return stdout
+
+
+@contextmanager
+def _kill_at(agent: Agent, deadline: float) -> Iterator[None]:
+	"""
+	Stop the agent if it is still working when the deadline passes
+	"""
+	import threading
+	import time
+
+	timer = threading.Timer(max(0, deadline - time.monotonic()), agent.process.kill)
+	timer.start()
+
+	try:
+		yield
+	finally:
+		timer.cancel()
 
 
 class InvalidRemoteData(Exception):
 	pass
 
 
-def _fetch_remote_coverage_information(address: SSHAddress) -> set[str]:
-	import subprocess
-	from huge.repo.paths import FILES_DIRECTORY
+def _fetch_remote_changes(address: SSHAddress, remote_hash: str, deadline: float) -> StorageChanges:
+	"""
+	Get what was stored and deleted on a remote since the last fetch, or all its files if we can't tell
+	"""
+	from huge.repo.agent import AgentError
+	from huge.repo.coverage import get_remote_position
+	from huge.repo.ssh import connect_agent, ssh_shell_command
+
+	epoch, sequence = get_remote_position(remote_hash)
 
-	process = subprocess.Popen(
-		[
-			"ssh",
-			f"{address.login}@{address.server}",
-			"ls",
-			f"{address.path}/{FILES_DIRECTORY}",
-		],
-		stdout=subprocess.PIPE,
+	# The agent reads its storage log, which does not need to be checked
+	if agent := connect_agent(address):
+		try:
+			with _kill_at(agent, deadline):
+				return agent.list_changes(epoch, sequence)
+		except AgentError as exception:
+			raise InvalidRemoteData(str(exception))
+
+	return _read_changes(lambda x: ssh_shell_command(address, x), address.path, epoch, sequence, deadline)
+
+
+def _read_changes(
+	command: Callable[[str], list[str]],
+	repository_path: str,
+	epoch: str,
+	sequence: int,
+	deadline: float,
+) -> StorageChanges:
+	import shlex
+	from huge.repo.storage import LOG_HEADER_SIZE, LOG_LINE_SIZE, parse_storage_log
+
+	offset = LOG_HEADER_SIZE + LOG_LINE_SIZE * sequence
+
+	stdout = _run(
+		command(_CHANGES_SCRIPT.format(
+			path=shlex.quote(repository_path),
+			epoch=shlex.quote(epoch),
+			offset=offset,
+			start=offset + 1,
+		)),
+		deadline,
+		f"Could not list remote repository files: {repository_path}",
 	)
 
-	stdout, _ = process.communicate()
+	try:
+		position, kind, data = stdout.split(b"\n", 2)
+		remote_epoch, size = position.decode().split(" ")
+	except ValueError:
+		raise InvalidRemoteData(f"Invalid storage listing from remote: {repository_path}")
 
-	if process.returncode:
-		raise InvalidRemoteData(f"Could not list remote repository files: {address}")
+	if kind == b"changes":
+		return parse_storage_log(remote_epoch, sequence, data)
 
-	file_hashes: set[str] = {x.strip() for x in stdout.decode().splitlines()}
+	return StorageChanges(
+		remote_epoch,
+		max(0, (int(size) - LOG_HEADER_SIZE) // LOG_LINE_SIZE),
+		files={x.strip() for x in data.decode().splitlines()},
+	)
 
-	_verify_file_hashes(file_hashes)
 
-	return file_hashes
+def _fetch_local_changes(address: PathAddress, remote_hash: str) -> StorageChanges:
+	from huge.repo.coverage import get_remote_position
+	from huge.repo.storage import get_storage_changes
 
+	return get_storage_changes(*get_remote_position(remote_hash), address.path)
 
-def _fetch_local_coverage_information(address: SSHAddress) -> set[str]:
-	import os
-	from huge.repo.paths import FILES_DIRECTORY
 
-	file_hashes = set(os.listdir(os.path.join(address.path, FILES_DIRECTORY)))
+def _store_changes(remote_hash: str, changes: StorageChanges) -> int:
+	"""
+	Write the changes into the coverage of the remote, returning about how many bytes they were
+	"""
+	from huge.repo.coverage import store_remote_changes
 
-	_verify_file_hashes(file_hashes)
+	_verify_file_hashes((changes.files or set()) | changes.added | changes.removed)
 
-	return file_hashes
+	store_remote_changes(remote_hash, changes)
+
+	if changes.files is not None:
+		return 33 * len(changes.files)
+
+	return 34 * (len(changes.added) + len(changes.removed))
 
 
 def _verify_file_hashes(file_hashes: set[str]) -> None:
@@ -216,3 +582,132 @@ def _verify_file_hashes(file_hashes: set[str]) -> None:
 			int(x, 16)
 		except ValueError:
 			raise InvalidRemoteData(f"Invalid hex in file name in remote: {x}")
+
+
+@huge_test
+def test_read_changes() -> None:
+	import os
+	import time
+	from huge.repo import create_repository
+	from huge.repo.coverage import get_remote_coverage, get_remote_position
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.remote import add_remote, get_remotes
+	from huge.repo.storage import add_stored_files, remove_stored_files
+	from huge.testing import cd
+
+	create_repository()
+	add_remote("remote")
+
+	remote_hash = next(get_remotes()).remote_hash
+
+	os.mkdir("remote")
+
+	with cd("remote"):
+		create_repository()
+
+		for x in "ab":
+			with open(os.path.join(FILES_DIRECTORY, x * 32), "w") as f:
+				f.write("Content")
+
+		add_stored_files({"a" * 32, "b" * 32})
+
+	# Run the script locally instead of on a server
+	def command(script: str) -> list[str]:
+		return ["sh", "-c", script]
+
+	def fetch() -> StorageChanges:
+		changes = _read_changes(command, os.path.abspath("remote"), *get_remote_position(remote_hash), time.monotonic() + 10)
+		_store_changes(remote_hash, changes)
+		return changes
+
+	# The first time everything is listed, then only what changed since is read from the log
+	assert fetch().files == {"a" * 32, "b" * 32}
+
+	with cd("remote"):
+		with open(os.path.join(FILES_DIRECTORY, "c" * 32), "w") as f:
+			f.write("Content")
+
+		add_stored_files({"c" * 32})
+		os.remove(os.path.join(FILES_DIRECTORY, "a" * 32))
+		remove_stored_files({"a" * 32})
+
+	changes = fetch()
+	assert (changes.files, changes.added, changes.removed) == (None, {"c" * 32}, {"a" * 32})
+	assert get_remote_coverage(remote_hash) == {"b" * 32, "c" * 32}
+
+	assert fetch() == StorageChanges(*get_remote_position(remote_hash))
+
+	# Files put into the storage without the remote knowing are not in its log, so all are listed
+	with open(os.path.join("remote", FILES_DIRECTORY, "d" * 32), "w") as f:
+		f.write("Content")
+
+	assert fetch().files == {"b" * 32, "c" * 32, "d" * 32}
+
+
+
+@huge_test
+def test_fetch_coverages() -> None:
+	import os
+	import shutil
+	import threading
+	import time
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, REPO_ID_FILE
+	from huge.repo.remote import add_remote, get_remotes
+	from huge.testing import catch_error, catch_output, cd
+
+	create_repository()
+
+	for name in ["good", "broken"]:
+		os.mkdir(name)
+
+		with cd(name):
+			create_repository()
+
+		add_remote(name)
+
+	for name in ["good", "broken"]:
+		with open(REPO_ID_FILE) as f, open(os.path.join(name, REPO_ID_FILE), "w") as g:
+			g.write(f.read())
+
+	# Listing the storage of "broken" fails with an OSError, which only skips that remote
+	shutil.rmtree(os.path.join("broken", FILES_DIRECTORY))
+
+	with catch_error() as errors:
+		reached = fetch_coverages()
+
+	assert "broken" in errors.getvalue()
+	assert reached == {x.remote_hash for x in get_remotes() if x.address.endswith("good")}
+
+	# A local remote that hangs, like on a network mount, is given up on at the deadline
+	shutil.rmtree("broken")
+	release = threading.Event()
+	set_config("remote.fetch-timeout", "0.2")
+
+	def hang(address: PathAddress, remote_hash: str) -> StorageChanges:
+		release.wait()
+		raise OSError("Released")
+
+	try:
+		with patch("huge.repo.fetch._fetch_local_changes", side_effect=hang), catch_error() as errors:
+			started = time.monotonic()
+			assert fetch_coverages() == set()
+			assert time.monotonic() - started < 5
+
+		assert "good: Timed out" in errors.getvalue()
+
+		with patch("huge.repo.fetch._fetch_local_changes", side_effect=hang), catch_output(), catch_error():
+			started = time.monotonic()
+			fetch_repositories()
+			assert time.monotonic() - started < 5
+
+	finally:
+		release.set()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,321 @@
+"""
+Garbage collection of the local repository
+
+Cleans up what is left behind by interrupted commands and files that no commit points at anymore:
+
+1. Temporary files and folders in HUGE_DIRECTORY, and partly received files in STAGING_FOLDER,
+   that are older than "gc.temporary-age"
+2. Mark: reads the files of every commit, remembering the files they point at
+3. Sweep: deletes stored files that were not marked
+4. Removes duplicates and invalid lines from the coverage files of the remotes and the file
+   metadata logs, and starts the storage log over when it has grown long, see huge.repo.storage
+
+The mark phase can take a long time on large repositories, so it can be given a time budget. The
+commits and files marked so far are then stored in GC_FOLDER, and the next run continues where the
+previous one stopped.
+"""
+import os
+import time
+from dataclasses import dataclass, field
+from huge.testing import huge_test
+
+
+@dataclass
+class GarbageCollection:
+	temporary_paths_removed: int = 0
+	commits_marked: int = 0
+	commits_remaining: int = 0
+
+	# Files that were deleted: {"hash sum": size}
+	files_removed: dict[str, int] = field(default_factory=dict)
+
+	coverage_lines_removed: int = 0
+
+	# If the time budget was used up before everything was done
+	finished: bool = True
+
+
+def collect_garbage(budget: float | None = None) -> GarbageCollection:
+	"""
+	Run all the phases of the garbage collection
+
+	budget is the number of seconds to spend, or None to run until done.
+	"""
+	from huge.repo.metadata import compact_metadata
+	from huge.repo.storage import compact_storage_log
+
+	deadline = None if budget is None else time.monotonic() + budget
+
+	result = GarbageCollection()
+
+	result.temporary_paths_removed = remove_temporary_paths()
+
+	if not _mark(result, deadline):
+		result.finished = False
+		return result
+
+	if not _sweep(result, deadline):
+		result.finished = False
+		return result
+
+	result.coverage_lines_removed = compact_coverages()
+	compact_metadata()
+	compact_storage_log()
+
+	return result
+
+
+def remove_temporary_paths() -> int:
+	"""
+	Remove temporary files and folders left behind by interrupted commands
+
+	Only paths older than "gc.temporary-age" are removed, as a command might still be using them.
+	Partly received files are kept as long, for a later transfer to continue from.
+	"""
+	import shutil
+	from huge.repo.config import get_duration_config
+	from huge.repo.paths import HUGE_DIRECTORY, STAGING_FOLDER
+
+	oldest = time.time() - get_duration_config("gc.temporary-age")
+
+	count = 0
+
+	entries = [
+		# Made by tempfile.TemporaryDirectory() and atomic_write()
+		x for x in os.scandir(HUGE_DIRECTORY) if x.name.startswith(("tmp", ".tmp-"))
+	]
+
+	if os.path.isdir(STAGING_FOLDER):
+		entries.extend(os.scandir(STAGING_FOLDER))
+
+	for entry in entries:
+		if entry.stat(follow_symlinks=False).st_mtime > oldest:
+			continue
+
+		if entry.is_dir(follow_symlinks=False):
+			shutil.rmtree(entry.path)
+		else:
+			os.remove(entry.path)
+
+		count += 1
+
+	return count
+
+
+def compact_coverages() -> int:
+	"""
+	Rewrite the coverage files of the remotes without duplicates and invalid lines
+
+	Pushing appends to the coverage files, so they grow until the next fetch.
+
+	Returns the number of lines removed.
+	"""
+	import re
+	from huge.repo import atomic_write
+	from huge.repo.paths import REMOTES_FOLDER
+
+	valid = re.compile("^[0-9a-f]{32}$")
+
+	removed = 0
+
+	for remote in os.listdir(REMOTES_FOLDER):
+		coverage_file = os.path.join(REMOTES_FOLDER, remote, "coverage")
+
+		if not os.path.isfile(coverage_file):
+			continue
+
+		with open(coverage_file) as f:
+			lines = [x.strip() for x in f]
+
+		file_hashes = sorted({x for x in lines if valid.match(x)})
+
+		if len(file_hashes) == len(lines):
+			continue
+
+		with atomic_write(coverage_file) as f:
+			f.writelines(f"{x}\n" for x in file_hashes)
+
+		removed += len(lines) - len(file_hashes)
+
+	return removed
+
+
+def _mark(result: GarbageCollection, deadline: float | None) -> bool:
+	"""
+	Mark the files used by all commits, continuing from any previous run
+
+	Returns False if the time ran out.
+	"""
+	from huge.repo.commit import get_commit_files
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.paths import GC_FOLDER
+	from huge.repo.storage import get_storage_changes
+
+	if not os.path.isdir(GC_FOLDER):
+		os.mkdir(GC_FOLDER)
+
+		# Files stored after this point are never swept, as their commit might not be written yet.
+		# Files received with their original mtime, like by rsync -a or tar, are found in the
+		# storage log after this position.
+		with open(os.path.join(GC_FOLDER, "started"), "w") as f:
+			f.write(str(time.time()))
+
+		changes = get_storage_changes("", 0)
+
+		with open(os.path.join(GC_FOLDER, "position"), "w") as f:
+			f.write(f"{changes.epoch}\t{changes.sequence}\n")
+
+	commits_to_mark = set(get_commit_graph().parents) - _read_lines(os.path.join(GC_FOLDER, "commits"))
+
+	with (
+		open(os.path.join(GC_FOLDER, "marked"), "a") as marked,
+		open(os.path.join(GC_FOLDER, "commits"), "a") as commits,
+	):
+		for commit_hash in commits_to_mark:
+			if deadline is not None and time.monotonic() >= deadline:
+				result.commits_remaining = len(commits_to_mark) - result.commits_marked
+				return False
+
+			marked.writelines(f"{x}\n" for x in set(get_commit_files(commit_hash).values()))
+			marked.flush()
+
+			commits.write(f"{commit_hash}\n")
+			commits.flush()
+
+			result.commits_marked += 1
+
+	return True
+
+
+def _sweep(result: GarbageCollection, deadline: float | None) -> bool:
+	"""
+	Delete the stored files that were not marked, then forget the marks
+
+	Returns False if the time ran out.
+	"""
+	import shutil
+	from huge.repo.drop import drop_commit_files
+	from huge.repo.paths import FILES_DIRECTORY, GC_FOLDER
+	from huge.repo.storage import get_storage_changes, get_stored_files
+
+	with open(os.path.join(GC_FOLDER, "started")) as f:
+		started = float(f.read())
+
+	epoch, sequence = "", "0"
+
+	if os.path.isfile(os.path.join(GC_FOLDER, "position")):
+		with open(os.path.join(GC_FOLDER, "position")) as f:
+			epoch, sequence = f.read().strip().split("\t")
+
+	# When the log has started over since, every file might be new
+	changes = get_storage_changes(epoch, int(sequence))
+	stored_since = changes.added if changes.files is None else changes.files
+
+	stored_files = get_stored_files()
+
+	unmarked = list(set(stored_files) - _read_lines(os.path.join(GC_FOLDER, "marked")) - stored_since)
+
+	for i in range(0, len(unmarked), 10000):
+		if deadline is not None and time.monotonic() >= deadline:
+			return False
+
+		to_remove: set[str] = set()
+
+		for file_hash in unmarked[i:i + 10000]:
+			try:
+				mtime = os.stat(os.path.join(FILES_DIRECTORY, file_hash)).st_mtime
+			except FileNotFoundError:
+				continue  # Deleted by someone else after the index was read
+
+			if mtime < started:
+				to_remove.add(file_hash)
+
+		result.files_removed.update({x: stored_files[x] for x in to_remove})
+
+		drop_commit_files(to_remove)
+
+	shutil.rmtree(GC_FOLDER)
+
+	return True
+
+
+def _read_lines(path: str) -> set[str]:
+	if not os.path.isfile(path):
+		return set()
+
+	with open(path) as f:
+		return {x.strip() for x in f if x.strip()}
+
+
+@huge_test
+def test_collect_garbage() -> None:
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.paths import FILES_DIRECTORY, GC_FOLDER, HUGE_DIRECTORY, REMOTES_FOLDER
+	from huge.repo.stage import mark_as_staged
+	from huge.repo.storage import add_stored_files, get_stored_files, remove_stored_files
+
+	create_repository()
+
+	with open("a", "w") as f:
+		f.write("Content")
+
+	mark_as_staged(["a"])
+	create_commit(None)
+
+	commit_files = set(get_commit_files(get_current_commit()).values())
+
+	# Left behind by an interrupted pull, long ago
+	os.mkdir(os.path.join(HUGE_DIRECTORY, "tmpabcdef"))
+	os.utime(os.path.join(HUGE_DIRECTORY, "tmpabcdef"), (0, 0))
+
+	# Stored file that no commit points at
+	with open(os.path.join(FILES_DIRECTORY, "f" * 32), "w") as f:
+		f.write("Orphan")
+
+	os.utime(os.path.join(FILES_DIRECTORY, "f" * 32), (0, 0))
+	add_stored_files({"f" * 32})
+
+	os.mkdir(os.path.join(REMOTES_FOLDER, "remote"))
+	with open(os.path.join(REMOTES_FOLDER, "remote", "coverage"), "w") as f:
+		f.write(f"{'a' * 32}\n{'a' * 32}\ninvalid\n")
+
+	# No time to do anything
+	result = collect_garbage(budget=0)
+	assert not result.finished
+	assert result.temporary_paths_removed == 1
+	assert result.commits_remaining == 1
+	assert os.path.isdir(GC_FOLDER)
+
+	# Received while the garbage collection was going on, keeping its original mtime
+	with open(os.path.join(FILES_DIRECTORY, "d" * 32), "w") as f:
+		f.write("Pushed")
+
+	os.utime(os.path.join(FILES_DIRECTORY, "d" * 32), (0, 0))
+	add_stored_files({"d" * 32})
+	commit_files.add("d" * 32)
+
+	result = collect_garbage()
+	assert result.finished
+	assert result.commits_marked == 1
+	assert result.files_removed == {"f" * 32: 6}
+	assert result.coverage_lines_removed == 2
+	assert set(get_stored_files()) == commit_files
+	assert not os.path.isdir(GC_FOLDER)
+
+	os.remove(os.path.join(FILES_DIRECTORY, "d" * 32))
+	remove_stored_files({"d" * 32})
+
+	# A file in the index that is deleted before the sweep gets to it is skipped
+	with patch("huge.repo.storage.get_stored_files", return_value={**get_stored_files(), "e" * 32: 1}):
+		result = collect_garbage()
+
+	assert result.finished
+	assert result.files_removed == {}
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,399 @@
+"""
+Graph of all the commits and how they relate to each other
+
+Stored in COMMIT_GRAPH_FILE so that the parents and timestamps of all commits are available without
+opening every commit folder. Each commit also gets a generation number, which is one more than the
+highest generation of its parents. A commit can never be the ancestor of a commit with a lower or
+equal generation, which lets ancestor searches stop early.
+
+The graph remembers the modification time of COMMITS_DIRECTORY it was written for, and new commits
+(e.g from a fetch) are added to it the next time it is read.
+"""
+import os
+from dataclasses import dataclass, field
+from huge.testing import huge_test
+
+
+@dataclass
+class CommitGraph:
+	# {"commit hash": ("parent commit hash", ...)}
+	parents: dict[str, tuple[str, ...]] = field(default_factory=dict)
+
+	# {"commit hash": {"child commit hash", ...}}
+	children: dict[str, set[str]] = field(default_factory=dict)
+
+	# {"commit hash": 1}. Commits without parents have generation 1.
+	generations: dict[str, int] = field(default_factory=dict)
+
+	# {"commit hash": "2024-04-13T15:35:01.123456+00:00"}
+	timestamps: dict[str, str] = field(default_factory=dict)
+
+	# Commits that has no children
+	heads: set[str] = field(default_factory=set)
+
+	# mtime of COMMITS_DIRECTORY when the graph was last updated
+	directory_mtime: int | None = None
+
+
+# {"/absolute/path/to/repository": CommitGraph(...)}
+_cache: dict[str, CommitGraph] = {}
+
+
+def get_commit_graph() -> CommitGraph:
+	"""
+	Get the graph for the repository, adding any new commits to it first
+	"""
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	key = os.path.abspath(".")
+	directory_mtime = os.stat(COMMITS_DIRECTORY).st_mtime_ns
+
+	if key in _cache and _cache[key].directory_mtime == directory_mtime:
+		return _cache[key]
+
+	graph = _read_graph()
+
+	if graph.directory_mtime != directory_mtime:
+		commit_hashes = set(os.listdir(COMMITS_DIRECTORY))
+
+		if set(graph.parents) - commit_hashes:
+			graph = CommitGraph()  # Commits has disappeared. Start over.
+
+		_add_commits(graph, commit_hashes - set(graph.parents))
+		graph.directory_mtime = directory_mtime
+		_write_graph(graph)
+
+	_cache[key] = graph
+
+	return graph
+
+
+def forget_commit_graph() -> None:
+	_cache.clear()
+
+
+def get_branches(graph: CommitGraph) -> set[str]:
+	"""
+	Get the first commit of every branch, meaning all the commits that has a sibling
+	"""
+	roots = {commit_hash for commit_hash, parents in graph.parents.items() if not parents}
+
+	return {
+		child_commit_hash
+		for children in list(graph.children.values()) + [roots]
+		if len(children) > 1
+		for child_commit_hash in children
+	}
+
+
+def is_ancestor(graph: CommitGraph, ancestor: str, commit_hash: str) -> bool:
+	"""
+	Check if a commit is reachable by following the parents of another commit
+	"""
+	minimum_generation = graph.generations[ancestor]
+
+	todo = [commit_hash]
+	seen = {commit_hash}
+
+	while todo:
+		x = todo.pop()
+
+		if x == ancestor:
+			return True
+
+		for parent in graph.parents.get(x, ()):
+			# Commits with too low generation can not lead to the ancestor
+			if parent not in seen and graph.generations.get(parent, 0) >= minimum_generation:
+				seen.add(parent)
+				todo.append(parent)
+
+	return False
+
+
+def get_merge_bases(graph: CommitGraph, first: str, second: str) -> set[str]:
+	"""
+	Find the best common ancestors of two commits
+
+	Common ancestors that are ancestors of other common ancestors are left out. Usually returns a
+	single commit, but criss-cross merges can give more. Returns an empty set if the commits has
+	no history in common.
+	"""
+	import heapq
+
+	# Everything reachable from the first commit
+	first_ancestors = {first}
+	todo = [first]
+	while todo:
+		for parent in graph.parents.get(todo.pop(), ()):
+			if parent not in first_ancestors:
+				first_ancestors.add(parent)
+				todo.append(parent)
+
+	# Walk the history of the second commit, newest generation first, stopping at common ancestors
+	candidates: set[str] = set()
+	queue = [(-graph.generations[second], second)]
+	seen = {second}
+
+	while queue:
+		_, commit_hash = heapq.heappop(queue)
+
+		if commit_hash in first_ancestors:
+			candidates.add(commit_hash)
+			continue
+
+		for parent in graph.parents.get(commit_hash, ()):
+			if parent not in seen:
+				seen.add(parent)
+				heapq.heappush(queue, (-graph.generations.get(parent, 0), parent))
+
+	return {
+		candidate
+		for candidate in candidates
+		if not any(
+			other != candidate and is_ancestor(graph, candidate, other)
+			for other in candidates
+		)
+	}
+
+
+def get_branch_labels(graph: CommitGraph) -> dict[str, int]:
+	"""
+	Number the branches and label each commit with the branch it belongs to
+
+	Every child of a commit that has more than one child, or that merges branches, starts a new
+	branch. Other commits inherit the branch of their parent. Merge commits and the commits in the
+	first line of history belong to branch 0.
+
+	Returns: {"commit hash": 1}
+	"""
+	branch_counter = 0
+	branch_starts: dict[str, int] = {}
+
+	by_timestamp = sorted(graph.parents, key=lambda x: graph.timestamps[x])
+
+	for commit_hash in by_timestamp:
+		if len(graph.children[commit_hash]) > 1 or len(graph.parents[commit_hash]) > 1:
+			for child_commit_hash in sorted(graph.children[commit_hash], key=lambda x: graph.timestamps[x]):
+				branch_counter += 1
+				branch_starts[child_commit_hash] = branch_counter
+
+	result: dict[str, int] = {}
+
+	# Parents always have a lower generation than their children
+	for commit_hash in sorted(graph.parents, key=lambda x: graph.generations[x]):
+		parents = graph.parents[commit_hash]
+
+		if len(parents) > 1:
+			result[commit_hash] = 0  # Commits that merges branches is the end of a branch line
+		elif commit_hash in branch_starts:
+			result[commit_hash] = branch_starts[commit_hash]
+		elif parents:
+			result[commit_hash] = result.get(parents[0], 0)
+		else:
+			result[commit_hash] = 0
+
+	return result
+
+
+def _add_commits(graph: CommitGraph, commit_hashes: set[str]) -> None:
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	for commit_hash in commit_hashes:
+		parents: list[str] = []
+		if os.path.isfile(os.path.join(COMMITS_DIRECTORY, commit_hash, "parents")):
+			with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "parents")) as f:
+				parents = [x.strip() for x in f if x.strip()]
+
+		with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "timestamp")) as f:
+			graph.timestamps[commit_hash] = f.read().strip()
+
+		graph.parents[commit_hash] = tuple(parents)
+		graph.children.setdefault(commit_hash, set())
+
+	for commit_hash in commit_hashes:
+		for parent in graph.parents[commit_hash]:
+			graph.children.setdefault(parent, set()).add(commit_hash)
+
+	graph.heads = {x for x in graph.parents if not graph.children[x]}
+
+	# Parents that arrived after their children changes the generation of existing commits
+	if any(child in graph.generations for x in commit_hashes for child in graph.children[x]):
+		graph.generations.clear()
+
+	for commit_hash in graph.parents:
+		if commit_hash not in graph.generations:
+			_calculate_generation(graph, commit_hash)
+
+
+def _calculate_generation(graph: CommitGraph, commit_hash: str) -> None:
+	# Iterative, as history can be far deeper than the recursion limit
+	todo = [commit_hash]
+	while todo:
+		x = todo[-1]
+		missing = [p for p in graph.parents[x] if p in graph.parents and p not in graph.generations]
+
+		if missing:
+			todo.extend(missing)
+			continue
+
+		todo.pop()
+		graph.generations[x] = 1 + max(
+			(graph.generations[p] for p in graph.parents[x] if p in graph.generations),
+			default=0,
+		)
+
+
+def _read_graph() -> CommitGraph:
+	from huge.repo.paths import COMMIT_GRAPH_FILE
+
+	graph = CommitGraph()
+
+	if not os.path.isfile(COMMIT_GRAPH_FILE):
+		return graph
+
+	with open(COMMIT_GRAPH_FILE) as f:
+		graph.directory_mtime = int(f.readline())
+
+		for x in f:
+			commit_hash, timestamp, generation, parents = x.rstrip("\n").split("\t")
+			graph.parents[commit_hash] = tuple(parents.split())
+			graph.timestamps[commit_hash] = timestamp
+			graph.generations[commit_hash] = int(generation)
+			graph.children.setdefault(commit_hash, set())
+
+	for commit_hash, parents in graph.parents.items():
+		for parent in parents:
+			graph.children.setdefault(parent, set()).add(commit_hash)
+
+	graph.heads = {x for x in graph.parents if not graph.children[x]}
+
+	return graph
+
+
+def _write_graph(graph: CommitGraph) -> None:
+	from huge.repo import atomic_write
+	from huge.repo.paths import COMMIT_GRAPH_FILE
+
+	with atomic_write(COMMIT_GRAPH_FILE) as f:
+		f.write(f"{graph.directory_mtime}\n")
+		f.writelines(
+			f"{commit_hash}\t{graph.timestamps[commit_hash]}\t{graph.generations[commit_hash]}\t{' '.join(parents)}\n"
+			for commit_hash, parents in graph.parents.items()
+		)
+
+
+def _create_test_graph(parents: dict[str, tuple[str, ...]]) -> CommitGraph:
+	"""
+	Create a graph where the commit names also sort in timestamp order
+	"""
+	graph = CommitGraph()
+	for commit_hash, commit_parents in parents.items():
+		graph.parents[commit_hash] = commit_parents
+		graph.timestamps[commit_hash] = commit_hash
+		graph.children.setdefault(commit_hash, set())
+		for parent in commit_parents:
+			graph.children.setdefault(parent, set()).add(commit_hash)
+
+	graph.heads = {x for x in graph.parents if not graph.children[x]}
+
+	for commit_hash in graph.parents:
+		_calculate_generation(graph, commit_hash)
+
+	return graph
+
+
+def test_generations_and_ancestors() -> None:
+	#   b - c
+	#  /     \
+	# a - d - e - f
+	graph = _create_test_graph(
+		{"a": (), "b": ("a",), "c": ("b",), "d": ("a",), "e": ("d", "c"), "f": ("e",)},
+	)
+
+	assert graph.generations == {"a": 1, "b": 2, "c": 3, "d": 2, "e": 4, "f": 5}
+	assert graph.heads == {"f"}
+	assert get_branches(graph) == {"b", "d"}
+
+	assert is_ancestor(graph, "a", "f")
+	assert is_ancestor(graph, "c", "e")
+	assert not is_ancestor(graph, "c", "d")
+	assert not is_ancestor(graph, "f", "a")
+
+	assert get_merge_bases(graph, "c", "d") == {"a"}
+	assert get_merge_bases(graph, "f", "c") == {"c"}
+	assert get_merge_bases(graph, "b", "b") == {"b"}
+
+
+def test_criss_cross_merge_bases() -> None:
+	#   b - d
+	#  /  X
+	# a - c - e   g
+	graph = _create_test_graph(
+		{"a": (), "b": ("a",), "c": ("a",), "d": ("b", "c"), "e": ("c", "b"), "g": ()},
+	)
+
+	# Both sides merged both branches, so neither branch is better than the other
+	assert get_merge_bases(graph, "d", "e") == {"b", "c"}
+	assert get_merge_bases(graph, "d", "c") == {"c"}
+
+	# No history in common
+	assert get_merge_bases(graph, "d", "g") == set()
+
+
+def test_branch_labels() -> None:
+	#   b - c
+	#  /     \
+	# a - d - e - f
+	#      \
+	#       g
+	graph = _create_test_graph(
+		{"a": (), "b": ("a",), "c": ("b",), "d": ("a",), "e": ("d", "c"), "f": ("e",), "g": ("d",)},
+	)
+
+	assert get_branch_labels(graph) == {"a": 0, "b": 1, "c": 1, "d": 2, "e": 0, "f": 5, "g": 4}
+
+
+@huge_test
+def test_incremental_update() -> None:
+	import shutil
+	from huge.repo import create_repository
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	create_repository()
+
+	def create_test_commit(commit_hash: str, parents: list[str]) -> None:
+		os.mkdir(os.path.join(COMMITS_DIRECTORY, commit_hash))
+
+		with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "parents"), "w") as f:
+			f.write("".join(f"{x}\n" for x in parents))
+
+		with open(os.path.join(COMMITS_DIRECTORY, commit_hash, "timestamp"), "w") as f:
+			f.write(f"2024-01-01T00:00:0{len(commit_hash)}+00:00")
+
+	create_test_commit("a", [])
+	create_test_commit("aaa", ["aa"])  # Parent arrives later, like from a partial fetch
+
+	graph = get_commit_graph()
+	assert graph.heads == {"a", "aaa"}
+
+	create_test_commit("aa", ["a"])
+
+	forget_commit_graph()
+
+	graph = get_commit_graph()
+	assert graph.heads == {"aaa"}
+	assert graph.generations == {"a": 1, "aa": 2, "aaa": 3}
+
+	# Graph has been stored and is read back the same
+	forget_commit_graph()
+	assert get_commit_graph() == graph
+
+	shutil.rmtree(os.path.join(COMMITS_DIRECTORY, "aaa"))
+
+	assert get_commit_graph().heads == {"aa"}
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,194 @@
+"""
+History of every path in the repository
+
+Finding all the versions of a single file would require reading the files of every commit. Instead,
+each commit is indexed once, when it is created or fetched, by storing the paths it changed in
+PATH_HISTORY_FOLDER.
+
+The paths are spread over 256 files, picked by the checksum of the path, so that looking up a path
+only requires reading a small part of the index. Each line is "path<TAB>commit hash<TAB>hash sum",
+where the hash sum is "-" if the commit deleted the path.
+
+The commits that has been indexed are listed in PATH_HISTORY_FOLDER/commits.
+"""
+import os
+from huge.testing import huge_test
+
+
+def update_path_history() -> None:
+	"""
+	Index the commits that has not been indexed yet
+	"""
+	from functools import lru_cache
+	from huge.repo.commit import get_commit_files
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.paths import COMMITS_DIRECTORY, PATH_HISTORY_FOLDER
+
+	graph = get_commit_graph()
+
+	commits_to_index = set(graph.parents) - _get_indexed_commits()
+
+	if not commits_to_index:
+		return
+
+	# Commits usually share parents with the commits indexed right before them
+	get_files = lru_cache(maxsize=16)(get_commit_files)
+
+	# {"shard": ["line\n", ...]}
+	lines: dict[str, list[str]] = {}
+
+	for commit_hash in sorted(commits_to_index, key=lambda x: graph.generations[x]):
+		# Parents we don't have the files of would make every path they differ in look changed, so
+		# commits are indexed when all their parents are there
+		parents = [x for x in graph.parents[commit_hash] if os.path.isfile(os.path.join(COMMITS_DIRECTORY, x, "files"))]
+
+		if len(parents) != len(graph.parents[commit_hash]):
+			commits_to_index.remove(commit_hash)
+			continue
+
+		commit_files = get_files(commit_hash)
+		parents_files = [get_files(x) for x in parents]
+
+		for path in set(commit_files).union(*parents_files):
+			file_hash = commit_files.get(path)
+
+			# Only store the paths that are different from all the parents
+			if parents_files and any(x.get(path) == file_hash for x in parents_files):
+				continue
+
+			lines.setdefault(_get_shard(path), []).append(f"{path}\t{commit_hash}\t{file_hash or '-'}\n")
+
+	if not os.path.isdir(PATH_HISTORY_FOLDER):
+		os.mkdir(PATH_HISTORY_FOLDER)
+
+	for shard, shard_lines in lines.items():
+		with open(os.path.join(PATH_HISTORY_FOLDER, shard), "a") as f:
+			f.writelines(shard_lines)
+
+	# Only mark the commits as indexed after all their paths has been written
+	with open(os.path.join(PATH_HISTORY_FOLDER, "commits"), "a") as f:
+		f.writelines(f"{x}\n" for x in commits_to_index)
+
+
+def get_path_history(path: str) -> list[tuple[str, str | None]]:
+	"""
+	Get the commits that changed a path, newest first
+
+	Returns: [("commit hash", "hash sum" or None if deleted), ...]
+	"""
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.paths import PATH_HISTORY_FOLDER
+
+	update_path_history()
+
+	path = os.path.normpath(path)
+	shard_path = os.path.join(PATH_HISTORY_FOLDER, _get_shard(path))
+
+	if not os.path.isfile(shard_path):
+		return []
+
+	# {"commit hash": "hash sum"}. A commit might have been indexed twice if interrupted.
+	result: dict[str, str | None] = {}
+
+	with open(shard_path) as f:
+		for x in f:
+			if x.startswith(f"{path}\t"):
+				_, commit_hash, file_hash = x.rstrip("\n").rsplit("\t", 2)
+				result[commit_hash] = None if file_hash == "-" else file_hash
+
+	graph = get_commit_graph()
+
+	return sorted(
+		((commit_hash, file_hash) for commit_hash, file_hash in result.items() if commit_hash in graph.parents),
+		key=lambda x: graph.timestamps[x[0]],
+		reverse=True,
+	)
+
+
+def _get_indexed_commits() -> set[str]:
+	from huge.repo.paths import PATH_HISTORY_FOLDER
+
+	if not os.path.isfile(os.path.join(PATH_HISTORY_FOLDER, "commits")):
+		return set()
+
+	with open(os.path.join(PATH_HISTORY_FOLDER, "commits")) as f:
+		return {x.strip() for x in f if x.strip()}
+
+
+def _get_shard(path: str) -> str:
+	import hashlib
+
+	return hashlib.md5(path.encode()).hexdigest()[:2]
+
+
+@huge_test
+def test_path_history() -> None:
+	from huge.repo import create_repository
+	import shutil
+	from huge.repo.commit import create_commit, get_current_commit
+	from huge.repo.paths import COMMITS_DIRECTORY, PATH_HISTORY_FOLDER
+	from huge.repo.stage import mark_as_staged
+
+	create_repository()
+
+	def commit(path: str, content: str | None) -> str:
+		if content is None:
+			os.remove(path)
+		else:
+			with open(path, "w") as f:
+				f.write(content)
+
+		mark_as_staged([path])
+		create_commit(None)
+		return get_current_commit()
+
+	first = commit("a", "First")
+	second = commit("b", "Other file")
+	third = commit("a", "Third")
+	fourth = commit("a", None)
+
+	a_history = get_path_history("./a")
+	assert [x[0] for x in a_history] == [fourth, third, first]
+	assert a_history[0][1] is None
+	assert a_history[1][1] != a_history[2][1]
+
+	assert len(get_path_history("b")) == 1
+	assert get_path_history("c") == []
+
+	# A commit whose parent is missing is not indexed until the parent is there
+	fifth = commit("b", "Changed")
+
+	shutil.rmtree(PATH_HISTORY_FOLDER)
+	os.rename(os.path.join(COMMITS_DIRECTORY, fourth), "fourth")
+
+	assert [x[0] for x in get_path_history("b")] == [second]
+
+	os.rename("fourth", os.path.join(COMMITS_DIRECTORY, fourth))
+
+	assert [x[0] for x in get_path_history("b")] == [fifth, second]
+	assert [x[0] for x in get_path_history("a")] == [fourth, third, first]
+
+	# A merge that brings "a" back as it was in third did not change it, but would look like it
+	# if indexed against fifth alone
+	with open("a", "w") as f:
+		f.write("Third")
+
+	mark_as_staged(["a"])
+	create_commit(None, merged_commit_hashes=(third,))
+	merge = get_current_commit()
+
+	shutil.rmtree(PATH_HISTORY_FOLDER)
+	os.rename(os.path.join(COMMITS_DIRECTORY, third), "third")
+
+	assert [x[0] for x in get_path_history("a")] == [first]
+
+	os.rename("third", os.path.join(COMMITS_DIRECTORY, third))
+
+	assert merge not in [x[0] for x in get_path_history("a")]
+	assert [x[0] for x in get_path_history("a")] == [fourth, third, first]
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,197 @@
+"""
+Journals of unfinished pushes and pulls
+
+Each remote has a journal for each direction, "push-journal" and "pull-journal" in its folder in
+REMOTES_FOLDER. A transfer writes down the files it is about to transfer, and then what happened to
+each batch of them as soon as it is known. If the command is stopped or a remote fails, running it
+again continues from the journal: files already transferred are not sent again, and the remote is not
+asked again for what it has.
+
+Each line is "state<TAB>hash sum". The newest line of a file decides its state. Lines are appended and
+synced to disk, so a half written last line is the worst that can happen, and it is ignored. The
+journal is removed when nothing in it is left to transfer.
+"""
+import os
+import threading
+from typing import Callable, TypeVar
+from huge.testing import huge_test
+
+# Planned, but not transferred yet
+QUEUED = "queued"
+
+# Transferred by us
+DONE = "done"
+
+# The remote had the file already, when pushing
+PRESENT = "present"
+
+# The remote did not have the file, when pulling
+MISSING = "missing"
+
+T = TypeVar("T")
+
+
+class TransferInterrupted(Exception):
+	"""
+	A transfer that failed in a way that may work if tried again, e.g a broken connection
+	"""
+
+
+class TransferJournal:
+	"""
+	The state of each file in the pushes or pulls with one remote
+
+	Usage:
+		journal = TransferJournal("push", remote_hash)
+		journal.mark(files_to_push, QUEUED)
+		...
+		journal.mark(files_pushed, DONE)
+		journal.close()
+	"""
+
+	def __init__(self, direction: str, remote_hash: str):
+		from huge.repo.paths import REMOTES_FOLDER
+
+		assert direction in ("push", "pull")
+
+		self.remote_hash = remote_hash
+		self.path = os.path.join(REMOTES_FOLDER, remote_hash, f"{direction}-journal")
+		self.states: dict[str, str] = {}
+		self.lock = threading.Lock()
+
+		if os.path.isfile(self.path):
+			with open(self.path) as f:
+				for x in f:
+					if x.endswith("\n") and len(parts := x.strip().split("\t")) == 2:
+						self.states[parts[1]] = parts[0]
+
+	def get_files(self, state: str) -> set[str]:
+		return {x for x, y in self.states.items() if y == state}
+
+	def mark(self, file_hashes: set[str], state: str) -> None:
+		"""
+		Write down the new state of files. Safe to call from several threads.
+		"""
+		if not file_hashes:
+			return
+
+		with self.lock, open(self.path, "a") as f:
+			f.writelines(f"{state}\t{x}\n" for x in file_hashes)
+			f.flush()
+			os.fsync(f.fileno())
+
+			self.states.update({x: state for x in file_hashes})
+
+	def close(self, needed: set[str] | None = None) -> None:
+		"""
+		Remove the journal if none of the needed files, or any files at all, are still queued
+		"""
+		queued = self.get_files(QUEUED)
+
+		if needed is not None:
+			queued &= needed
+
+		if not queued and os.path.isfile(self.path):
+			os.remove(self.path)
+			self.states.clear()
+
+
+def with_retries(function: Callable[[], T]) -> T:
+	"""
+	Call function, calling it again when it raises TransferInterrupted or OSError
+
+	Waits "remote.retry-delay" before the first retry, and twice as long before each of the next,
+	until "remote.retries" retries have been done. The last error is raised.
+	"""
+	import random
+	import time
+	from huge.repo.config import get_duration_config, get_int_config
+
+	retries = get_int_config("remote.retries")
+	delay = get_duration_config("remote.retry-delay")
+
+	for attempt in range(retries + 1):
+		try:
+			return function()
+		except (TransferInterrupted, OSError):
+			if attempt == retries:
+				raise
+
+		# Somewhat random, so that many transfers failing at once does not retry at once
+		time.sleep(delay * 2**attempt * random.uniform(.5, 1.5))
+
+	raise AssertionError
+
+
+@huge_test
+def test_transfer_journal() -> None:
+	from huge.repo import create_repository
+	from huge.repo.remote import add_remote, get_remotes
+
+	create_repository()
+	add_remote("remote")
+
+	remote_hash = next(get_remotes()).remote_hash
+
+	journal = TransferJournal("push", remote_hash)
+	journal.mark({"a", "b", "c"}, QUEUED)
+	journal.mark({"a"}, DONE)
+
+	# A line cut off when the command was stopped
+	with open(journal.path, "a") as f:
+		f.write(f"{DONE}\tb")
+
+	journal = TransferJournal("push", remote_hash)
+	assert journal.states == {"a": DONE, "b": QUEUED, "c": QUEUED}
+
+	# Only the files still needed keeps the journal
+	journal.close({"b"})
+	assert os.path.isfile(journal.path)
+
+	journal.close()
+	assert os.path.isfile(journal.path)
+
+	journal.mark({"b", "c"}, DONE)
+	journal.close()
+	assert not os.path.isfile(journal.path)
+	assert TransferJournal("push", remote_hash).states == {}
+
+
+@huge_test
+def test_with_retries() -> None:
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+
+	create_repository()
+	set_config("remote.retry-delay", "0s")
+
+	calls: list[int] = []
+
+	def flaky() -> str:
+		calls.append(1)
+
+		if len(calls) < 3:
+			raise TransferInterrupted("Connection lost")
+
+		return "ok"
+
+	assert with_retries(flaky) == "ok"
+	assert len(calls) == 3
+
+	def broken() -> None:
+		calls.append(1)
+		raise TransferInterrupted("Connection lost")
+
+	calls.clear()
+
+	try:
+		with_retries(broken)
+		assert False
+	except TransferInterrupted:
+		assert len(calls) == 4
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
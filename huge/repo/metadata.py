@@ -0,0 +1,202 @@
+"""
+Metadata about each file in FILES_DIRECTORY
+
+Kept beside the storage index, which has the sizes, as one log per kind of event:
+
+	STORED_FILE    When the file was put into the storage
+	VERIFIED_FILE  When the content of the file was last hashed and found to be correct
+	ACCESS_FILE    When the file was last used, e.g checked out
+
+Each line is "hash sum<TAB>unix timestamp". New lines are appended when something happens to the
+files, and a log is rewritten with only the newest entry of each stored file when it grows too large.
+Files stored before the logs existed have no entries, and are treated as being from long ago.
+"""
+import os
+from dataclasses import dataclass
+from huge.testing import huge_test
+
+
+@dataclass
+class FileMetadata:
+	size: int
+
+	# Unix timestamps, or 0 if unknown
+	stored_at: int
+	verified_at: int
+	accessed_at: int
+
+
+def get_file_metadata(file_hashes: set[str] | None = None) -> dict[str, FileMetadata]:
+	"""
+	Get the metadata of the stored files, or only of some of them
+
+	Files that are not stored are left out.
+	"""
+	from huge.repo.paths import ACCESS_FILE, STORED_FILE, VERIFIED_FILE
+	from huge.repo.storage import get_stored_files
+
+	stored_files = get_stored_files()
+
+	if file_hashes is None:
+		file_hashes = set(stored_files)
+
+	stored_at = _read_times(STORED_FILE)
+	verified_at = _read_times(VERIFIED_FILE)
+	accessed_at = _read_times(ACCESS_FILE)
+
+	return {
+		file_hash: FileMetadata(
+			size=stored_files[file_hash],
+			stored_at=stored_at.get(file_hash, 0),
+			verified_at=verified_at.get(file_hash, 0),
+			accessed_at=accessed_at.get(file_hash, 0),
+		)
+		for file_hash in file_hashes
+		if file_hash in stored_files
+	}
+
+
+def record_stored(file_hashes: set[str], path: str = ".") -> None:
+	"""
+	Mark files as just put into the storage of a repository
+	"""
+	from huge.repo.paths import STORED_FILE
+
+	_append_times(os.path.join(path, STORED_FILE), file_hashes, path)
+
+
+def record_verified(file_hashes: set[str]) -> None:
+	"""
+	Mark files as just hashed and found to be correct
+	"""
+	from huge.repo.paths import VERIFIED_FILE
+
+	_append_times(VERIFIED_FILE, file_hashes)
+
+
+def record_access(file_hashes: set[str]) -> None:
+	"""
+	Mark files as used just now, e.g when checked out
+	"""
+	from huge.repo.paths import ACCESS_FILE
+
+	_append_times(ACCESS_FILE, file_hashes)
+
+
+def get_access_times() -> dict[str, int]:
+	"""
+	Get when files were last used
+
+	Returns: {"hash sum": unix timestamp}
+	"""
+	from huge.repo.paths import ACCESS_FILE
+
+	return _read_times(ACCESS_FILE)
+
+
+def get_verify_times() -> dict[str, int]:
+	"""
+	Get when files were last found to be correct
+
+	Returns: {"hash sum": unix timestamp}
+	"""
+	from huge.repo.paths import VERIFIED_FILE
+
+	return _read_times(VERIFIED_FILE)
+
+
+def compact_metadata(path: str = ".") -> None:
+	"""
+	Rewrite the logs with a single line for each file that is still stored
+	"""
+	from huge.repo.paths import ACCESS_FILE, STORED_FILE, VERIFIED_FILE
+
+	for log_path in [STORED_FILE, VERIFIED_FILE, ACCESS_FILE]:
+		_compact_times(os.path.join(path, log_path), path)
+
+
+def _append_times(log_path: str, file_hashes: set[str], path: str = ".") -> None:
+	import time
+	from huge.repo.storage import get_stored_files
+
+	if not file_hashes:
+		return
+
+	now = int(time.time())
+
+	with open(log_path, "a") as f:
+		f.writelines(f"{file_hash}\t{now}\n" for file_hash in file_hashes)
+
+	# Keep the log from growing forever. A line is about 45 bytes.
+	if os.path.getsize(log_path) > 2**20 + 4 * 45 * len(get_stored_files(path)):
+		_compact_times(log_path, path)
+
+
+def _read_times(log_path: str) -> dict[str, int]:
+	result: dict[str, int] = {}
+
+	if os.path.isfile(log_path):
+		with open(log_path) as f:
+			for x in f:
+				file_hash, timestamp = x.split("\t")
+				result[file_hash] = max(int(timestamp), result.get(file_hash, 0))
+
+	return result
+
+
+def _compact_times(log_path: str, path: str = ".") -> None:
+	from huge.repo import atomic_write
+	from huge.repo.storage import get_stored_files
+
+	if not os.path.isfile(log_path):
+		return
+
+	stored_files = get_stored_files(path)
+
+	times = {x: y for x, y in _read_times(log_path).items() if x in stored_files}
+
+	with atomic_write(log_path) as f:
+		f.writelines(f"{file_hash}\t{timestamp}\n" for file_hash, timestamp in times.items())
+
+
+@huge_test
+def test_file_metadata() -> None:
+	from huge.repo import create_repository
+	from huge.repo.paths import ACCESS_FILE, FILES_DIRECTORY
+	from huge.repo.storage import add_stored_files, remove_stored_files
+
+	create_repository()
+
+	for x in "ab":
+		with open(os.path.join(FILES_DIRECTORY, x * 32), "w") as f:
+			f.write(x * 10)
+
+	add_stored_files({"a" * 32, "b" * 32})
+
+	record_verified({"a" * 32})
+
+	with open(ACCESS_FILE, "a") as f:
+		f.write(f"{'b' * 32}\t100\n{'b' * 32}\t50\n{'c' * 32}\t100\n")
+
+	metadata = get_file_metadata()
+	assert set(metadata) == {"a" * 32, "b" * 32}
+	assert metadata["a" * 32].size == 10
+	assert metadata["a" * 32].stored_at > 0
+	assert metadata["a" * 32].verified_at >= metadata["a" * 32].stored_at
+	assert metadata["a" * 32].accessed_at == 0
+	assert metadata["b" * 32].verified_at == 0
+	assert metadata["b" * 32].accessed_at == 100
+
+	os.remove(os.path.join(FILES_DIRECTORY, "b" * 32))
+	remove_stored_files({"b" * 32})
+
+	compact_metadata()
+
+	assert get_access_times() == {}
+	assert set(get_verify_times()) == {"a" * 32}
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,227 @@
+"""
+Sending many small files as a single tar stream over SSH
+
+rsync negotiates each file on its own, which is slower than the connection when there are hundreds
+of thousands of small files. Batches of files that are small on average, below "remote.pack-size",
+are instead sent as one tar stream through the shared SSH connection. Only a POSIX shell, GNU tar
+and md5sum are needed on the server, no agent.
+
+The receiver unpacks into the staging area, and only moves a file into FILES_DIRECTORY after checking
+that its content matches its hash sum. Files that do not match are left out, and sent again later.
+"""
+import shlex
+import subprocess
+from typing import BinaryIO
+from huge.repo.address import SSHAddress
+from huge.testing import huge_test
+
+# Run on the server with the path of the repository. Unpacks into a folder of its own in the staging
+# area, moves the files with correct content into the storage and prints their hash sums. Files stored
+# compressed, see huge.repo.encoding, are checked by decompressing them.
+_RECEIVE_SCRIPT = """
+set -e
+cd {path}/.huge
+mkdir -p staging
+d=$(mktemp -d staging/pack.XXXXXX)
+trap 'rm -rf "$d" "$d.verified"' EXIT
+tar -x -C "$d" -f -
+(cd "$d" && ls | xargs -r md5sum) | awk '$1 == $2 {{ print $2 }}' > "$d.verified"
+(cd "$d" && ls) | grep -vxF -f "$d.verified" | while read f; do
+	[ "$(zstd -d -q -c --long=27 < "$d/$f" 2>/dev/null | md5sum | cut -c 1-32)" != "$f" ] || echo "$f"
+done >> "$d.verified"
+(cd "$d" && xargs -r sh -c 'mv "$@" ../../storage/' sh) < "$d.verified"
+cat "$d.verified"
+"""
+
+# Run on the server with the path of the repository. Packs the files listed on stdin, leaving out
+# the ones it doesn't have.
+_SEND_SCRIPT = """
+cd {path}/.huge/storage && tar -c --ignore-failed-read -f - -T - 2>/dev/null
+"""
+
+
+def use_pack(sizes: list[int]) -> bool:
+	"""
+	Whether files of these sizes should be sent as a tar stream rather than with rsync
+	"""
+	from huge.repo.config import get_size_config
+
+	return bool(sizes) and sum(sizes) / len(sizes) < (get_size_config("remote.pack-size") or 0)
+
+
+def push_pack(address: SSHAddress, file_hashes: list[str]) -> set[str]:
+	"""
+	Send files from FILES_DIRECTORY to the storage of a remote as a tar stream
+
+	Returns the files the remote stored. Raises TransferInterrupted if the transfer failed.
+	"""
+	return _push_pack(_remote_command(address, _RECEIVE_SCRIPT), file_hashes)
+
+
+def pull_pack(address: SSHAddress, file_hashes: list[str]) -> set[str]:
+	"""
+	Get files from the storage of a remote as a tar stream into FILES_DIRECTORY
+
+	Returns the files received, which must be added to the storage index by the caller. Files the
+	remote doesn't have, or that were damaged on the way, are left out. Raises TransferInterrupted
+	if the transfer failed.
+	"""
+	return _pull_pack(_remote_command(address, _SEND_SCRIPT), file_hashes)
+
+
+def write_pack(stream: BinaryIO, file_hashes: list[str]) -> None:
+	"""
+	Write files from FILES_DIRECTORY to stream as a tar archive
+	"""
+	import os
+	import tarfile
+	from huge.repo.paths import FILES_DIRECTORY
+
+	with tarfile.open(fileobj=stream, mode="w|") as tar:
+		for file_hash in file_hashes:
+			tar.add(os.path.join(FILES_DIRECTORY, file_hash), arcname=file_hash, recursive=False)
+
+
+def receive_pack(stream: BinaryIO, file_hashes: set[str], path: str = ".") -> set[str]:
+	"""
+	Read a tar archive of files into the storage of a repository, checking the content of each
+
+	Returns the files stored. Anything else in the archive is skipped.
+	"""
+	import tarfile
+	from huge.repo.agent import CHUNK_SIZE
+	from huge.repo.staging import stage_stream
+
+	received: set[str] = set()
+
+	with tarfile.open(fileobj=stream, mode="r|") as tar:
+		for member in tar:
+			if not member.isfile() or member.name not in file_hashes:
+				continue
+
+			f = tar.extractfile(member)
+
+			if stage_stream(member.name, iter(lambda: f.read(CHUNK_SIZE), b""), 0, path):
+				received.add(member.name)
+
+	return received
+
+
+def _remote_command(address: SSHAddress, script: str) -> list[str]:
+	from huge.repo.ssh import ssh_shell_command
+
+	return ssh_shell_command(address, script.format(path=shlex.quote(address.path)))
+
+
+def _push_pack(command: list[str], file_hashes: list[str]) -> set[str]:
+	from huge.repo.journal import TransferInterrupted
+
+	process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+	try:
+		write_pack(process.stdin, file_hashes)
+		process.stdin.close()
+	except BrokenPipeError:
+		pass  # The receiver stopped, which is reported below
+
+	stored = process.stdout.read().decode().split()
+
+	if process.wait():
+		raise TransferInterrupted(f"Sending the files as a tar stream failed with code {process.returncode}")
+
+	return set(stored) & set(file_hashes)
+
+
+def _pull_pack(command: list[str], file_hashes: list[str]) -> set[str]:
+	import tarfile
+	import threading
+	from huge.repo.journal import TransferInterrupted
+
+	process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+	# Written from another thread, as tar starts sending before it has the whole list
+	def write_list() -> None:
+		try:
+			process.stdin.write("".join(f"{x}\n" for x in file_hashes).encode())
+			process.stdin.close()
+		except BrokenPipeError:
+			pass
+
+	writer = threading.Thread(target=write_list)
+	writer.start()
+
+	try:
+		received = receive_pack(process.stdout, set(file_hashes))
+	except tarfile.TarError as exception:
+		process.kill()
+		raise TransferInterrupted(f"Receiving the files as a tar stream failed: {exception}")
+	finally:
+		writer.join()
+
+	if process.wait():
+		raise TransferInterrupted(f"Receiving the files as a tar stream failed with code {process.returncode}")
+
+	return received
+
+
+@huge_test
+def test_pack() -> None:
+	import hashlib
+	import os
+	import shutil
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.encoding import compress_file
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+	from huge.testing import cd
+
+	create_repository()
+	set_config("storage.compression", "3")
+
+	file_hashes = []
+
+	for content in [b"a", b"b" * 1000, b"c" * 100000]:
+		file_hashes.append(hashlib.md5(content).hexdigest())
+
+		with open(os.path.join(FILES_DIRECTORY, file_hashes[-1]), "wb") as f:
+			f.write(content)
+
+	# Stored compressed files are sent as they are
+	assert compress_file(os.path.join(FILES_DIRECTORY, file_hashes[-1]), file_hashes[-1])
+
+	# Pretends to have a file that is damaged
+	shutil.copy(os.path.join(FILES_DIRECTORY, file_hashes[0]), os.path.join(FILES_DIRECTORY, "f" * 32))
+
+	os.mkdir("remote")
+
+	with cd("remote"):
+		create_repository()
+
+	# Run the scripts locally instead of on a server
+	def command(script: str) -> list[str]:
+		return ["sh", "-c", script.format(path=shlex.quote(os.path.abspath("remote")))]
+
+	assert _push_pack(command(_RECEIVE_SCRIPT), file_hashes + ["f" * 32]) == set(file_hashes)
+	assert sorted(os.listdir("remote/.huge/storage")) == sorted(file_hashes)
+	assert os.listdir(f"remote/{STAGING_FOLDER}") == []
+
+	for file_hash in file_hashes:
+		os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+
+	assert _pull_pack(command(_SEND_SCRIPT), file_hashes + ["e" * 32]) == set(file_hashes)
+
+	with open(os.path.join(FILES_DIRECTORY, file_hashes[1]), "rb") as f:
+		assert f.read() == b"b" * 1000
+
+	assert use_pack([10, 20])
+	assert not use_pack([2**30])
+	assert not use_pack([])
+
+	set_config("remote.pack-size", "0")
+	assert not use_pack([10])
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
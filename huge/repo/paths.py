@@ -29,3 +29,42 @@ REMOTES_FOLDER = os.path.join(HUGE_DIRECTORY, "remotes")
 
 # Local information on current staged files
 STAGED_FILE = os.path.join(HUGE_DIRECTORY, "stage")
+
+# Index of the files in FILES_DIRECTORY, with their sizes
+STORAGE_INDEX_FILE = os.path.join(HUGE_DIRECTORY, "storage_index")
+
+# Log of the files added to and removed from the index, for remotes to follow
+STORAGE_LOG_FILE = os.path.join(HUGE_DIRECTORY, "storage_log")
+
+# Parents, timestamps and generation numbers of all commits
+COMMIT_GRAPH_FILE = os.path.join(HUGE_DIRECTORY, "graph")
+
+# Index of which commits changed which paths
+PATH_HISTORY_FOLDER = os.path.join(HUGE_DIRECTORY, "history")
+
+# Index of which commits that points at each file in FILES_DIRECTORY
+REFERENCES_FOLDER = os.path.join(HUGE_DIRECTORY, "references")
+
+# Settings for this repository
+CONFIG_FILE = os.path.join(HUGE_DIRECTORY, "config")
+
+# When the files in FILES_DIRECTORY were last used
+ACCESS_FILE = os.path.join(HUGE_DIRECTORY, "access")
+
+# When the files in FILES_DIRECTORY were stored
+STORED_FILE = os.path.join(HUGE_DIRECTORY, "stored")
+
+# When the files in FILES_DIRECTORY were last found to be correct
+VERIFIED_FILE = os.path.join(HUGE_DIRECTORY, "verified")
+
+# Progress of an unfinished garbage collection
+GC_FOLDER = os.path.join(HUGE_DIRECTORY, "gc")
+
+# Progress of an unfinished verification
+VERIFY_FOLDER = os.path.join(HUGE_DIRECTORY, "verify")
+
+# Result of the last verification, as JSON
+VERIFY_REPORT_FILE = os.path.join(HUGE_DIRECTORY, "verify.json")
+
+# Files partly received from other repositories, kept for the transfer to continue later
+STAGING_FOLDER = os.path.join(HUGE_DIRECTORY, "staging")
@@ -1,111 +1,724 @@
 """
 Pulling commit files from remote repositories
+
+The files are split between the remotes before anything is transferred, using what we know about
+them from earlier: which files they have, from the coverage files, and how fast they have been, from
+their measured bandwidth. As few remotes as possible are used to get all the files, and more are only
+added when they can take a large enough share of the work to be worth the extra connection.
+
+All the planned remotes are pulled from at the same time, each with "remote.streams" batches at a
+time, limited in count and size like in huge.repo.transfer. Each stream takes the smallest files and
+the largest files in turns, so that small files keep coming while large ones are transferred. Batches
+of small files from SSH remotes without an agent are sent as a tar stream, see huge.repo.pack, and
+large files from them and from local remotes in ranges over several streams, see huge.repo.ranges.
+
+A remote that runs out of work takes files
+from the remote with the most work left, if it has them, so that a slow remote does not hold up the
+pull. Files a remote fails to deliver are handed to another remote that has not tried them yet.
+
+Which remote each file was given to, and which remotes did not have it, is kept in the journals of
+the remotes, see huge.repo.journal. A pull that was stopped continues with the same plan when run
+again, and does not ask remotes again for files they did not have.
 """
 import os
+import threading
+from dataclasses import dataclass, field
 from huge.repo.address import PathAddress, SSHAddress
+from huge.repo.journal import TransferJournal
+from huge.repo.remote import RemoteInfo
+from huge.testing import huge_test
+
+# Bandwidth assumed for remotes that have never been measured, in bytes per second
+DEFAULT_BANDWIDTH = 10 * 2**20
+
+# A remote that is not needed to get all the files is only used if it gets at least this much
+STRIPE_MIN_BYTES = 64 * 2**20
 
+# Size assumed for files when no remote we can look into has them
+DEFAULT_FILE_SIZE = 2**20
 
-def pull_commit(commits: list[str], remotes: list[str]) -> None:
-	from huge import output
-	from huge.repo.address import PathAddress, parse_address
+# Measurements of less than this are too noisy to be recorded as the bandwidth of a remote
+BANDWIDTH_MIN_BYTES = 2**20
+
+
+class PullError(Exception):
+	pass
+
+
+def pull_commit(commits: list[str], remotes: list[RemoteInfo]) -> None:
+	from huge import error
 	from huge.repo.commit import get_commit_files
-	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.metadata import record_access
+	from huge.repo.quota import enforce_quota
+	from huge.repo.storage import get_stored_files
 
 	assert commits
 	assert remotes
 
 	# Make a list of all the file checksums we need
-	remaining_files = {
+	wanted_files = {
 		file_hash
 		for commit in commits
 		for file_hash in get_commit_files(commit).values()
 	}
 
 	# Then remove the files we already have locally
-	remaining_files -= set(os.listdir(FILES_DIRECTORY))
+	wanted_files -= get_stored_files().keys()
+
+	remaining_files = set(wanted_files)
+
+	if remaining_files:
+		_Scheduler(remotes, remaining_files).run()
+
+	# Pulled files are likely to be checked out soon, so they should not be evicted first
+	record_access(wanted_files - remaining_files)
+	enforce_quota()
+
+	if remaining_files:
+		error("Not able to retrieve all required files.")
+
+
+def plan_pull(
+	file_sizes: dict[str, int],
+	coverages: dict[str, set[str] | None],
+	bandwidths: dict[str, float],
+) -> dict[str, list[str]]:
+	"""
+	Decide which remote each file is pulled from
+
+	coverages are the files each remote has, or None if unknown. Remotes with unknown coverage are
+	assumed to have everything, but are used last. Files no remote is known to have may be from any.
+
+	Returns: {"remote": ["hash sum", ...]}, with the largest files first. Remotes not used are left out.
+	"""
+	holders = {file_hash: _get_holders(file_hash, coverages) for file_hash in file_sizes}
+
+	# Greedy set cover: take the remote with the most bytes we still need, until all are covered
+	chosen: list[str] = []
+	uncovered = set(file_sizes)
+
+	while uncovered:
+		best = max(
+			(x for x in coverages if x not in chosen),
+			key=lambda x: (
+				sum(file_sizes[y] for y in uncovered if x in holders[y]),
+				coverages[x] is not None,
+				bandwidths[x],
+			),
+		)
+
+		chosen.append(best)
+		uncovered = {x for x in uncovered if best not in holders[x]}
+
+	# Spread the work to more remotes, if they would get enough of it
+	for remote in sorted((x for x in coverages if x not in chosen), key=lambda x: -bandwidths[x]):
+		plan = _balance(file_sizes, holders, bandwidths, chosen + [remote])
+
+		if sum(file_sizes[x] for x in plan.get(remote, [])) >= STRIPE_MIN_BYTES:
+			chosen.append(remote)
+
+	return _balance(file_sizes, holders, bandwidths, chosen)
+
+
+def _get_holders(file_hash: str, coverages: dict[str, set[str] | None]) -> set[str]:
+	known = {x for x, y in coverages.items() if y is not None and file_hash in y}
+	unknown = {x for x, y in coverages.items() if y is None}
+
+	return known or unknown or set(coverages)
+
+
+def _balance(
+	file_sizes: dict[str, int],
+	holders: dict[str, set[str]],
+	bandwidths: dict[str, float],
+	remotes: list[str],
+) -> dict[str, list[str]]:
+	"""
+	Give each file to the remote that would be done with it first, taking the largest files first
+	"""
+	load = {x: 0 for x in remotes}
+	result: dict[str, list[str]] = {}
+
+	for file_hash in sorted(file_sizes, key=lambda x: (-file_sizes[x], x)):
+		candidates = [x for x in remotes if x in holders[file_hash]] or remotes
+
+		remote = min(candidates, key=lambda x: (load[x] + file_sizes[file_hash]) / bandwidths[x])
+
+		load[remote] += file_sizes[file_hash]
+		result.setdefault(remote, []).append(file_hash)
+
+	return result
+
+
+@dataclass
+class _Source:
+	"""
+	A remote being pulled from
+	"""
+	remote: RemoteInfo
+	address: PathAddress | SSHAddress
+
+	# Files the remote has, as far as we know, or None if unknown
+	coverage: set[str] | None
+	bandwidth: float
+	journal: TransferJournal
+
+	# Files waiting to be pulled from this remote
+	queue: list[str] = field(default_factory=list)
+
+	# How many batches may be pulled at the same time, and how many are
+	streams: int = 1
+	workers: int = 0
+
+	# Whether the next batch is of the largest files in the queue instead of the smallest
+	take_large: bool = False
+
+	started: bool = False
+	error: str | None = None
 
-	for remote in remotes:
-		if not remaining_files:
-			break  # Got all the files, no reason to get from other remotes
+	# Whether the agent of the remote has been checked to serve our repository
+	checked: bool = False
 
-		# TODO merayen exit this loop when all files have been retrieved
+	bytes_received: int = 0
+	seconds: float = 0
 
-		address = parse_address(remote.address)
 
-		output(f"Pulling files from {address}")
+class _Scheduler:
+	"""
+	Runs a pull from several remotes, moving work between them as they finish or fail
+	"""
 
-		if isinstance(address, PathAddress):
-			_local_pull(
+	def __init__(self, remotes: list[RemoteInfo], remaining_files: set[str]):
+		from huge.repo.address import parse_address
+		from huge.repo.config import get_config, get_int_config, get_size_config
+		from huge.repo.coverage import get_remote_coverage
+		from huge.repo.journal import MISSING
+		from huge.repo.remote import get_remote_bandwidth
+		from huge.repo.paths import HUGE_DIRECTORY
+		from huge.repo.storage import get_stored_files
+
+		self.remaining_files = remaining_files
+		self.condition = threading.Condition()
+		self.sources: list[_Source] = []
+
+		# {"hash sum": {"remote hash", ...}} of the remotes that has failed to deliver each file
+		self.tried: dict[str, set[str]] = {x: set() for x in remaining_files}
+
+		self.sizes: dict[str, int] = {}
+
+		self.batch_files = get_int_config("remote.batch-files")
+		self.batch_size = get_size_config("remote.batch-size")
+
+		for remote in remotes:
+			address = parse_address(remote.address)
+
+			if not isinstance(address, (PathAddress, SSHAddress)):
+				raise NotImplementedError
+
+			coverage = get_remote_coverage(remote.remote_hash)
+
+			# Local remotes can be looked into directly, which also tells the sizes of the files
+			if isinstance(address, PathAddress) and os.path.isdir(os.path.join(address.path, HUGE_DIRECTORY)):
+				stored_files = get_stored_files(address.path)
+				coverage = set(stored_files)
+				self.sizes.update({x: stored_files[x] for x in remaining_files & coverage})
+
+			source = _Source(
+				remote=remote,
 				address=address,
-				remaining_files=remaining_files,
+				coverage=coverage,
+				bandwidth=get_remote_bandwidth(remote.remote_hash) or DEFAULT_BANDWIDTH,
+				journal=TransferJournal("pull", remote.remote_hash),
+
+				# An agent is a single session, that can only do one thing at a time
+				streams=(
+					1 if isinstance(address, SSHAddress) and get_config("remote.agent") else
+					get_int_config("remote.streams")
+				),
 			)
 
-		elif isinstance(address, SSHAddress):
-			_remote_pull(
-				address=address,
-				remaining_files=remaining_files,
+			for file_hash in source.journal.get_files(MISSING) & remaining_files:
+				self.tried[file_hash].add(remote.remote_hash)
+
+			self.sources.append(source)
+
+		average_size = sum(self.sizes.values()) // len(self.sizes) if self.sizes else DEFAULT_FILE_SIZE
+
+		for file_hash in remaining_files - self.sizes.keys():
+			self.sizes[file_hash] = average_size
+
+	def run(self) -> None:
+		from concurrent.futures import ThreadPoolExecutor
+		from huge.repo.journal import QUEUED
+		from huge.repo.remote import record_remote_bandwidth
+
+		sources = {x.remote.remote_hash: x for x in self.sources}
+
+		# Files given to a remote by a pull that was stopped stay with it
+		resumed: dict[str, list[str]] = {}
+		unplanned = set(self.remaining_files)
+
+		for source in self.sources:
+			if files := source.journal.get_files(QUEUED) & unplanned:
+				resumed[source.remote.remote_hash] = sorted(files, key=lambda x: -self.sizes[x])
+				unplanned -= files
+
+		plan = plan_pull(
+			{x: self.sizes[x] for x in unplanned},
+			{x.remote.remote_hash: x.coverage for x in self.sources},
+			{x.remote.remote_hash: x.bandwidth for x in self.sources},
+		)
+
+		for remote_hash, files in resumed.items():
+			plan[remote_hash] = files + plan.get(remote_hash, [])
+
+		# Progress from several rsyncs at the same time would be garbled
+		self.progress = len(plan) == 1 and all(x.streams == 1 for x in self.sources)
+
+		with ThreadPoolExecutor(max_workers=sum(x.streams for x in self.sources)) as executor:
+			self.executor = executor
+			self.futures = []
+
+			with self.condition:
+				for source in self.sources:
+					if files := plan.get(source.remote.remote_hash):
+						source.journal.mark(set(files), QUEUED)
+						source.queue.extend(files)
+						self._start(source)
+
+				while any(x.workers for x in self.sources):
+					self.condition.wait()
+
+			for future in self.futures:
+				future.result()
+
+		for remote_hash, source in sources.items():
+			if source.bytes_received >= BANDWIDTH_MIN_BYTES:
+				record_remote_bandwidth(remote_hash, source.bytes_received, source.seconds)
+
+			source.journal.close(self.remaining_files)
+
+	def _start(self, source: _Source) -> None:
+		"""
+		Start threads working through the queue of a source, up to its number of streams. Must hold
+		the lock.
+		"""
+		from huge import output
+
+		if not source.started:
+			output(f"Pulling files from {source.address}")
+			source.started = True
+
+		while source.workers < min(source.streams, len(source.queue)):
+			source.workers += 1
+			self.futures.append(self.executor.submit(self._work, source))
+
+	def _work(self, source: _Source) -> None:
+		import time
+		from huge import error
+		from huge.repo.agent import AgentError
+		from huge.repo.journal import DONE, MISSING, TransferInterrupted, with_retries
+		from huge.repo.pack import use_pack
+		from huge.repo.paths import FILES_DIRECTORY
+		from huge.repo.storage import add_stored_files
+
+		done = False
+
+		try:
+			while batch := self._next_batch(source):
+				started = time.monotonic()
+
+				failure: str | None = None
+				pack = use_pack([self.sizes[x] for x in batch])
+
+				try:
+					received = with_retries(lambda: _pull_batch(source, batch, self.progress, pack))
+				except (PullError, TransferInterrupted, AgentError, OSError) as exception:
+					received = set()
+					failure = str(exception)
+
+				with self.condition:
+					# Reported once, even if several streams fail
+					if failure is not None and source.error is None:
+						source.error = failure
+						error(f"Could not transfer files from {source.address}: {failure}")
+
+					add_stored_files(received)
+
+					source.journal.mark(received, DONE)
+
+					if source.error is None:
+						source.journal.mark(batch - received, MISSING)
+
+					source.seconds += time.monotonic() - started
+					source.bytes_received += sum(
+						os.path.getsize(os.path.join(FILES_DIRECTORY, x)) for x in received
+					)
+
+					self.remaining_files -= received
+
+					for file_hash in batch - received:
+						self.tried[file_hash].add(source.remote.remote_hash)
+						self._reassign(file_hash)
+
+					if source.error is not None:
+						for file_hash in source.queue:
+							self._reassign(file_hash)
+
+						source.queue.clear()
+						break
+
+			done = True
+
+		finally:
+			with self.condition:
+				# Work might have been handed to us after we stopped looking
+				if done and source.queue and source.error is None:
+					self.futures.append(self.executor.submit(self._work, source))
+				else:
+					source.workers -= 1
+					self.condition.notify_all()
+
+	def _next_batch(self, source: _Source) -> set[str]:
+		"""
+		Take the next files to pull from a source's queue, or from another source with more work left
+		"""
+		with self.condition:
+			if not source.queue and (stolen := self._steal(source)):
+				source.journal.mark(set(stolen), QUEUED)
+				source.queue.extend(stolen)
+
+			source.queue.sort(key=lambda x: self.sizes[x])
+
+			index = -1 if source.take_large else 0
+			source.take_large = not source.take_large
+
+			batch: set[str] = set()
+			batch_bytes = 0
+
+			while source.queue and len(batch) < self.batch_files:
+				if batch and batch_bytes + self.sizes[source.queue[index]] > self.batch_size:
+					break
+
+				file_hash = source.queue.pop(index)
+				batch.add(file_hash)
+				batch_bytes += self.sizes[file_hash]
+
+			return batch
+
+	def _steal(self, thief: _Source) -> list[str]:
+		"""
+		Take half of the files the thief has from the queue of the source with the most work left
+		"""
+		def remaining_time(source: _Source) -> float:
+			return sum(self.sizes[x] for x in source.queue) / source.bandwidth
+
+		def can_take(file_hash: str) -> bool:
+			return (
+				thief.remote.remote_hash not in self.tried[file_hash] and
+				(thief.coverage is None or file_hash in thief.coverage)
 			)
 
-		else:
-			raise NotImplementedError
+		for victim in sorted(self.sources, key=remaining_time, reverse=True):
+			if victim is thief or not victim.queue:
+				continue
 
-	if remaining_files:
-		error("Not able to retrieve all required files.")
+			# Take from the end, the victim will soon be busy with the start of its queue
+			stolen = [x for x in victim.queue if can_take(x)][-((len(victim.queue) + 1) // 2):]
 
+			if stolen:
+				taken = set(stolen)
+				victim.queue[:] = [x for x in victim.queue if x not in taken]
+				return stolen
 
-def _remote_pull(address: SSHAddress, remaining_files: set[str]) -> None:
-	import shutil
+		return []
+
+	def _reassign(self, file_hash: str) -> None:
+		"""
+		Hand a file that was not delivered to another remote that may have it. Must hold the lock.
+		"""
+		from huge.repo.journal import QUEUED
+
+		candidates = [
+			x for x in self.sources
+			if x.error is None and x.remote.remote_hash not in self.tried[file_hash]
+		]
+
+		if not candidates:
+			return  # No one left to ask
+
+		# Remotes that are known to have it comes first, then the ones we know nothing about. The rest
+		# are still asked, as their coverage may be outdated.
+		def order(source: _Source) -> tuple[int, float]:
+			return (
+				0 if source.coverage is not None and file_hash in source.coverage else
+				1 if source.coverage is None else
+				2,
+				sum(self.sizes[x] for x in source.queue + [file_hash]) / source.bandwidth,
+			)
+
+		source = min(candidates, key=order)
+		source.journal.mark({file_hash}, QUEUED)
+		source.queue.append(file_hash)
+
+		self._start(source)
+
+
+def _pull_batch(source: _Source, file_hashes: set[str], progress: bool, pack: bool = False) -> set[str]:
+	"""
+	Download files from a source into FILES_DIRECTORY, through the staging area
+
+	SSH remotes without an agent send the files as a tar stream when pack is set, instead of with
+	rsync.
+
+	Returns the files received, which must be added to the storage index by the caller. Files the
+	remote doesn't have, or that were damaged on the way, are left out.
+	"""
+	from huge.repo.ssh import connect_agent
+
+	if isinstance(source.address, PathAddress):
+		return _local_pull(source.address, file_hashes)
+
+	if agent := connect_agent(source.address):
+		if not source.checked:
+			agent.check_repository()
+			source.checked = True
+
+		return agent.get_files(file_hashes)
+
+	if pack:
+		from huge.repo.pack import pull_pack
+
+		return pull_pack(source.address, sorted(file_hashes))
+
+	return _remote_pull(source, file_hashes, progress)
+
+
+def _remote_pull(source: _Source, file_hashes: set[str], progress: bool) -> set[str]:
 	import subprocess
-	import tempfile
-	from huge import error
+	from huge.repo.compression import get_compression_level, rsync_compression
+	from huge.repo.config import get_size_config
+	from huge.repo.journal import TransferInterrupted
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+	from huge.repo.ranges import get_remote_sizes, pull_ranged
+	from huge.repo.ssh import rsync_address, rsync_command
+	from huge.repo.staging import store_verified
+
+	address = source.address
+	range_size = get_size_config("remote.range-size") or 0
+
+	# Interrupted files are kept by rsync in the partial folder, and continued from on the next try
+	directory = os.path.join(STAGING_FOLDER, "rsync")
+	os.makedirs(directory, exist_ok=True)
+
+	process = subprocess.Popen(
+		rsync_command() +
+
+		# Files the remote doesn't have are skipped, so the remote doesn't need to be listed first
+		["-ah", "--ignore-missing-args", "--partial-dir=.partial", "--files-from=-"] +
+		(["--info=progress2"] if progress else []) +
+
+		# Large files are skipped, to be pulled in ranges below
+		([f"--max-size={range_size}"] if range_size else []) +
+		rsync_compression(get_compression_level(source.remote.remote_hash)) +
+
+		# The files are listed on stdin, relative to the source folder
+		[rsync_address(address, f"{address.path}/{FILES_DIRECTORY}/"), f"{directory}/"],
+		stdin=subprocess.PIPE,
+	)
+
+	process.communicate("".join(f"{x}\n" for x in file_hashes).encode())
+
+	if process.returncode:
+		raise TransferInterrupted(f"rsync failed with code {process.returncode}")
+
+	received = {
+		file_hash
+		for file_hash in file_hashes & set(os.listdir(directory))
+		if store_verified(os.path.join(directory, file_hash), file_hash)
+	}
+
+	# The remote is only asked for sizes when something is missing, which is usually the large files
+	if range_size and (left := file_hashes - received):
+		for file_hash, size in sorted(get_remote_sizes(address, left).items()):
+			if size > range_size and pull_ranged(address, file_hash, size):
+				received.add(file_hash)
+
+	return received
+
+
+def _local_pull(address: PathAddress, file_hashes: set[str]) -> set[str]:
+	from huge.repo.agent import CHUNK_SIZE
 	from huge.repo.paths import FILES_DIRECTORY, HUGE_DIRECTORY
-	from huge.repo.ssh import get_remote_files
+	from huge.repo.ranges import copy_ranged, is_ranged
+	from huge.repo.staging import StagedFile
+	from huge.repo.storage import get_stored_files
 
-	files_to_process = list(remaining_files & get_remote_files(address))
+	if not os.path.isdir(os.path.join(address.path, HUGE_DIRECTORY)):
+		raise PullError("Not a repository")
 
-	with tempfile.TemporaryDirectory(dir=HUGE_DIRECTORY) as d:
-		while files_to_process:
-			current_files, files_to_process = set(files_to_process[:500]), files_to_process[500:]
+	received: set[str] = set()
 
-			process = subprocess.Popen(
-				["rsync", "-ah", "--info=progress2"] +
-				[f"{address.login}@{address.server}:{address.path}/{FILES_DIRECTORY}/{x}" for x in current_files] +
-				[f"{d}/"],
-			)
+	stored_files = get_stored_files(address.path)
+
+	for file_hash in file_hashes & stored_files.keys():
+		source_path = os.path.join(address.path, FILES_DIRECTORY, file_hash)
+
+		if is_ranged(stored_files[file_hash]):
+			if copy_ranged(source_path, file_hash):
+				received.add(file_hash)
+
+			continue
+
+		with StagedFile(file_hash) as staged, open(source_path, "rb") as f:
+			f.seek(staged.offset)
+
+			while data := f.read(CHUNK_SIZE):
+				staged.write(data)
 
-			process.wait()
+			if staged.commit():
+				received.add(file_hash)
 
-			if process.returncode:
-				error(f"Could not transfer files from {address}")
-				return
+	return received
 
-			# Move the transferred files as scp reported transfer was successful
-			for file_hash in current_files:
-				shutil.move(os.path.join(d, file_hash), os.path.join(FILES_DIRECTORY, file_hash))
 
-			remaining_files -= current_files
+def test_plan_pull() -> None:
+	big = STRIPE_MIN_BYTES
 
+	# A single remote with everything is enough for small pulls, even if others have it too
+	assert plan_pull(
+		{"a": 10, "b": 10},
+		{"r1": {"a", "b"}, "r2": {"a", "b"}},
+		{"r1": 100, "r2": 10},
+	) == {"r1": ["a", "b"]}
 
-def _local_pull(address: PathAddress, remaining_files: set[str]) -> None:
+	# The files are split when none has them all, using as few remotes as possible
+	assert plan_pull(
+		{"a": 10, "b": 10, "c": 10},
+		{"r1": {"a"}, "r2": {"a", "b"}, "r3": {"c"}},
+		{"r1": 100, "r2": 100, "r3": 100},
+	) == {"r2": ["a", "b"], "r3": ["c"]}
+
+	# Large pulls are spread out by bandwidth
+	plan = plan_pull(
+		{"a": 3 * big, "b": 2 * big, "c": big},
+		{"r1": {"a", "b", "c"}, "r2": {"a", "b", "c"}},
+		{"r1": 100, "r2": 100},
+	)
+	assert sorted(plan.values()) == [["a"], ["b", "c"]]
+
+	plan = plan_pull(
+		{"a": 3 * big, "b": 2 * big, "c": big},
+		{"r1": {"a", "b", "c"}, "r2": {"a", "b", "c"}},
+		{"r1": 1000, "r2": 1},
+	)
+	assert plan == {"r1": ["a", "b", "c"]}
+
+	# Remotes we know nothing about are only used for what no one else has
+	assert plan_pull(
+		{"a": 10, "b": 10},
+		{"r1": {"a"}, "r2": None},
+		{"r1": 100, "r2": 100},
+	) == {"r1": ["a"], "r2": ["b"]}
+
+
+@huge_test
+def test_pull_commit() -> None:
 	import shutil
-	import tempfile
-	from huge import fail
-	from huge.repo.paths import FILES_DIRECTORY, HUGE_DIRECTORY
+	from huge.repo import create_repository
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, REMOTES_FOLDER, REPO_ID_FILE
+	from huge.repo.remote import add_remote, get_remotes
+	from huge.repo.stage import mark_as_staged
+	from huge.repo.storage import get_stored_files, remove_stored_files
+	from huge.testing import catch_error, catch_output, cd
+
+	create_repository()
+
+	for x in "abc":
+		with open(x, "w") as f:
+			f.write(x * 100)
+
+	mark_as_staged(["a", "b", "c"])
+	create_commit(None)
+
+	commit_hash = get_current_commit()
+	file_hashes = get_commit_files(commit_hash)
+
+	# remote1 has a and b, remote2 has b and c
+	for name, names in [("remote1", "ab"), ("remote2", "bc")]:
+		os.mkdir(name)
+
+		with cd(name):
+			create_repository()
+
+		shutil.copy(REPO_ID_FILE, os.path.join(name, REPO_ID_FILE))
+
+		for x in names:
+			shutil.copy(os.path.join(FILES_DIRECTORY, file_hashes[x]), os.path.join(name, FILES_DIRECTORY))
+
+		add_remote(name)
+
+	# The fastest remote claims to have everything, but is gone
+	add_remote("gone")
+
+	remotes = {x.address: x.remote_hash for x in get_remotes()}
+
+	with open(os.path.join(REMOTES_FOLDER, remotes["gone"], "coverage"), "w") as f:
+		f.writelines(f"{x}\n" for x in file_hashes.values())
+
+	with open(os.path.join(REMOTES_FOLDER, remotes["gone"], "bandwidth"), "w") as f:
+		f.write(f"{DEFAULT_BANDWIDTH * 10}\n")
+
+	for file_hash in file_hashes.values():
+		os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+
+	remove_stored_files(set(file_hashes.values()))
+
+	with catch_output() as out, catch_error() as err:
+		pull_commit([commit_hash], sorted(get_remotes(), key=lambda x: x.address))
+
+		# Everything was given to "gone", and then moved to the others when it failed
+		assert out.getvalue().startswith("Pulling files from gone\n")
+		assert sorted(out.getvalue().splitlines()[1:]) == ["Pulling files from remote1", "Pulling files from remote2"]
+		assert err.getvalue() == "Could not transfer files from gone: Not a repository\n"
+
+	assert set(get_stored_files()) == set(file_hashes.values())
+
+	# Nothing is left to continue
+	assert not any(x.endswith("journal") for y in remotes.values() for x in os.listdir(os.path.join(REMOTES_FOLDER, y)))
+
+	# The same files pulled from remotes with good coverage only needs one remote each
+	for file_hash in file_hashes.values():
+		os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+
+	remove_stored_files(set(file_hashes.values()))
+
+	with catch_output() as out:
+		pull_commit([commit_hash], [x for x in get_remotes() if x.address != "gone"])
+		assert sorted(out.getvalue().splitlines()) == ["Pulling files from remote1", "Pulling files from remote2"]
+
+	assert set(get_stored_files()) == set(file_hashes.values())
+
+	# Large files are copied in ranges
+	set_config("remote.range-size", "30")
+
+	for file_hash in file_hashes.values():
+		os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+
+	remove_stored_files(set(file_hashes.values()))
 
-	if not os.path.isdir(address.path):
-		fail(f"Could not transfer files from {address}")
-		return
+	with catch_output():
+		pull_commit([commit_hash], [x for x in get_remotes() if x.address != "gone"])
 
-	files_available = remaining_files & set(os.listdir(os.path.join(address.path, FILES_DIRECTORY)))
+	assert set(get_stored_files()) == set(file_hashes.values())
 
-	# Copy the files that are available to temporary directory, hopefully on same device.
-	# If this fails, with-statement should delete the temporary files.
-	with tempfile.TemporaryDirectory(dir=HUGE_DIRECTORY) as d:
-		for file_hash in files_available:
-			shutil.copy(os.path.join(address.path, FILES_DIRECTORY, file_hash), d)
+	with open(os.path.join(FILES_DIRECTORY, file_hashes["c"])) as f:
+		assert f.read() == "c" * 100
 
-		# If getting here, move files in place
-		for file_hash in files_available:
-			shutil.move(os.path.join(d, file_hash), os.path.join(FILES_DIRECTORY, file_hash))
 
-	remaining_files -= files_available
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -1,8 +1,200 @@
 """
 Pushing commit files to other repositories
+
+All the remotes are pushed to at the same time. Local remotes and remotes with an agent are fed by a
+single reader: each file is read from disk once, and its chunks are handed to every remote that is
+missing it. Each remote writes from its own queue at its own pace, so the reader is only held back
+when a remote falls too far behind. SSH remotes without an agent are pushed with rsync, each on its
+own thread, with several batches at the same time, see huge.repo.transfer. Large files are sent to
+local remotes and SSH remotes without an agent in ranges instead, see huge.repo.ranges. Changed files
+are sent to SSH remotes as deltas against their version in the parent commit, see huge.repo.delta.
+SSH remotes without an agent get the files added to their storage index and log after the push.
+
+A remote that fails is reported and skipped, without stopping the pushes to the others. What was
+pushed to it is kept in its journal, see huge.repo.journal, and the next push continues from there.
 """
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable
 from huge.repo.address import SSHAddress
+from huge.repo.agent import Agent
+from huge.repo.journal import TransferJournal
 from huge.repo.remote import RemoteInfo
+from huge.testing import huge_test
+
+# How many chunks each remote may fall behind the reader
+READ_AHEAD = 16
+
+# Run on the server with the path of the repository, and the files just pushed without the agent on
+# stdin. Adds them to the storage index and log, like huge.repo.storage.add_stored_files does, so
+# that the next fetch reads the log instead of listing all the files. Left alone unless the index
+# and the pushed files are all the storage has, and without GNU stat, as huge.repo.fetch needs the
+# same nanosecond mtime.
+_STORED_SCRIPT = """
+cd {path}/.huge || exit 1
+m=$(stat -c %.9Y storage 2>/dev/null | tr -d .)
+[ -n "$m" ] && [ -f storage_index ] && [ -s storage_log ] || exit 0
+mkdir -p staging
+: > staging/pushed.tmp
+: > staging/log.tmp
+: > staging/index.tmp
+(cd storage && xargs -r stat -c '%n %s' 2>/dev/null) > staging/pushed.tmp
+ls storage > staging/listed.tmp
+awk '
+	FILENAME == "storage_index" {{ if (FNR > 1) {{ split($0, x, "\\t"); size[x[1]] = x[2] }} next }}
+	FILENAME == "staging/pushed.tmp" {{ if (!($1 in size)) added[++n] = $1; size[$1] = $2; next }}
+	length($0) == 32 && $0 !~ /[^0-9a-f]/ {{ listed[$0] = 1 }}
+	END {{
+		for (f in size) if (!(f in listed)) exit 1
+		for (f in listed) if (!(f in size)) exit 1
+		for (i = 1; i <= n; i++) print "+" added[i] > "staging/log.tmp"
+		for (f in size) printf "%s\\t%s\\n", f, size[f] > "staging/index.tmp"
+	}}
+' storage_index staging/pushed.tmp staging/listed.tmp &&
+	s=$(stat -c %s storage_log) &&
+	truncate -s $(({header} + (s - {header}) / {line} * {line})) storage_log &&
+	cat staging/log.tmp >> storage_log &&
+	{{ echo "$m"; cat staging/index.tmp; }} > staging/index.new &&
+	mv staging/index.new storage_index
+rm -f staging/pushed.tmp staging/listed.tmp staging/log.tmp staging/index.tmp staging/index.new
+"""
+
+
+class PushError(Exception):
+	pass
+
+
+class _LocalSink:
+	"""
+	Writes files into the storage of a repository on the local file system, through its staging area
+
+	Sinks are given each file from the start, and begin_file() returns how much of it to skip. Large
+	files are not handed to the sink by the reader, but copied in ranges by finish().
+	"""
+
+	def __init__(self, remote_path: str, journal: TransferJournal, ranged: set[str]):
+		self.remote_path = remote_path
+		self.journal = journal
+		self.ranged = ranged
+		self.stored: set[str] = set()
+
+	def start(self) -> None:
+		return  # Each file is staged on its own
+
+	def begin_file(self, file_hash: str) -> int:
+		from huge.repo.staging import StagedFile
+
+		self.staged = StagedFile(file_hash, self.remote_path)
+
+		return self.staged.offset
+
+	def write(self, data: bytes) -> None:
+		self.staged.write(data)
+
+	def end_file(self, file_hash: str) -> None:
+		from huge.repo.journal import DONE
+
+		if self.staged.commit():
+			self.stored.add(file_hash)
+			self.journal.mark({file_hash}, DONE)
+
+	def finish(self) -> set[str]:
+		from huge.repo.journal import DONE
+		from huge.repo.paths import FILES_DIRECTORY
+		from huge.repo.ranges import copy_ranged
+		from huge.repo.storage import add_stored_files
+
+		for file_hash in sorted(self.ranged):
+			if copy_ranged(os.path.join(FILES_DIRECTORY, file_hash), file_hash, self.remote_path):
+				self.stored.add(file_hash)
+				self.journal.mark({file_hash}, DONE)
+
+		add_stored_files(self.stored, self.remote_path)
+
+		return self.stored
+
+
+class _AgentSink:
+	"""
+	Streams files to an agent with its put_files operation
+
+	Files with a base that both we and the agent have are not handed to the sink by the reader, but
+	sent as deltas by finish().
+	"""
+
+	def __init__(self, agent: Agent, journal: TransferJournal, offsets: dict[str, int], deltas: dict[str, str]):
+		self.agent = agent
+		self.journal = journal
+
+		# How much the agent has staged of each file already
+		self.offsets = offsets
+
+		# {"hash sum": "hash sum of base"}
+		self.deltas = deltas
+
+	def start(self) -> None:
+		self.agent.send("put_files")
+
+	def begin_file(self, file_hash: str) -> int:
+		from huge.repo.agent import write_message
+
+		write_message(self.agent.output, {"file": file_hash, "offset": self.offsets.get(file_hash, 0)})
+
+		return self.offsets.get(file_hash, 0)
+
+	def write(self, data: bytes) -> None:
+		from huge.repo.agent import write_frame
+
+		write_frame(self.agent.output, data)
+
+	def end_file(self, file_hash: str) -> None:
+		from huge.repo.agent import write_frame
+
+		write_frame(self.agent.output, b"")
+
+	def finish(self) -> set[str]:
+		from huge.repo.agent import read_lines, write_message
+		from huge.repo.journal import DONE
+
+		write_message(self.agent.output, {"done": True})
+
+		self.agent.receive()
+
+		stored = set(read_lines(self.agent.input))
+
+		for file_hash, base_hash in sorted(self.deltas.items()):
+			if self.agent.put_delta(file_hash, base_hash):
+				stored.add(file_hash)
+
+		# A delta that did not give the right content is sent whole instead
+		if failed := self.deltas.keys() - stored:
+			stored |= self.agent.put_files(failed)
+
+		self.journal.mark(stored, DONE)
+
+		return stored
+
+
+@dataclass
+class _Target:
+	"""
+	A remote fed by the shared reader
+	"""
+	remote: RemoteInfo
+	sink: _LocalSink | _AgentSink
+
+	# Files the remote is missing
+	wanted: set[str]
+
+	# Chunks handed over by the reader, ended by None
+	chunks: queue.Queue = field(default_factory=lambda: queue.Queue(maxsize=READ_AHEAD))
+
+	pushed: set[str] = field(default_factory=set)
+	bytes_total: int = 0
+	bytes_done: int = 0
+	error: str | None = None
 
 
 def push_commit(commits: list[str], remotes: list[RemoteInfo]) -> None:
@@ -15,24 +207,31 @@ def push_commit(commits: list[str], remotes: list[RemoteInfo]) -> None:
 	If metadata is not updated on remotes, they might not have any commits actually pointing at the
 	files.
 	"""
-	import os
-	from huge import output
+	from huge import error, output
+	from huge.repo.address import PathAddress, parse_address
+	from huge.repo.agent import AgentError
 	from huge.repo.commit import get_commit_files
-	from huge.repo.address import PathAddress, SSHAddress, parse_address
+	from huge.repo.coverage import get_remote_coverage
+	from huge.repo.delta import get_delta_bases
+	from huge.repo.journal import DONE
 	from huge.repo.paths import REMOTES_FOLDER
+	from huge.repo.ssh import connect_agent
 
 	assert commits
 	assert remotes
 
-	# TODO merayen add the files pushed to the .huge/remotes/.../coverage file... here? otherwise another fetch is needed
+	commit_files = {
+		file_hash
+		for commit in commits
+		for file_hash in get_commit_files(commit).values()
+	}
 
-	commit_files = list(
-		{
-			file_hash
-			for commit in commits
-			for file_hash in get_commit_files(commit).values()
-		}
-	)
+	# Changed files are sent as deltas to remotes that have their earlier version
+	bases = get_delta_bases(commits)
+
+	targets: list[_Target] = []
+	rsync_remotes: list[tuple[SSHAddress, TransferJournal]] = []
+	journals: dict[str, TransferJournal] = {}
 
 	remote: RemoteInfo
 	for remote in remotes:
@@ -40,32 +239,81 @@ def push_commit(commits: list[str], remotes: list[RemoteInfo]) -> None:
 
 		output(f"Pushing files to {address}")
 
-		if isinstance(address, PathAddress):
-			file_hashes_pushed = _local_push(address.path, commit_files=commit_files)
+		journal = journals[remote.remote_hash] = TransferJournal("push", remote.remote_hash)
 
-		elif isinstance(address, SSHAddress):
-			file_hashes_pushed = _remote_push(address, commit_files=commit_files)
+		try:
+			if isinstance(address, PathAddress):
+				targets.append(_local_target(remote, address.path, commit_files, journal))
 
-		else:
-			raise NotImplementedError
+			elif isinstance(address, SSHAddress) and (agent := connect_agent(address)):
+				targets.append(_agent_target(remote, agent, commit_files, journal, bases))
 
-		# Write to remote's coverage file for the files we have sent
-		with open(os.path.join(REMOTES_FOLDER, remote.remote_hash, "coverage"), "a") as f:
-			for file_hash in file_hashes_pushed:
-				f.write(f"{file_hash}\n")
+			elif isinstance(address, SSHAddress):
+				rsync_remotes.append((address, journal))
 
+			else:
+				raise NotImplementedError
 
-def _local_push(remote_path: str, commit_files: list[str]) -> set[str]:
-	import os
-	import shutil
-	from huge import fail
-	from huge.repo.paths import FILES_DIRECTORY, HUGE_DIRECTORY, REPO_ID_FILE
+		except (PushError, AgentError) as exception:
+			error(str(exception))
+
+	with ThreadPoolExecutor(max_workers=len(targets) + len(rsync_remotes) or 1) as executor:
+		rsync_futures = [
+			(address, executor.submit(_remote_push, address, commit_files, len(remotes) == 1, journal, bases))
+			for address, journal in rsync_remotes
+		]
+
+		_fan_out(targets, executor)
+
+		for target in targets:
+			if target.error is not None:
+				error(f"Could not transfer (all) files to {parse_address(target.remote.address)}: {target.error}")
+
+		for address, future in rsync_futures:
+			try:
+				future.result()
+			except PushError as exception:
+				error(f"Could not transfer (all) files to {address}: {exception}")
+
+	# Write to remote's coverage file for the files we have sent, also by earlier pushes that were
+	# stopped before getting this far
+	for remote_hash, journal in journals.items():
+		file_hashes_pushed = journal.get_files(DONE) - (get_remote_coverage(remote_hash) or set())
+
+		if file_hashes_pushed:
+			with open(os.path.join(REMOTES_FOLDER, remote_hash, "coverage"), "a") as f:
+				f.writelines(f"{file_hash}\n" for file_hash in file_hashes_pushed)
+
+		journal.close(commit_files)
+
+
+def _get_wanted(journal: TransferJournal, commit_files: set[str], list_remote: Callable[[], set[str]]) -> set[str]:
+	"""
+	Find the files the remote is missing, writing them down in the journal as queued
+
+	If an earlier push that was stopped has planned all the files already, the remote is not asked
+	what it has.
+	"""
+	from huge.repo.journal import DONE, PRESENT, QUEUED
+
+	if not commit_files <= journal.states.keys():
+		present = commit_files & list_remote()
+
+		journal.mark(present - journal.get_files(DONE), PRESENT)
+		journal.mark(commit_files - present - journal.states.keys(), QUEUED)
+
+	return {x for x in commit_files if journal.states[x] == QUEUED}
+
+
+def _local_target(remote: RemoteInfo, remote_path: str, commit_files: set[str], journal: TransferJournal) -> _Target:
+	from huge.repo.paths import HUGE_DIRECTORY, REPO_ID_FILE
+	from huge.repo.ranges import is_ranged
+	from huge.repo.storage import get_stored_files
 
 	# TODO merayen verify earlier that all the commits actually exists
 
 	if not os.path.isdir(os.path.join(remote_path, HUGE_DIRECTORY)):
-		fail(f"Skipping invalid remote '{remote_path}'")
-		return set()
+		raise PushError(f"Skipping invalid remote '{remote_path}'")
 
 	# Verify repository id is the same
 	with open(os.path.join(remote_path, REPO_ID_FILE)) as f:
@@ -75,66 +323,521 @@ def _local_push(remote_path: str, commit_files: list[str]) -> set[str]:
 		local_id = f.read().strip()
 
 	if remote_id != local_id:
-		fail(f"Remote repository is another repository: '{remote_path}'")
-		return set()
+		raise PushError(f"Remote repository is another repository: '{remote_path}'")
 
-	# Get all the remote files
-	remote_files = set(os.listdir(os.path.join(remote_path, FILES_DIRECTORY)))
+	# Calculate the files that is needed for the remote to represent the whole commit
+	wanted = _get_wanted(journal, commit_files, lambda: set(get_stored_files(remote_path)))
 
-	# Calculate and send the files that is needed for the remote to represent the whole commit
-	files_to_process = set(commit_files) - set(remote_files)
+	stored_files = get_stored_files()
+	ranged = {x for x in wanted if is_ranged(stored_files.get(x, 0))}
 
-	for file_checksum in files_to_process:
-		# TODO merayen should we copy to a temporary location first, then move everything in one go?
-		shutil.copy(
-			os.path.join(FILES_DIRECTORY, file_checksum),
-			os.path.join(remote_path, FILES_DIRECTORY, file_checksum),
-		)
+	return _Target(
+		remote=remote,
+		sink=_LocalSink(remote_path, journal, ranged),
+		wanted=wanted - ranged,
+	)
+
+
+def _agent_target(
+	remote: RemoteInfo,
+	agent: Agent,
+	commit_files: set[str],
+	journal: TransferJournal,
+	bases: dict[str, str],
+) -> _Target:
+	from huge.repo.storage import get_stored_files
+
+	agent.check_repository()
+
+	wanted = _get_wanted(journal, commit_files, lambda: agent.have(commit_files))
+
+	# Deltas are made against our copy of the base, and applied to the agent's
+	stored_files = get_stored_files()
+	deltas = {x: y for x, y in bases.items() if x in wanted and y in stored_files}
+
+	if deltas:
+		present = agent.have(set(deltas.values()))
+		deltas = {x: y for x, y in deltas.items() if y in present}
+
+	return _Target(
+		remote=remote,
+		sink=_AgentSink(agent, journal, agent.get_staged(wanted - deltas.keys()), deltas),
+		wanted=wanted - deltas.keys(),
+	)
+
+
+def _fan_out(targets: list[_Target], executor: ThreadPoolExecutor) -> None:
+	"""
+	Read each file wanted by any of the targets once, handing the chunks to all that wants it
+	"""
+	import sys
+	import time
+	from huge.repo.agent import CHUNK_SIZE
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.storage import get_stored_files
+
+	if not targets:
+		return
+
+	stored_files = get_stored_files()
+
+	for target in targets:
+		# Files we don't have can not be pushed
+		target.wanted &= stored_files.keys()
+		target.bytes_total = sum(stored_files[x] for x in target.wanted)
+
+	writers = [executor.submit(_write_target, target) for target in targets]
+
+	last_print = time.monotonic() + .5
+	printed = ""
+
+	try:
+		for file_hash in sorted(set().union(*(x.wanted for x in targets))):
+			receivers = [x for x in targets if file_hash in x.wanted and x.error is None]
+
+			if not receivers:
+				continue
+
+			for target in receivers:
+				target.chunks.put(("begin", file_hash))
+
+			with open(os.path.join(FILES_DIRECTORY, file_hash), "rb") as f:
+				while data := f.read(CHUNK_SIZE):
+					for target in receivers:
+						target.chunks.put(("data", data))
 
-	return files_to_process
+			for target in receivers:
+				target.chunks.put(("end", file_hash))
 
+			if last_print < time.monotonic():
+				last_print = time.monotonic() + .1
+				printed = "\rPushing: " + ", ".join(
+					f"{x.remote.address} {'failed' if x.error else f'{100 * x.bytes_done // max(1, x.bytes_total)}%'}"
+					for x in targets
+				)
+				sys.stdout.write(printed)
+				sys.stdout.flush()
 
-def _remote_push(address: SSHAddress, commit_files: list[str]) -> set[str]:
+	finally:
+		for target in targets:
+			target.chunks.put(None)
+
+		for writer in writers:
+			writer.result()
+
+		if printed:
+			sys.stdout.write(" " * len(printed) + "\r")
+
+
+def _write_target(target: _Target) -> None:
+	"""
+	Hand the chunks in the target's queue to its sink until the reader is done
+
+	After any failure the queue is still emptied, so that the reader is never blocked by it.
+	"""
+	try:
+		target.sink.start()
+	except Exception as exception:
+		target.error = str(exception)
+
+	# Bytes at the start of the current file that the remote has already
+	skip = 0
+
+	while (item := target.chunks.get()) is not None:
+		if target.error is not None:
+			continue
+
+		kind, value = item
+
+		try:
+			if kind == "begin":
+				skip = target.sink.begin_file(value)
+			elif kind == "data":
+				if skip < len(value):
+					target.sink.write(value[skip:])
+
+				skip = max(0, skip - len(value))
+				target.bytes_done += len(value)
+			else:
+				target.sink.end_file(value)
+
+		except Exception as exception:
+			target.error = str(exception)
+
+	if target.error is None:
+		try:
+			target.pushed = target.sink.finish()
+		except Exception as exception:
+			target.error = str(exception)
+
+
+def _remote_push(
+	address: SSHAddress,
+	commit_files: set[str],
+	progress: bool,
+	journal: TransferJournal,
+	bases: dict[str, str],
+) -> None:
 	import subprocess
-	from huge import fail
+	import threading
+	import time
+	from huge.repo.compression import get_compression_level, is_compressible, rsync_compression
+	from huge.repo.config import get_int_config
+	from huge.repo.coverage import get_cached_remote_files, write_remote_coverage
+	from huge.repo.delta import seed_bases
+	from huge.repo.journal import DONE, QUEUED, TransferInterrupted, with_retries
+	from huge.repo.pack import push_pack, use_pack
 	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.pull import BANDWIDTH_MIN_BYTES
+	from huge.repo.ranges import is_ranged, push_ranged
+	from huge.repo.remote import record_remote_bandwidth
+	from huge.repo.ssh import rsync_address, rsync_command, ssh_command, ssh_shell_command
+	from huge.repo.storage import get_stored_files
+	from huge.repo.transfer import make_batches, run_batches
+
+	def list_remote() -> set[str]:
+		nonlocal listed_from_cache
+
+		# Usually listed by the fetch that came right before
+		if (cached := get_cached_remote_files(journal.remote_hash)) is not None:
+			listed_from_cache = True
+			return cached
+
+		process = subprocess.Popen(
+			ssh_command(address) + ["ls", f"{address.path}/{FILES_DIRECTORY}"],
+			stdout=subprocess.PIPE,
+		)
+
+		stdout, _ = process.communicate()
+
+		if process.returncode:
+			raise TransferInterrupted("Could not list the files of the remote")
+
+		file_hashes = {x.strip() for x in stdout.decode().splitlines()}
+		write_remote_coverage(journal.remote_hash, file_hashes)
+
+		return file_hashes
+
+	def find_missing() -> set[str]:
+		# A dry run prints the files the remote does not have, without sending anything
+		process = subprocess.Popen(
+			rsync_command() +
+			["-an", "--ignore-existing", "--out-format=%n", "--files-from=-"] +
+			[f"{FILES_DIRECTORY}/", rsync_address(address, f"{address.path}/{FILES_DIRECTORY}/")],
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+		)
+
+		stdout, _ = process.communicate("".join(f"{x}\n" for x in sorted(commit_files & stored_files.keys())).encode())
+
+		if process.returncode:
+			raise TransferInterrupted(f"rsync failed with code {process.returncode}")
+
+		return commit_files & {x.strip() for x in stdout.decode().splitlines()}
+
+	def send(file_hashes: list[str]) -> set[str]:
+		if use_pack([stored_files[x] for x in file_hashes]):
+			return push_pack(address, file_hashes)
+
+		compress = level and is_compressible([os.path.join(FILES_DIRECTORY, x) for x in file_hashes])
+
+		process = subprocess.Popen(
+			rsync_command() +
+
+			# Progress from several rsyncs at the same time would be garbled. Interrupted files are
+			# kept in the staging area of the remote, and continued from on the next try.
+			["-ah", "--ignore-existing", "--partial-dir=../staging", "--files-from=-"] +
+			(["--info=progress2"] if progress and streams == 1 else []) +
+			(rsync_compression(level) if compress else []) +
+
+			# The files are listed on stdin, relative to the source folder
+			[f"{FILES_DIRECTORY}/", rsync_address(address, f"{address.path}/{FILES_DIRECTORY}/")],
+			stdin=subprocess.PIPE,
+		)
+
+		process.communicate("".join(f"{x}\n" for x in file_hashes).encode())
+
+		if process.returncode:
+			raise TransferInterrupted(f"rsync failed with code {process.returncode}")
+
+		return set(file_hashes)
+
+	def transfer(file_hashes: list[str]) -> None:
+		nonlocal bytes_sent, seconds
+
+		started = time.monotonic()
+
+		# Written down at once, so that a later failure does not make us send these again. Files
+		# the remote found damaged stay queued, and are sent again by the next push.
+		journal.mark(with_retries(lambda: send(file_hashes)), DONE)
+
+		with lock:
+			bytes_sent += sum(stored_files[x] for x in file_hashes)
+			seconds += time.monotonic() - started
+
+	def send_all(wanted: set[str]) -> None:
+		sizes = {x: stored_files[x] for x in wanted if x in stored_files}
+
+		# Files that get a basis on the remote are sent with rsync, which then only sends a delta
+		seeded = with_retries(lambda: seed_bases(address, {x: bases[x] for x in sizes if x in bases}))
+		ranged = {x for x in sizes if is_ranged(sizes[x]) and x not in seeded}
+
+		run_batches(make_batches({x: y for x, y in sizes.items() if x not in ranged}), transfer, streams)
+
+		# Each large file is sent in ranges on all the streams
+		for file_hash in sorted(ranged):
+			if with_retries(lambda: push_ranged(address, file_hash)):
+				journal.mark({file_hash}, DONE)
+
+	streams = get_int_config("remote.streams")
+	level = get_compression_level(journal.remote_hash)
+
+	# Measured like when pulling, see huge.repo.pull
+	lock = threading.Lock()
+	bytes_sent = 0
+	seconds = 0.
+
+	listed_from_cache = False
+	stored_files = get_stored_files()
+
+	try:
+		wanted = _get_wanted(journal, commit_files, lambda: with_retries(list_remote))
+		send_all(wanted)
+
+		# The cached list does not know of files deleted on the remote since it was listed, so what
+		# the remote still lacks is asked for in one go, and sent too
+		if listed_from_cache and (missing := with_retries(find_missing) - wanted):
+			journal.mark(missing, QUEUED)
+			send_all(missing)
+			wanted |= missing
+
+		# Without the agent the remote does not know what it got, and the next fetch would have to
+		# list all its files
+		_record_remote_stored(lambda x: ssh_shell_command(address, x), address.path, journal.get_files(DONE) & commit_files)
+
+	except TransferInterrupted as exception:
+		raise PushError(f"{exception}, after {len(journal.get_files(DONE) & wanted)} files")
+
+	finally:
+		if bytes_sent >= BANDWIDTH_MIN_BYTES:
+			record_remote_bandwidth(journal.remote_hash, bytes_sent, seconds)
+
+
+def _record_remote_stored(command: Callable[[str], list[str]], repository_path: str, file_hashes: set[str]) -> None:
+	"""
+	Add files pushed without the agent to the storage index and log of the remote, see _STORED_SCRIPT
+
+	Failing only makes the next fetch list all the files, so it is not reported.
+	"""
+	import shlex
+	import subprocess
+	from huge.repo.storage import LOG_HEADER_SIZE, LOG_LINE_SIZE
 
-	process = subprocess.Popen(
-		[
-			"ssh", f"{address.login}@{address.server}",
-			"ls", f"{address.path}/{FILES_DIRECTORY}",
-		],
-		stdout=subprocess.PIPE,
+	script = _STORED_SCRIPT.format(path=shlex.quote(repository_path), header=LOG_HEADER_SIZE, line=LOG_LINE_SIZE)
+
+	subprocess.run(
+		command(script),
+		input="".join(f"{x}\n" for x in sorted(file_hashes)).encode(),
+		stdout=subprocess.DEVNULL,
+		stderr=subprocess.DEVNULL,
 	)
 
-	stdout, _ = process.communicate()
 
-	if process.returncode:
-		fail("Could not transfer files")
-		return set()
+@huge_test
+def test_push_commit() -> None:
+	import shutil
+	from huge.repo import create_repository
+	from huge.repo.agent import CHUNK_SIZE
+	from huge.repo.commit import create_commit, get_current_commit
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, REPO_ID_FILE
+	from huge.repo.remote import add_remote, get_remotes
+	from huge.repo.stage import mark_as_staged
+	from huge.testing import catch_error, catch_output, cd
+
+	create_repository()
+
+	for x in "ab":
+		with open(x, "w") as f:
+			f.write(x * (CHUNK_SIZE * 2 + 1))  # Spans several chunks
+
+	mark_as_staged(["a", "b"])
+	create_commit(None)
+
+	for name in ["remote1", "remote2"]:
+		os.mkdir(name)
+
+		with cd(name):
+			create_repository()
+
+		shutil.copy(REPO_ID_FILE, os.path.join(name, REPO_ID_FILE))
+		add_remote(name)
+
+	# The second remote already has one of the files, and the third is broken
+	shutil.copy(os.path.join(FILES_DIRECTORY, sorted(os.listdir(FILES_DIRECTORY))[0]), "remote2/.huge/storage/")
+	add_remote("broken")
+
+	with catch_output() as out, catch_error() as err:
+		push_commit([get_current_commit()], sorted(get_remotes(), key=lambda x: x.address))
+		assert out.getvalue() == "Pushing files to broken\nPushing files to remote1\nPushing files to remote2\n"
+		assert err.getvalue() == "Skipping invalid remote 'broken'\n"
+
+	for name in ["remote1", "remote2"]:
+		assert sorted(os.listdir(f"{name}/.huge/storage")) == sorted(os.listdir(FILES_DIRECTORY))
+
+	remotes = {x.address: x.remote_hash for x in get_remotes()}
+
+	with open(f".huge/remotes/{remotes['remote1']}/coverage") as f:
+		assert len(f.readlines()) == 2
+
+	with open(f".huge/remotes/{remotes['remote2']}/coverage") as f:
+		assert len(f.readlines()) == 1
+
+	# Large files are copied in ranges
+	set_config("remote.range-size", str(CHUNK_SIZE))
+	shutil.rmtree("remote1/.huge/storage")
+	os.mkdir("remote1/.huge/storage")
+	os.remove(f".huge/remotes/{remotes['remote1']}/coverage")
+
+	with catch_output():
+		push_commit([get_current_commit()], [x for x in get_remotes() if x.address == "remote1"])
+
+	assert sorted(os.listdir("remote1/.huge/storage")) == sorted(os.listdir(FILES_DIRECTORY))
+
+
+@huge_test
+def test_fan_out_failure() -> None:
+	from concurrent.futures import ThreadPoolExecutor
+	from unittest.mock import MagicMock
+	from huge.repo import create_repository
+	from huge.repo.agent import CHUNK_SIZE
+	from huge.repo.commit import create_commit
+	from huge.repo.remote import RemoteInfo
+	from huge.repo.stage import mark_as_staged
+	from huge.repo.storage import get_stored_files
+
+	create_repository()
+
+	with open("a", "w") as f:
+		f.write("a" * (CHUNK_SIZE * READ_AHEAD * 2))  # More chunks than fit in the queue
+
+	mark_as_staged(["a"])
+	create_commit(None)
+
+	# Any exception from the sink fails only its target, and the reader is not left waiting on it
+	sink = MagicMock()
+	sink.begin_file.side_effect = ValueError("Broken sink")
+	target = _Target(RemoteInfo("remote", "f" * 32, None), sink, set(get_stored_files()))
+
+	with ThreadPoolExecutor() as executor:
+		_fan_out([target], executor)
+
+	assert target.error == "Broken sink"
+	assert target.pushed == set()
+
+
+@huge_test
+def test_record_remote_stored() -> None:
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+	from huge.repo.storage import add_stored_files, forget_stored_files, get_storage_changes, get_stored_files
+	from huge.testing import cd
+
+	os.mkdir("remote")
+
+	with cd("remote"):
+		create_repository()
+
+		with open(os.path.join(FILES_DIRECTORY, "a" * 32), "w") as f:
+			f.write("Content")
+
+		add_stored_files({"a" * 32})
+		position = get_storage_changes("", 0)
+
+	# Run the script locally instead of on a server
+	def command(script: str) -> list[str]:
+		return ["sh", "-c", script]
+
+	def push(file_hash: str) -> None:
+		with open(os.path.join("remote", FILES_DIRECTORY, file_hash), "w") as f:
+			f.write("Pushed")
+
+		_record_remote_stored(command, os.path.abspath("remote"), {file_hash, "f" * 32})
+		forget_stored_files()
+
+	# The pushed file is read from the log, and the index is up to date without listing the storage
+	with open(os.path.join("remote", FILES_DIRECTORY, f"{'c' * 32}.tmp"), "w") as f:
+		f.write("Partial")
+
+	push("b" * 32)
+
+	with cd("remote"), patch("huge.repo.storage._scan_storage", side_effect=AssertionError):
+		changes = get_storage_changes(position.epoch, position.sequence)
+		assert (changes.added, changes.files) == ({"b" * 32}, None)
+		assert get_stored_files() == {"a" * 32: 7, "b" * 32: 6}
+
+	# Files the index does not know of, that we did not push, leave the index to be rebuilt
+	with open(os.path.join("remote", FILES_DIRECTORY, "d" * 32), "w") as f:
+		f.write("Other")
+
+	push("e" * 32)
+
+	with cd("remote"):
+		assert get_storage_changes(changes.epoch, changes.sequence).added == {"d" * 32, "e" * 32}
+
+		# Nothing is left behind in the staging area
+		assert os.listdir(STAGING_FOLDER) == []
+
+
+@huge_test
+def test_push_resume() -> None:
+	import shutil
+	from huge.repo import create_repository
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.coverage import get_remote_coverage
+	from huge.repo.journal import DONE, QUEUED
+	from huge.repo.paths import REPO_ID_FILE
+	from huge.repo.remote import add_remote, get_remotes
+	from huge.repo.stage import mark_as_staged
+	from huge.testing import catch_output, cd
+
+	create_repository()
+
+	for x in "ab":
+		with open(x, "w") as f:
+			f.write(x)
+
+	mark_as_staged(["a", "b"])
+	create_commit(None)
+
+	file_hashes = get_commit_files(get_current_commit())
 
-	remote_files = [x.strip() for x in stdout.decode().splitlines()]
+	os.mkdir("remote")
 
-	files_to_process = list(set(commit_files) - set(remote_files))
+	with cd("remote"):
+		create_repository()
 
-	if files_to_process:
-		while files_to_process:
-			current_files, files_to_process = files_to_process[:500], files_to_process[500:]
+	shutil.copy(REPO_ID_FILE, os.path.join("remote", REPO_ID_FILE))
+	add_remote("remote")
 
-			process = subprocess.Popen(
-				["rsync", "-ah", "--info=progress2", "--ignore-existing"] +
+	remote = next(get_remotes())
 
-				# Source files
-				[f"{FILES_DIRECTORY}/{x}" for x in current_files] +
+	# An earlier push was stopped after sending a
+	journal = TransferJournal("push", remote.remote_hash)
+	journal.mark(set(file_hashes.values()), QUEUED)
+	journal.mark({file_hashes["a"]}, DONE)
 
-				# Destination
-				[f"{address.login}@{address.server}:{address.path}/{FILES_DIRECTORY}/"],
-			)
+	with catch_output():
+		push_commit([get_current_commit()], [remote])
 
-			process.wait()
+	# Only b is sent, as the remote is not asked again what it has
+	assert os.listdir("remote/.huge/storage") == [file_hashes["b"]]
+	assert get_remote_coverage(remote.remote_hash) == set(file_hashes.values())
+	assert not os.path.exists(journal.path)
 
-			if process.returncode:
-				fail("Could not transfer (all) files")
-				return set()
 
-	return files_to_process
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,144 @@
+"""
+Keeping FILES_DIRECTORY within a size limit
+
+When the storage grows larger than the "storage.quota" setting, the least recently used files are
+deleted, turning the local storage into a cache in front of the remotes. Only files that enough
+remotes has copies of are deleted, counting only remotes whose files were listed within
+"remote.inventory-age", as an older listing might no longer be true.
+
+When files were last used is kept in ACCESS_FILE, see huge.repo.metadata.
+"""
+import os
+from huge.testing import huge_test
+
+
+def enforce_quota() -> None:
+	"""
+	Delete the least recently used files until the storage is within "storage.quota"
+	"""
+	from huge import error, output
+	from huge.repo.commit import get_commit_files, get_current_commit
+	from huge.repo.config import get_int_config, get_size_config
+	from huge.repo.coverage import get_recently_listed_remotes, get_remote_copies
+	from huge.repo.drop import drop_commit_files
+	from huge.repo.metadata import get_access_times
+	from huge.repo.storage import get_stored_files
+
+	quota = get_size_config("storage.quota")
+
+	if quota is None:
+		return
+
+	stored_files = get_stored_files()
+
+	excess = sum(stored_files.values()) - quota
+
+	if excess <= 0:
+		return
+
+	required_copies = get_int_config("storage.eviction-copies")
+
+	# Files in the commit the user is working on is always kept
+	keep = set(get_commit_files(get_current_commit()).values()) if get_current_commit() else set()
+
+	remote_copies = get_remote_copies(set(stored_files) - keep, get_recently_listed_remotes())
+
+	candidates = [x for x, copies in remote_copies.items() if copies >= required_copies]
+
+	# Files that has never been used are considered the oldest
+	access_times = get_access_times()
+	candidates.sort(key=lambda x: access_times.get(x, 0))
+
+	to_evict: set[str] = set()
+	for file_hash in candidates:
+		if excess <= 0:
+			break
+
+		to_evict.add(file_hash)
+		excess -= stored_files[file_hash]
+
+	if to_evict:
+		freed = sum(stored_files[x] for x in to_evict)
+		drop_commit_files(to_evict)
+		output(f"Evicted {len(to_evict)} files ({freed} bytes) to stay within the storage quota")
+
+	if excess > 0:
+		error(
+			f"Storage quota exceeded by {excess} bytes, but no more files has at least "
+			f"{required_copies} copies on the remotes listed within remote.inventory-age (huge fetch)"
+		)
+
+
+@huge_test
+def test_enforce_quota() -> None:
+	import time
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, REMOTES_FOLDER
+	from huge.repo.storage import add_stored_files, get_stored_files
+	from huge.testing import catch_error, catch_output
+
+	create_repository()
+
+	files = {x * 32: x * 100 for x in "abc"}
+
+	for file_hash, content in files.items():
+		with open(os.path.join(FILES_DIRECTORY, file_hash), "w") as f:
+			f.write(content)
+
+	add_stored_files(set(files))
+
+	# "a" is the most recently used, "b" has never been used
+	with open(".huge/access", "w") as f:
+		f.write(f"{'c' * 32}\t100\n{'a' * 32}\t200\n")
+
+	# Two remotes has "b" and "c", only one has "a"
+	for remote, remote_files in [("remote1", "abc"), ("remote2", "bc")]:
+		os.mkdir(os.path.join(REMOTES_FOLDER, remote))
+
+		with open(os.path.join(REMOTES_FOLDER, remote, "address"), "w") as f:
+			f.write(remote)
+
+		with open(os.path.join(REMOTES_FOLDER, remote, "coverage"), "w") as f:
+			f.write("".join(f"{x * 32}\n" for x in remote_files))
+
+		with open(os.path.join(REMOTES_FOLDER, remote, "listed"), "w") as f:
+			f.write(f"{time.time() - 7200}\n")
+
+	enforce_quota()  # No quota set
+
+	set_config("storage.quota", "250")
+
+	# The listings are too old to be sure the remotes still has the files
+	with catch_error() as err:
+		enforce_quota()
+		assert "no more files has at least 2 copies" in err.getvalue()
+
+	assert set(get_stored_files()) == set(files)
+
+	set_config("remote.inventory-age", "3h")
+
+	with catch_output() as out:
+		enforce_quota()
+		assert out.getvalue() == "Evicted 1 files (100 bytes) to stay within the storage quota\n"
+
+	assert set(get_stored_files()) == {"a" * 32, "c" * 32}
+
+	set_config("storage.quota", "50")
+
+	with catch_output() as out, catch_error() as err:
+		enforce_quota()
+		assert out.getvalue() == "Evicted 1 files (100 bytes) to stay within the storage quota\n"
+		assert err.getvalue() == (
+			"Storage quota exceeded by 50 bytes, but no more files has at least 2 copies on the remotes "
+			"listed within remote.inventory-age (huge fetch)\n"
+		)
+
+	# "a" is not replicated enough to be evicted
+	assert set(get_stored_files()) == {"a" * 32}
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,542 @@
+"""
+Transferring a large file in ranges, several at the same time
+
+A single stream seldom fills a fast connection with a long round trip, so files larger than
+"remote.range-size" are split into ranges of that size, and "remote.streams" of the ranges are
+transferred at the same time. Local remotes copy the ranges with os.pread and os.pwrite, and SSH
+remotes without an agent transfer each range over its own channel of the shared connection, using
+only a POSIX shell and GNU coreutils on the server.
+
+The receiver writes each range at its offset into "<hash sum>.ranged" in the staging area, and checks
+it against the md5 of the range at the sender. Each range that matched is written down as a line
+"offset<TAB>length<TAB>md5" in "<hash sum>.ranges" next to it, so a transfer that was stopped only
+sends the ranges that are left. When all the ranges are there, the content of the whole file is
+checked against its hash sum before it is moved into FILES_DIRECTORY.
+"""
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+from typing import BinaryIO, Callable, Iterator
+from huge.repo.address import SSHAddress
+from huge.testing import huge_test
+
+# Run on the server. Prints the ranges staged earlier.
+_RANGES_SCRIPT = """
+cd {staging} 2>/dev/null && [ -f {hash}.ranged ] && cat {hash}.ranges 2>/dev/null
+true
+"""
+
+# Run on the server. Writes stdin into the staged file at offset, and prints the md5 of what it wrote.
+_WRITE_RANGE_SCRIPT = """
+set -e
+mkdir -p {staging}
+cd {staging}
+dd of={hash}.ranged bs=1M seek={offset} oflag=seek_bytes conv=notrunc iflag=fullblock status=none
+md5=$(tail -c +{start} {hash}.ranged | head -c {length} | md5sum | cut -c 1-32)
+printf '%s\\t%s\\t%s\\n' {offset} {length} "$md5" >> {hash}.ranges
+echo "$md5"
+"""
+
+# Run on the server. Moves the staged file into the storage if its content is right, also when it is
+# stored compressed, see huge.repo.encoding.
+_COMMIT_SCRIPT = """
+cd {staging} || exit 1
+s=$(md5sum < {hash}.ranged | cut -c 1-32)
+[ "$s" = {hash} ] || s=$(zstd -d -q -c --long=27 < {hash}.ranged 2>/dev/null | md5sum | cut -c 1-32)
+if [ "$s" = {hash} ]; then
+	mv {hash}.ranged {storage}/{hash} && rm -f {hash}.ranges && echo stored
+else
+	rm -f {hash}.ranged {hash}.ranges
+fi
+"""
+
+# Run on the server. Prints a range of a stored file, followed by its md5. The second read of the
+# range is usually served from the page cache.
+_READ_RANGE_SCRIPT = """
+tail -c +{start} {file} | head -c {length}
+tail -c +{start} {file} | head -c {length} | md5sum | cut -c 1-32
+"""
+
+# Run on the server. Prints "hash size" for each of the files listed on stdin that it has.
+_SIZES_SCRIPT = """
+cd {storage} && xargs -r stat -c '%n %s' -- 2>/dev/null
+true
+"""
+
+
+class RangedFile:
+	"""
+	A file being received in ranges, in any order and from several threads at the same time
+
+	Usage:
+		with RangedFile(file_hash, size) as ranged:
+			for offset, length in ranged.get_missing():
+				md5 = ranged.write_range(offset, length, chunks)
+				# Compare md5 with the md5 of the range at the sender
+				ranged.finish_range(offset, length, md5)
+
+			ranged.commit()
+	"""
+
+	def __init__(self, file_hash: str, size: int, path: str = "."):
+		from huge.repo.paths import STAGING_FOLDER
+
+		self.file_hash = file_hash
+		self.size = size
+		self.path = path
+
+		os.makedirs(os.path.join(path, STAGING_FOLDER), exist_ok=True)
+
+		self.data_path = os.path.join(path, STAGING_FOLDER, f"{file_hash}.ranged")
+		self.ranges_path = os.path.join(path, STAGING_FOLDER, f"{file_hash}.ranges")
+
+		# {(offset, length): "md5"}
+		self.done: dict[tuple[int, int], str] = {}
+
+		if os.path.isfile(self.data_path) and os.path.isfile(self.ranges_path):
+			with open(self.ranges_path) as f:
+				self.done = _parse_ranges(f.read())
+
+		self.lock = threading.Lock()
+		self.fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+		os.ftruncate(self.fd, size)
+
+	def __enter__(self) -> "RangedFile":
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+	def get_missing(self) -> list[tuple[int, int]]:
+		"""
+		Get the ranges not received yet, as (offset, length)
+		"""
+		return [x for x in split_ranges(self.size) if x not in self.done]
+
+	def write_range(self, offset: int, length: int, chunks: Iterator[bytes]) -> str:
+		"""
+		Write the content of a range, returning its md5. Safe to call from several threads.
+		"""
+		from huge.repo.journal import TransferInterrupted
+
+		md5sum = hashlib.md5()
+		position = offset
+
+		for data in chunks:
+			if position + len(data) > offset + length:
+				raise TransferInterrupted(f"Received more than the range at {offset} of {self.file_hash}")
+
+			view = memoryview(data)
+
+			while view:
+				written = os.pwrite(self.fd, view, position)
+				view = view[written:]
+				position += written
+
+			md5sum.update(data)
+
+		if position != offset + length:
+			raise TransferInterrupted(
+				f"The range at {offset} of {self.file_hash} ended after {position - offset} of {length} bytes"
+			)
+
+		return md5sum.hexdigest()
+
+	def finish_range(self, offset: int, length: int, md5: str) -> None:
+		"""
+		Write down that a range has been received, after checking its md5 with the sender
+		"""
+		# The content must be on disk before its line, or a crash could leave a line for a range
+		# that was never written
+		os.fsync(self.fd)
+
+		with self.lock, open(self.ranges_path, "a") as f:
+			f.write(f"{offset}\t{length}\t{md5}\n")
+			f.flush()
+			os.fsync(f.fileno())
+
+			self.done[(offset, length)] = md5
+
+	def commit(self) -> bool:
+		"""
+		Move the complete file into FILES_DIRECTORY, if its content is correct
+
+		A file with the wrong content is thrown away, and False returned.
+		"""
+		from huge.repo.encoding import check_content
+		from huge.repo.paths import FILES_DIRECTORY
+		from huge.repo.staging import BLOCK_SIZE
+
+		md5sum = hashlib.md5()
+		position = 0
+
+		while data := os.pread(self.fd, BLOCK_SIZE, position):
+			md5sum.update(data)
+			position += len(data)
+
+		self.close()
+
+		if not check_content(self.data_path, self.file_hash, md5sum.hexdigest()):
+			self.discard()
+			return False
+
+		os.replace(self.data_path, os.path.join(self.path, FILES_DIRECTORY, self.file_hash))
+
+		if os.path.isfile(self.ranges_path):
+			os.remove(self.ranges_path)
+
+		return True
+
+	def close(self) -> None:
+		"""
+		Stop receiving, keeping the ranges received for later
+		"""
+		if self.fd != -1:
+			os.close(self.fd)
+			self.fd = -1
+
+	def discard(self) -> None:
+		self.close()
+
+		for x in [self.data_path, self.ranges_path]:
+			if os.path.isfile(x):
+				os.remove(x)
+
+
+def is_ranged(size: int) -> bool:
+	"""
+	Whether a file of this size is transferred in ranges
+	"""
+	from huge.repo.config import get_size_config
+
+	return size > (get_size_config("remote.range-size") or 0) > 0
+
+
+def split_ranges(size: int) -> list[tuple[int, int]]:
+	"""
+	Split a file of this size into ranges of "remote.range-size", as (offset, length)
+	"""
+	from huge.repo.config import get_size_config
+
+	range_size = get_size_config("remote.range-size") or size or 1
+
+	return [(x, min(range_size, size - x)) for x in range(0, size, range_size)]
+
+
+def copy_ranged(source_path: str, file_hash: str, path: str = ".") -> bool:
+	"""
+	Copy a file on the local file system into the storage of a repository, in ranges
+
+	Returns whether the content was correct and the file stored.
+	"""
+	from huge.repo.transfer import run_batches
+
+	with RangedFile(file_hash, os.path.getsize(source_path), path) as ranged, open(source_path, "rb") as f:
+		def copy(offset_length: tuple[int, int]) -> None:
+			offset, length = offset_length
+
+			md5 = ranged.write_range(offset, length, _read_range(f.fileno(), offset, length))
+			ranged.finish_range(offset, length, md5)
+
+		run_batches(ranged.get_missing(), copy)
+
+		return ranged.commit()
+
+
+def push_ranged(address: SSHAddress, file_hash: str) -> bool:
+	"""
+	Send a file from FILES_DIRECTORY to the storage of a remote, in ranges
+
+	Returns whether the remote stored it. Raises TransferInterrupted if a range failed, and the
+	ranges sent are kept by the remote for the next try.
+	"""
+	from huge.repo.ssh import ssh_shell_command
+
+	return _push_ranged(lambda x: ssh_shell_command(address, x), address.path, file_hash)
+
+
+def pull_ranged(address: SSHAddress, file_hash: str, size: int) -> bool:
+	"""
+	Get a file from the storage of a remote into FILES_DIRECTORY, in ranges
+
+	Returns whether it was stored, which must be added to the storage index by the caller. Raises
+	TransferInterrupted if a range failed, and the ranges received are kept for the next try.
+	"""
+	from huge.repo.ssh import ssh_shell_command
+
+	return _pull_ranged(lambda x: ssh_shell_command(address, x), address.path, file_hash, size)
+
+
+def get_remote_sizes(address: SSHAddress, file_hashes: set[str]) -> dict[str, int]:
+	"""
+	Get the sizes of the files the remote has of these
+
+	Returns: {"hash sum": size}
+	"""
+	from huge.repo.ssh import ssh_shell_command
+
+	return _get_sizes(lambda x: ssh_shell_command(address, x), address.path, file_hashes)
+
+
+def _parse_ranges(text: str) -> dict[tuple[int, int], str]:
+	result: dict[tuple[int, int], str] = {}
+
+	for x in text.splitlines(keepends=True):
+		if x.endswith("\n") and len(parts := x.strip().split("\t")) == 3:
+			result[(int(parts[0]), int(parts[1]))] = parts[2]
+
+	return result
+
+
+def _read_range(fd: int, offset: int, length: int) -> Iterator[bytes]:
+	from huge.repo.agent import CHUNK_SIZE
+
+	end = offset + length
+
+	while offset < end and (data := os.pread(fd, min(CHUNK_SIZE, end - offset), offset)):
+		yield data
+		offset += len(data)
+
+
+def _read_exactly(stream: BinaryIO, length: int) -> Iterator[bytes]:
+	from huge.repo.agent import CHUNK_SIZE
+
+	while length and (data := stream.read(min(CHUNK_SIZE, length))):
+		yield data
+		length -= len(data)
+
+
+def _push_ranged(command: Callable[[str], list[str]], repository_path: str, file_hash: str) -> bool:
+	from huge.repo.journal import TransferInterrupted
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+	from huge.repo.transfer import run_batches
+
+	names = {
+		"hash": file_hash,
+		"staging": shlex.quote(f"{repository_path}/{STAGING_FOLDER}"),
+		"storage": shlex.quote(f"{repository_path}/{FILES_DIRECTORY}"),
+	}
+
+	process = subprocess.run(command(_RANGES_SCRIPT.format(**names)), stdout=subprocess.PIPE)
+
+	if process.returncode:
+		raise TransferInterrupted("Could not ask the remote what it has staged")
+
+	recorded = _parse_ranges(process.stdout.decode())
+
+	with open(os.path.join(FILES_DIRECTORY, file_hash), "rb") as f:
+		fd = f.fileno()
+
+		# Ranges sent earlier only count if they are what we have. Only those are hashed, the rest
+		# are read once, when sent.
+		missing = [
+			(offset, length)
+			for offset, length in split_ranges(os.fstat(fd).st_size)
+			if (offset, length) not in recorded or recorded[offset, length] != _md5(_read_range(fd, offset, length))
+		]
+
+		def push(offset_length: tuple[int, int]) -> None:
+			offset, length = offset_length
+
+			process = subprocess.Popen(
+				command(_WRITE_RANGE_SCRIPT.format(**names, offset=offset, start=offset + 1, length=length)),
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+			)
+
+			md5sum = hashlib.md5()
+
+			try:
+				for data in _read_range(fd, offset, length):
+					process.stdin.write(data)
+					md5sum.update(data)
+
+				process.stdin.close()
+			except BrokenPipeError:
+				pass  # The receiver stopped, which is reported below
+
+			written = process.stdout.read().decode().strip()
+
+			if process.wait() or written != md5sum.hexdigest():
+				raise TransferInterrupted(f"The range at {offset} of {file_hash} was damaged on the way")
+
+		run_batches(missing, push)
+
+	process = subprocess.run(command(_COMMIT_SCRIPT.format(**names)), stdout=subprocess.PIPE)
+
+	if process.returncode:
+		raise TransferInterrupted(f"Could not store {file_hash} on the remote")
+
+	return process.stdout.decode().strip() == "stored"
+
+
+def _pull_ranged(command: Callable[[str], list[str]], repository_path: str, file_hash: str, size: int) -> bool:
+	from huge.repo.journal import TransferInterrupted
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.transfer import run_batches
+
+	source = shlex.quote(f"{repository_path}/{FILES_DIRECTORY}/{file_hash}")
+
+	with RangedFile(file_hash, size) as ranged:
+		def pull(offset_length: tuple[int, int]) -> None:
+			offset, length = offset_length
+
+			process = subprocess.Popen(
+				command(_READ_RANGE_SCRIPT.format(file=source, start=offset + 1, length=length)),
+				stdout=subprocess.PIPE,
+			)
+
+			try:
+				md5 = ranged.write_range(offset, length, _read_exactly(process.stdout, length))
+				expected = process.stdout.read().decode().strip()
+			except BaseException:
+				process.kill()
+				process.wait()
+				raise
+
+			if process.wait() or md5 != expected:
+				raise TransferInterrupted(f"The range at {offset} of {file_hash} was damaged on the way")
+
+			ranged.finish_range(offset, length, md5)
+
+		run_batches(ranged.get_missing(), pull)
+
+		return ranged.commit()
+
+
+def _get_sizes(command: Callable[[str], list[str]], repository_path: str, file_hashes: set[str]) -> dict[str, int]:
+	from huge.repo.journal import TransferInterrupted
+	from huge.repo.paths import FILES_DIRECTORY
+
+	process = subprocess.run(
+		command(_SIZES_SCRIPT.format(storage=shlex.quote(f"{repository_path}/{FILES_DIRECTORY}"))),
+		input="".join(f"{x}\n" for x in sorted(file_hashes)).encode(),
+		stdout=subprocess.PIPE,
+	)
+
+	if process.returncode:
+		raise TransferInterrupted("Could not get the sizes of the files of the remote")
+
+	result: dict[str, int] = {}
+
+	for x in process.stdout.decode().splitlines():
+		if len(parts := x.split()) == 2 and parts[0] in file_hashes:
+			result[parts[0]] = int(parts[1])
+
+	return result
+
+
+def _md5(chunks: Iterator[bytes]) -> str:
+	md5sum = hashlib.md5()
+
+	for data in chunks:
+		md5sum.update(data)
+
+	return md5sum.hexdigest()
+
+
+@huge_test
+def test_copy_ranged() -> None:
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY
+
+	create_repository()
+	set_config("remote.range-size", "4")
+
+	content = b"0123456789"
+	file_hash = hashlib.md5(content).hexdigest()
+
+	with open("source", "wb") as f:
+		f.write(content)
+
+	assert split_ranges(10) == [(0, 4), (4, 4), (8, 2)]
+	assert is_ranged(10)
+	assert not is_ranged(4)
+
+	# Stopped after the second range
+	with RangedFile(file_hash, len(content)) as ranged:
+		ranged.finish_range(4, 4, ranged.write_range(4, 4, iter([b"45", b"67"])))
+
+	with RangedFile(file_hash, len(content)) as ranged:
+		assert ranged.get_missing() == [(0, 4), (8, 2)]
+
+	assert copy_ranged("source", file_hash)
+
+	with open(os.path.join(FILES_DIRECTORY, file_hash), "rb") as f:
+		assert f.read() == content
+
+	assert not os.path.exists(ranged.data_path)
+	assert not os.path.exists(ranged.ranges_path)
+
+	# Wrong content is never stored
+	assert not copy_ranged("source", "f" * 32)
+	assert not os.path.exists(os.path.join(FILES_DIRECTORY, "f" * 32))
+
+	set_config("remote.range-size", "0")
+	assert not is_ranged(10)
+
+
+@huge_test
+def test_remote_ranged() -> None:
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+	from huge.repo.paths import FILES_DIRECTORY, STAGING_FOLDER
+	from huge.testing import cd
+
+	create_repository()
+	set_config("remote.range-size", "4")
+
+	content = b"0123456789"
+	file_hash = hashlib.md5(content).hexdigest()
+
+	with open(os.path.join(FILES_DIRECTORY, file_hash), "wb") as f:
+		f.write(content)
+
+	os.mkdir("remote")
+
+	with cd("remote"):
+		create_repository()
+
+	# Run the scripts locally instead of on a server
+	def command(script: str) -> list[str]:
+		return ["sh", "-c", script]
+
+	remote = os.path.abspath("remote")
+
+	# An earlier push was stopped after the first range, and left a damaged second range
+	os.makedirs(f"remote/{STAGING_FOLDER}")
+
+	with open(f"remote/{STAGING_FOLDER}/{file_hash}.ranged", "wb") as f:
+		f.write(b"0123XXXX")
+
+	with open(f"remote/{STAGING_FOLDER}/{file_hash}.ranges", "w") as f:
+		f.write(f"0\t4\t{hashlib.md5(b'0123').hexdigest()}\n4\t4\t{hashlib.md5(b'XXXX').hexdigest()}\n")
+
+	# Only the two recorded ranges are hashed before sending
+	with patch("huge.repo.ranges._md5", wraps=_md5) as md5:
+		assert _push_ranged(command, remote, file_hash)
+
+	assert md5.call_count == 2
+	assert os.listdir(f"remote/{STAGING_FOLDER}") == []
+
+	with open(f"remote/{FILES_DIRECTORY}/{file_hash}", "rb") as f:
+		assert f.read() == content
+
+	assert _get_sizes(command, remote, {file_hash, "e" * 32}) == {file_hash: 10}
+
+	os.remove(os.path.join(FILES_DIRECTORY, file_hash))
+
+	assert _pull_ranged(command, remote, file_hash, 10)
+
+	with open(os.path.join(FILES_DIRECTORY, file_hash), "rb") as f:
+		assert f.read() == content
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
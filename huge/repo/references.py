@@ -0,0 +1,159 @@
+"""
+Index of which commits that points at each stored file
+
+Used to figure out if a file can be deleted without reading the files of every commit. Each commit is
+indexed once, when it is created or fetched.
+
+The index is spread over 4096 files in REFERENCES_FOLDER, picked by the first three characters of
+the file's hash sum, so that only the part of the index for the files in question has to be read.
+Each line is "hash sum<TAB>commit hash".
+
+The commits that has been indexed are listed in REFERENCES_FOLDER/commits.
+"""
+import os
+from huge.testing import huge_test
+
+
+def update_references() -> None:
+	"""
+	Index the commits that has not been indexed yet
+	"""
+	from huge.repo.commit import get_commit_files
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.paths import REFERENCES_FOLDER
+
+	commits_to_index = set(get_commit_graph().parents) - _get_indexed_commits()
+
+	if not commits_to_index:
+		return
+
+	# {"shard": ["line\n", ...]}
+	lines: dict[str, list[str]] = {}
+
+	for commit_hash in commits_to_index:
+		for file_hash in set(get_commit_files(commit_hash).values()):
+			lines.setdefault(file_hash[:3], []).append(f"{file_hash}\t{commit_hash}\n")
+
+	if not os.path.isdir(REFERENCES_FOLDER):
+		os.mkdir(REFERENCES_FOLDER)
+
+	for shard, shard_lines in lines.items():
+		with open(os.path.join(REFERENCES_FOLDER, shard), "a") as f:
+			f.writelines(shard_lines)
+
+	# Only mark the commits as indexed after all their files has been written
+	with open(os.path.join(REFERENCES_FOLDER, "commits"), "a") as f:
+		f.writelines(f"{x}\n" for x in commits_to_index)
+
+
+def get_references(file_hashes: set[str]) -> dict[str, set[str]]:
+	"""
+	Get the commits pointing at each of the files
+
+	Returns: {"hash sum": {"commit hash", ...}}
+	"""
+	from huge.repo.paths import REFERENCES_FOLDER
+
+	update_references()
+
+	result: dict[str, set[str]] = {x: set() for x in file_hashes}
+
+	for shard in {x[:3] for x in file_hashes}:
+		if not os.path.isfile(os.path.join(REFERENCES_FOLDER, shard)):
+			continue
+
+		with open(os.path.join(REFERENCES_FOLDER, shard)) as f:
+			for x in f:
+				file_hash, commit_hash = x.rstrip("\n").split("\t")
+				if file_hash in result:
+					result[file_hash].add(commit_hash)
+
+	return result
+
+
+def get_reference_counts(file_hashes: set[str]) -> dict[str, int]:
+	"""
+	Count the commits pointing at each of the files
+
+	Returns: {"hash sum": 2}
+	"""
+	return {file_hash: len(x) for file_hash, x in get_references(file_hashes).items()}
+
+
+def get_exclusive_files(commit_hashes: set[str]) -> set[str]:
+	"""
+	Get the files that are only pointed at by the given commits, and no others
+	"""
+	from huge.repo.commit import get_commit_files
+
+	commit_files: set[str] = {
+		file_hash
+		for commit_hash in commit_hashes
+		for file_hash in get_commit_files(commit_hash).values()
+	}
+
+	return {
+		file_hash
+		for file_hash, referencing_commits in get_references(commit_files).items()
+		if referencing_commits <= commit_hashes
+	}
+
+
+def get_exclusive_size(commit_hashes: set[str]) -> int:
+	"""
+	Count the bytes stored locally that only the given commits are using
+	"""
+	from huge.repo.storage import get_stored_files
+
+	stored_files = get_stored_files()
+
+	return sum(stored_files.get(x, 0) for x in get_exclusive_files(commit_hashes))
+
+
+def _get_indexed_commits() -> set[str]:
+	from huge.repo.paths import REFERENCES_FOLDER
+
+	if not os.path.isfile(os.path.join(REFERENCES_FOLDER, "commits")):
+		return set()
+
+	with open(os.path.join(REFERENCES_FOLDER, "commits")) as f:
+		return {x.strip() for x in f if x.strip()}
+
+
+@huge_test
+def test_references() -> None:
+	from huge.repo import create_repository
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.stage import mark_as_staged
+
+	create_repository()
+
+	with open("a", "w") as f:
+		f.write("Shared")
+
+	mark_as_staged(["a"])
+	create_commit(None)
+	first_commit = get_current_commit()
+
+	with open("b", "w") as f:
+		f.write("Only in second")
+
+	mark_as_staged(["b"])
+	create_commit(None)
+	second_commit = get_current_commit()
+
+	second_files = get_commit_files(second_commit)
+
+	assert get_reference_counts(set(second_files.values())) == {second_files["a"]: 2, second_files["b"]: 1}
+
+	assert get_exclusive_files({first_commit}) == set()
+	assert get_exclusive_files({second_commit}) == {second_files["b"]}
+	assert get_exclusive_files({first_commit, second_commit}) == set(second_files.values())
+
+	assert get_exclusive_size({second_commit}) == len("Only in second")
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -55,3 +55,38 @@ def get_remotes() -> Iterator[RemoteInfo]:
 			remote_hash=x.strip(),
 			last_coverage_update=mtime,
 		)
+
+
+def get_remote_bandwidth(remote_hash: str) -> float | None:
+	"""
+	Get how many bytes per second we have been getting from a remote, or None if never measured
+	"""
+	import os
+	from huge.repo.paths import REMOTES_FOLDER
+
+	path = os.path.join(REMOTES_FOLDER, remote_hash, "bandwidth")
+
+	if not os.path.isfile(path):
+		return None
+
+	with open(path) as f:
+		return float(f.read())
+
+
+def record_remote_bandwidth(remote_hash: str, bytes_transferred: int, seconds: float) -> None:
+	"""
+	Blend a new measurement into the bandwidth of a remote
+
+	Half of the old value is kept, so that a single slow transfer does not count too much.
+	"""
+	import os
+	from huge.repo import atomic_write
+	from huge.repo.paths import REMOTES_FOLDER
+
+	bandwidth = bytes_transferred / max(seconds, .001)
+
+	if (old := get_remote_bandwidth(remote_hash)) is not None:
+		bandwidth = (old + bandwidth) / 2
+
+	with atomic_write(os.path.join(REMOTES_FOLDER, remote_hash, "bandwidth")) as f:
+		f.write(f"{bandwidth:.0f}\n")
@@ -52,14 +52,13 @@ def _local_send(address: str) -> None:
 def _remote_send(parsed_address: SSHAddress) -> None:
 	import subprocess
 	from huge import fail
+	from huge.repo.compression import get_compression_level, rsync_compression
 	from huge.repo.paths import COMMITS_DIRECTORY, FILES_DIRECTORY, REMOTES_FOLDER, REPO_ID_FILE
+	from huge.repo.ssh import rsync_address, rsync_command, ssh_command
 
 	# Create folder
 	process = subprocess.Popen(
-		[
-			"ssh", f"{parsed_address.login}@{parsed_address.server}",
-			"mkdir", "-p", f"{parsed_address.path}/{FILES_DIRECTORY}",
-		]
+		ssh_command(parsed_address) + ["mkdir", "-p", f"{parsed_address.path}/{FILES_DIRECTORY}"]
 	)
 
 	process.wait()
@@ -70,7 +69,9 @@ def _remote_send(parsed_address: SSHAddress) -> None:
 
 	# Send the actual repository metadata
 	process = subprocess.Popen(
-		["rsync", "-ahz", "--info=progress2"] +
+		rsync_command() +
+		["-ah", "--info=progress2"] +
+		rsync_compression(get_compression_level(None)) +
 
 		# Sources
 		[
@@ -80,7 +81,7 @@ def _remote_send(parsed_address: SSHAddress) -> None:
 		] +
 
 		# Destination
-		[f"{parsed_address.login}@{parsed_address.server}:{parsed_address.path}/.huge/"]
+		[rsync_address(parsed_address, f"{parsed_address.path}/.huge/")]
 	)
 
 	process.wait()
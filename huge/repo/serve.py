@@ -0,0 +1,342 @@
+"""
+The agent side of huge.repo.agent, run by 'huge serve --stdio' in the root of a repository
+
+Operations, with what follows the request and the answer:
+
+	hello         -> {"repo_id": ..., "version": ...}
+	list_files    -> {} and a stream of the hash sums of the stored files
+	list_changes  {"epoch": ..., "sequence": ...} -> {"epoch": ..., "sequence": ..., "listed": false}
+	              and a stream of "+hash sum" and "-hash sum" for the files stored and deleted
+	              since, or {..., "listed": true} and a stream of all the stored files, see
+	              huge.repo.storage.get_storage_changes
+	list_commits  -> {} and a stream of commit hashes
+	have          Stream of hash sums -> {} and a stream of the ones that are stored
+	staged        Stream of hash sums -> {"offsets": {"hash sum": offset}} of the files that are
+	              partly received, see huge.repo.staging
+	get_files     {"offsets": {"hash sum": offset}} and a stream of hash sums -> {}, then for each
+	              file {"file": ..., "offset": ...} and a stream of its content from offset, or
+	              {"file": ..., "missing": true}, ended by {"done": true}
+	put_files     For each file {"file": ..., "offset": ...} and a stream of its content from offset,
+	              ended by {"done": true} -> {} and a stream of the hash sums of the files that were
+	              stored
+	put_delta     {"file": ..., "base": ...} and a stream of the delta, see huge.repo.delta ->
+	              {"stored": true or false}
+	get_commits   Stream of commit hashes -> {}, then {"commit": ..., "files": {"name": "content"}}
+	              for each commit that exists, ended by {"done": true}
+	put_commits   {"commit": ..., "files": {"name": "content"}} for each commit, ended by
+	              {"done": true} -> {}
+
+A request that fails before reading or writing any stream is answered with an error, and the session
+goes on. After that the error can not be told apart from the frames the other end expects, so the
+session is ended instead, which the other end sees as an AgentError.
+
+Nothing may be written to stdout except the answers, so output() must not be used here.
+"""
+import os
+from typing import BinaryIO, Callable
+from huge.testing import huge_test
+
+
+def serve(input: BinaryIO, output: BinaryIO) -> None:
+	"""
+	Answer requests until the other end closes the connection, or a request fails in the middle
+	"""
+	from huge import error
+	from huge.repo.agent import AgentError, read_message, write_message
+
+	counted_input = _CountingStream(input)
+	counted_output = _CountingStream(output)
+
+	while (request := read_message(counted_input)) is not None:
+		operation = _OPERATIONS.get(request.get("op"))
+		position = (counted_input.count, counted_output.count)
+
+		if operation is None:
+			write_message(output, {"error": f"Unsupported operation {request.get('op')!r}"})
+		else:
+			try:
+				operation(request, counted_input, counted_output)
+			except Exception as exception:
+				message = str(exception) if isinstance(exception, AgentError) else f"{type(exception).__name__}: {exception}"
+
+				if (counted_input.count, counted_output.count) != position:
+					error(f"Ending the session, {request['op']} failed: {message}")
+					output.flush()
+					return
+
+				write_message(output, {"error": message})
+
+		output.flush()
+
+
+class _CountingStream:
+	"""
+	Counts the bytes read from and written to a stream, to tell whether an operation has used it
+	"""
+
+	def __init__(self, stream: BinaryIO):
+		self.stream = stream
+		self.count = 0
+
+	def read(self, size: int = -1) -> bytes:
+		data = self.stream.read(size)
+		self.count += len(data)
+		return data
+
+	def write(self, data: bytes) -> int:
+		self.count += len(data)
+		return self.stream.write(data)
+
+	def flush(self) -> None:
+		self.stream.flush()
+
+
+def _hello(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import PROTOCOL_VERSION, write_message
+	from huge.repo.paths import REPO_ID_FILE
+
+	with open(REPO_ID_FILE) as f:
+		write_message(output, {"repo_id": f.read().strip(), "version": PROTOCOL_VERSION})
+
+
+def _list_files(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import write_lines, write_message
+	from huge.repo.storage import get_stored_files
+
+	write_message(output, {})
+	write_lines(output, get_stored_files())
+
+
+def _list_changes(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import write_lines, write_message
+	from huge.repo.storage import get_storage_changes
+
+	changes = get_storage_changes(str(request.get("epoch", "")), int(request.get("sequence", 0)))
+
+	write_message(output, {"epoch": changes.epoch, "sequence": changes.sequence, "listed": changes.files is not None})
+
+	if changes.files is not None:
+		write_lines(output, changes.files)
+	else:
+		write_lines(output, [f"+{x}" for x in changes.added] + [f"-{x}" for x in changes.removed])
+
+
+def _list_commits(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import write_lines, write_message
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	write_message(output, {})
+	write_lines(output, os.listdir(COMMITS_DIRECTORY))
+
+
+def _have(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import read_lines, write_lines, write_message
+	from huge.repo.storage import get_stored_files
+
+	file_hashes = set(read_lines(input))
+
+	write_message(output, {})
+	write_lines(output, file_hashes & get_stored_files().keys())
+
+
+def _staged(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	import re
+	from huge.repo.agent import read_lines, write_message
+	from huge.repo.staging import get_staged_offsets
+
+	file_hashes = {x for x in read_lines(input) if re.match("^[0-9a-f]{32}$", x)}
+
+	write_message(output, {"offsets": get_staged_offsets(file_hashes)})
+
+
+def _get_files(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import read_lines, write_file, write_message
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.storage import get_stored_files
+
+	offsets = request.get("offsets", {})
+	file_hashes = set(read_lines(input))
+
+	write_message(output, {})
+
+	stored_files = get_stored_files()
+
+	for file_hash in file_hashes:
+		if file_hash in stored_files:
+			offset = min(offsets.get(file_hash, 0), stored_files[file_hash])
+
+			write_message(output, {"file": file_hash, "offset": offset})
+			write_file(output, os.path.join(FILES_DIRECTORY, file_hash), offset)
+		else:
+			write_message(output, {"file": file_hash, "missing": True})
+
+	write_message(output, {"done": True})
+
+
+def _put_files(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	import re
+	from huge.repo.agent import read_message, read_stream, receive_file, write_lines, write_message
+	from huge.repo.storage import add_stored_files
+
+	stored: set[str] = set()
+
+	while "file" in (message := read_message(input) or {}):
+		file_hash = message["file"]
+
+		if not re.match("^[0-9a-f]{32}$", file_hash):
+			for _ in read_stream(input):
+				pass
+
+			continue
+
+		# Files damaged on the way are thrown away
+		if receive_file(input, file_hash, message.get("offset", 0)):
+			stored.add(file_hash)
+
+	add_stored_files(stored)
+
+	write_message(output, {})
+	write_lines(output, stored)
+
+
+def _put_delta(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	import re
+	from huge.repo.agent import write_message
+	from huge.repo.delta import apply_delta, read_delta
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.staging import stage_stream
+	from huge.repo.storage import add_stored_files, get_stored_files
+
+	file_hash = request.get("file", "")
+	base_hash = request.get("base", "")
+
+	ops = read_delta(input)
+	stored = False
+
+	if re.match("^[0-9a-f]{32}$", file_hash) and base_hash in get_stored_files():
+		# Files damaged on the way are thrown away
+		stored = stage_stream(file_hash, apply_delta(os.path.join(FILES_DIRECTORY, base_hash), ops), 0)
+
+	for _ in ops:
+		pass
+
+	if stored:
+		add_stored_files({file_hash})
+
+	write_message(output, {"stored": stored})
+
+
+def _get_commits(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import read_commit, read_lines, write_message
+	from huge.repo.paths import COMMITS_DIRECTORY
+
+	commit_hashes = set(read_lines(input))
+
+	write_message(output, {})
+
+	for commit_hash in commit_hashes & set(os.listdir(COMMITS_DIRECTORY)):
+		write_message(output, {"commit": commit_hash, "files": read_commit(commit_hash)})
+
+	write_message(output, {"done": True})
+
+
+def _put_commits(request: dict, input: BinaryIO, output: BinaryIO) -> None:
+	from huge.repo.agent import AgentError, read_message, write_commit, write_message
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.history import update_path_history
+	from huge.repo.references import update_references
+
+	while "commit" in (message := read_message(input) or {}):
+		try:
+			write_commit(message["commit"], message["files"])
+		except AgentError:
+			pass  # Invalid commits are left out
+
+	get_commit_graph()
+	update_path_history()
+	update_references()
+
+	write_message(output, {})
+
+
+_OPERATIONS: dict[str, Callable[[dict, BinaryIO, BinaryIO], None]] = {
+	"hello": _hello,
+	"list_files": _list_files,
+	"list_changes": _list_changes,
+	"list_commits": _list_commits,
+	"have": _have,
+	"staged": _staged,
+	"get_files": _get_files,
+	"put_files": _put_files,
+	"put_delta": _put_delta,
+	"get_commits": _get_commits,
+	"put_commits": _put_commits,
+}
+
+
+@huge_test
+def test_serve_failure() -> None:
+	import io
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.agent import AgentError, read_message, read_stream, write_frame, write_lines, write_message
+	from huge.repo.paths import FILES_DIRECTORY
+	from huge.repo.storage import add_stored_files
+	from huge.testing import catch_error
+
+	create_repository()
+
+	with open(os.path.join(FILES_DIRECTORY, "a" * 32), "w") as f:
+		f.write("Content")
+
+	add_stored_files({"a" * 32})
+
+	def answer(*requests: tuple[dict, list[str] | None]) -> io.BytesIO:
+		input = io.BytesIO()
+
+		for message, lines in requests:
+			write_message(input, message)
+
+			if lines is not None:
+				write_lines(input, lines)
+
+		input.seek(0)
+		output = io.BytesIO()
+		serve(input, output)
+		output.seek(0)
+
+		return output
+
+	# A failure before any stream is used is answered, and the next request too
+	output = answer(({"op": "list_changes", "sequence": "x"}, None), ({"op": "list_commits"}, None))
+	assert "ValueError" in read_message(output)["error"]
+	assert read_message(output) == {}
+
+	# A failure in the middle of sending a file ends the session instead of answering
+	def broken_write_file(stream: BinaryIO, path: str, offset: int = 0) -> None:
+		write_frame(stream, b"Cont")
+		raise OSError("Disk failed")
+
+	with patch("huge.repo.agent.write_file", new=broken_write_file), catch_error() as errors:
+		output = answer(({"op": "get_files"}, ["a" * 32]), ({"op": "list_commits"}, None))
+
+	assert "Disk failed" in errors.getvalue()
+
+	assert read_message(output) == {}
+	assert read_message(output) == {"file": "a" * 32, "offset": 0}
+
+	try:
+		for _ in read_stream(output):
+			pass
+
+		assert False
+	except AgentError:
+		pass
+
+	assert read_message(output) is None
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
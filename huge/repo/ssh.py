@@ -1,32 +1,176 @@
 """
 Common methods for communication over SSH
+
+All ssh and rsync processes started for a server during a command share a single SSH connection,
+using OpenSSH's ControlMaster. The first process to connect becomes the master and the rest sends
+their traffic through it, so that the handshake is only done once per server. The masters are
+closed by close_connections() when the command finishes.
+
+If the "remote.agent" setting is set, connect_agent() starts an agent on the server instead, see
+huge.repo.agent. The agents are also kept for the whole command.
 """
+import threading
 from huge.repo.address import SSHAddress
+from huge.repo.agent import Agent
+from huge.testing import huge_test
+
+# Folder with the control sockets of the masters, created when first needed
+_control_folder: str | None = None
+
+# Servers we might have a master running for: {"login@server", ...}
+_servers: set[str] = set()
+
+# {"login@server:/path": Agent}
+_agents: dict[str, Agent] = {}
+
+_lock = threading.RLock()
+
+
+def ssh_command(address: SSHAddress) -> list[str]:
+	"""
+	Start of the command line for running a command on the server through the shared connection
+
+	Usage:
+		subprocess.Popen(ssh_command(address) + ["ls", path])
+	"""
+	_servers.add(f"{address.login}@{address.server}")
+
+	return ["ssh"] + _ssh_options() + [f"{address.login}@{address.server}"]
+
+
+def ssh_shell_command(address: SSHAddress, script: str) -> list[str]:
+	"""
+	Command line for running a shell script on the server through the shared connection
+	"""
+	import shlex
+
+	# ssh joins its arguments to a single command line for the login shell of the server
+	return ssh_command(address) + [shlex.join(["sh", "-c", script])]
+
+
+def rsync_command() -> list[str]:
+	"""
+	Start of the command line for rsync, which sends any remote paths through the shared connections
+
+	The servers must have been registered with ssh_command() for their master to be closed at the
+	end of the command. rsync_address() does that.
+	"""
+	import shlex
+
+	return ["rsync", "-e", shlex.join(["ssh"] + _ssh_options())]
+
+
+def rsync_address(address: SSHAddress, path: str) -> str:
+	"""
+	Format a remote path for rsync, e.g "login@server:/repository/.huge/storage/"
+	"""
+	_servers.add(f"{address.login}@{address.server}")
 
+	return f"{address.login}@{address.server}:{path}"
 
-def get_remote_files(address: SSHAddress) -> set[str]:
+
+def connect_agent(address: SSHAddress) -> Agent | None:
+	"""
+	Get the agent running in the repository on the server, starting it if needed
+
+	Returns None if the "remote.agent" setting is not set.
 	"""
-	Retrieve a list of available files from remote
+	import shlex
+	from huge.repo.config import get_config
+
+	if not (agent_command := get_config("remote.agent")):
+		return None
+
+	with _lock:
+		if str(address) not in _agents:
+			_agents[str(address)] = Agent(
+				ssh_command(address) + [f"cd {shlex.quote(address.path)} && {agent_command}"],
+			)
+
+		return _agents[str(address)]
+
 
-	Returns the hashes of the files.
+def close_connections() -> None:
 	"""
+	Close all the agents and shared connections opened by this command
+	"""
+	import shutil
 	import subprocess
-	from huge import fail
-	from huge.repo.paths import FILES_DIRECTORY
 
-	process = subprocess.Popen(
-		[
-			"ssh", f"{address.login}@{address.server}",
-			"ls", f"{address.path}/{FILES_DIRECTORY}",
-		],
-		stdout=subprocess.PIPE,
-	)
+	global _control_folder
+
+	for agent in _agents.values():
+		agent.close()
+
+	_agents.clear()
+
+	if _control_folder is None:
+		return
+
+	for server in _servers:
+		subprocess.run(
+			["ssh"] + _ssh_options() + ["-O", "exit", server],
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+		)
+
+	shutil.rmtree(_control_folder, ignore_errors=True)
+
+	_control_folder = None
+	_servers.clear()
+
+
+def _ssh_options() -> list[str]:
+	import tempfile
+	from huge.repo.config import get_duration_config
+
+	global _control_folder
+
+	# Not inside the repository, as the path of a socket can not be longer than about 100 bytes
+	with _lock:
+		if _control_folder is None:
+			_control_folder = tempfile.mkdtemp(prefix="huge-ssh-")
+
+	return [
+		"-o", "ControlMaster=auto",
+		"-o", f"ControlPath={_control_folder}/%C",
+		"-o", "ControlPersist=yes",
+		"-o", f"ConnectTimeout={int(get_duration_config('remote.connect-timeout'))}",
+	]
+
+
+@huge_test
+def test_ssh_command() -> None:
+	import os
+	from huge.repo import create_repository
+
+	create_repository()
+
+	address = SSHAddress(login="login", server="server", path="/repository")
+
+	assert connect_agent(address) is None
+
+	command = ssh_command(address)
+	assert command[0] == "ssh"
+	assert command[-1] == "login@server"
+	assert "ControlMaster=auto" in command
+
+	assert rsync_command()[:2] == ["rsync", "-e"]
+	assert "ControlPath=" in rsync_command()[2]
+	assert rsync_address(address, "/repository/.huge/") == "login@server:/repository/.huge/"
+
+	control_folder = _control_folder
+	assert os.path.isdir(control_folder)
 
-	remote_files, _ = process.communicate()
+	# The server is not reachable, so there are no masters to stop
+	_servers.clear()
+	close_connections()
 
-	if process.returncode:
-		fail("Could not transfer files")
-		return {}
+	assert not os.path.isdir(control_folder)
+	assert _control_folder is None
 
-	return {x.strip() for x in remote_files.decode().splitlines()}
 
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,277 @@
+"""
+Staging area for files being transferred into FILES_DIRECTORY
+
+Large files can take hours to transfer, so a transfer that is stopped should not have to start over.
+Files are received into STAGING_FOLDER, and a digest of each BLOCK_SIZE bytes is written down as soon
+as the block is on disk. The next transfer of the file continues after the last block that still
+matches its digest. When the file is complete its content is checked against its hash sum, and it is
+moved into FILES_DIRECTORY.
+
+For each file being received there are two files in STAGING_FOLDER:
+
+	<hash sum>         The content received so far
+	<hash sum>.blocks  A line "offset<TAB>md5 of the block" for each complete block
+"""
+import hashlib
+import os
+from typing import Iterable
+from huge.testing import huge_test
+
+BLOCK_SIZE = 16 * 2**20
+
+
+class StagedFile:
+	"""
+	A file being received, continuing from what an earlier transfer left behind
+
+	Usage:
+		with StagedFile(file_hash) as staged, open(source_path, "rb") as f:
+			f.seek(staged.offset)
+
+			while data := f.read(CHUNK_SIZE):
+				staged.write(data)
+
+			staged.commit()
+	"""
+
+	def __init__(self, file_hash: str, path: str = "."):
+		from huge.repo.paths import STAGING_FOLDER
+
+		self.file_hash = file_hash
+		self.path = path
+
+		os.makedirs(os.path.join(path, STAGING_FOLDER), exist_ok=True)
+
+		self.data_path = os.path.join(path, STAGING_FOLDER, file_hash)
+		self.blocks_path = self.data_path + ".blocks"
+
+		# Digest of the whole file, and of the block being received
+		self.md5sum = hashlib.md5()
+		self.block = hashlib.md5()
+		self.block_size = 0
+
+		self.offset = self._resume()
+
+		self.file = open(self.data_path, "r+b" if os.path.isfile(self.data_path) else "wb")
+		self.file.seek(self.offset)
+		self.file.truncate()
+
+		self.blocks = open(self.blocks_path, "a")
+
+	def __enter__(self) -> "StagedFile":
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+	def _resume(self) -> int:
+		"""
+		Check the blocks received earlier, returning where to continue
+		"""
+		from huge.repo import atomic_write
+
+		if not os.path.isfile(self.data_path) or not os.path.isfile(self.blocks_path):
+			return 0
+
+		digests: list[str] = []
+
+		with open(self.blocks_path) as f, open(self.data_path, "rb") as g:
+			for x in f:
+				parts = x.strip().split("\t")
+
+				if not x.endswith("\n") or len(parts) != 2 or int(parts[0]) != len(digests) * BLOCK_SIZE:
+					break
+
+				data = g.read(BLOCK_SIZE)
+
+				if len(data) != BLOCK_SIZE or hashlib.md5(data).hexdigest() != parts[1]:
+					break
+
+				self.md5sum.update(data)
+				digests.append(parts[1])
+
+		with atomic_write(self.blocks_path) as f:
+			f.writelines(f"{i * BLOCK_SIZE}\t{x}\n" for i, x in enumerate(digests))
+
+		return len(digests) * BLOCK_SIZE
+
+	def write(self, data: bytes) -> None:
+		view = memoryview(data)
+
+		while view:
+			part, view = view[:BLOCK_SIZE - self.block_size], view[BLOCK_SIZE - self.block_size:]
+
+			self.file.write(part)
+			self.md5sum.update(part)
+			self.block.update(part)
+			self.block_size += len(part)
+
+			if self.block_size == BLOCK_SIZE:
+				# The content must be on disk before its digest, or a crash could leave a digest
+				# for a block that was never written
+				self.file.flush()
+				os.fsync(self.file.fileno())
+
+				self.blocks.write(f"{self.offset}\t{self.block.hexdigest()}\n")
+				self.blocks.flush()
+				os.fsync(self.blocks.fileno())
+
+				self.offset += BLOCK_SIZE
+				self.block = hashlib.md5()
+				self.block_size = 0
+
+	def commit(self) -> bool:
+		"""
+		Move the complete file into FILES_DIRECTORY, if its content is correct
+
+		A file with the wrong content is thrown away, and False returned.
+		"""
+		from huge.repo.encoding import check_content
+		from huge.repo.paths import FILES_DIRECTORY
+
+		self.close()
+
+		if not check_content(self.data_path, self.file_hash, self.md5sum.hexdigest()):
+			self.discard()
+			return False
+
+		os.replace(self.data_path, os.path.join(self.path, FILES_DIRECTORY, self.file_hash))
+		os.remove(self.blocks_path)
+
+		return True
+
+	def close(self) -> None:
+		"""
+		Stop receiving, keeping what has been received for later
+		"""
+		self.file.close()
+		self.blocks.close()
+
+	def discard(self) -> None:
+		self.close()
+
+		for x in [self.data_path, self.blocks_path]:
+			if os.path.isfile(x):
+				os.remove(x)
+
+
+def stage_stream(file_hash: str, chunks: Iterable[bytes], offset: int, path: str = ".") -> bool:
+	"""
+	Receive the content of a file, sent from offset, into the staging area of a repository
+
+	The file is moved into FILES_DIRECTORY when complete, if its content matches file_hash. Returns
+	whether it was. If less than offset turns out to be staged, the content can not be used and is
+	skipped, and the file has to be sent again from where the staging area really is.
+	"""
+	with StagedFile(file_hash, path) as staged:
+		skip = staged.offset - offset
+
+		for data in chunks:
+			if skip < 0:
+				continue
+
+			if skip >= len(data):
+				skip -= len(data)
+				continue
+
+			staged.write(data[skip:])
+			skip = 0
+
+		return skip >= 0 and staged.commit()
+
+
+def get_staged_offsets(file_hashes: set[str], path: str = ".") -> dict[str, int]:
+	"""
+	Get how much has been received of files that are partly staged
+
+	Read from the block digests only, so the content may turn out to be shorter when it is checked.
+
+	Returns: {"hash sum": offset}, for the files with at least one block
+	"""
+	from huge.repo.paths import STAGING_FOLDER
+
+	result: dict[str, int] = {}
+
+	for file_hash in file_hashes:
+		blocks_path = os.path.join(path, STAGING_FOLDER, f"{file_hash}.blocks")
+
+		if os.path.isfile(blocks_path):
+			with open(blocks_path) as f:
+				if count := sum(1 for x in f if x.endswith("\n")):
+					result[file_hash] = count * BLOCK_SIZE
+
+	return result
+
+
+def store_verified(source_path: str, file_hash: str, path: str = ".") -> bool:
+	"""
+	Move a complete file received by other means into FILES_DIRECTORY, if its content is correct
+
+	A file with the wrong content is deleted, and False returned.
+	"""
+	from huge.repo.encoding import check_content
+	from huge.repo.paths import FILES_DIRECTORY
+
+	md5sum = hashlib.md5()
+
+	with open(source_path, "rb") as f:
+		while data := f.read(BLOCK_SIZE):
+			md5sum.update(data)
+
+	if not check_content(source_path, file_hash, md5sum.hexdigest()):
+		os.remove(source_path)
+		return False
+
+	os.replace(source_path, os.path.join(path, FILES_DIRECTORY, file_hash))
+
+	return True
+
+
+@huge_test
+def test_staged_file() -> None:
+	from unittest.mock import patch
+	from huge.repo import create_repository
+	from huge.repo.paths import FILES_DIRECTORY
+
+	create_repository()
+
+	with patch(f"{__name__}.BLOCK_SIZE", 4):
+		content = b"0123456789abcdefghij"
+		file_hash = hashlib.md5(content).hexdigest()
+
+		# Stopped in the middle of the third block
+		with StagedFile(file_hash) as staged:
+			assert staged.offset == 0
+			staged.write(content[:10])
+
+		assert get_staged_offsets({file_hash, "f" * 32}) == {file_hash: 8}
+
+		# The second block is damaged, so only the first one is kept
+		with open(staged.data_path, "r+b") as f:
+			f.seek(5)
+			f.write(b"X")
+
+		with StagedFile(file_hash) as staged:
+			assert staged.offset == 4
+			staged.write(content[4:])
+			assert staged.commit()
+
+		with open(os.path.join(FILES_DIRECTORY, file_hash), "rb") as f:
+			assert f.read() == content
+
+		assert not os.path.exists(staged.data_path)
+		assert not os.path.exists(staged.blocks_path)
+
+		# Wrong content is never stored
+		with StagedFile("f" * 32) as staged:
+			staged.write(content)
+			assert not staged.commit()
+
+		assert not os.path.exists(os.path.join(FILES_DIRECTORY, "f" * 32))
+		assert not os.path.exists(staged.data_path)
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
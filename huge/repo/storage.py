@@ -0,0 +1,477 @@
+"""
+Index of the files stored in FILES_DIRECTORY
+
+Listing FILES_DIRECTORY takes a long time when it contains millions of files, so the names and
+sizes of the stored files are kept in STORAGE_INDEX_FILE instead.
+
+The index remembers the modification time of FILES_DIRECTORY it was written for. If the directory
+has been changed by someone else, e.g a remote pushing files to us with rsync, the index is brought
+up to date with a single listing before it is used.
+
+Every change to the index is also appended to STORAGE_LOG_FILE, so that other repositories can
+follow what is stored here without listing all of it each time. The log starts with a random epoch
+on a line of its own, followed by lines of "+<hash sum>" for files added and "-<hash sum>" for files
+removed. The lines have a fixed length, so the sequence number of an entry is its position in the
+log, and the entries after a sequence number are read by seeking past the ones before. Compacting
+the log starts a new epoch, and readers of the old one must list the files again.
+"""
+import os
+from dataclasses import dataclass, field
+from huge.testing import huge_test
+
+# Length of the epoch line and of each entry of STORAGE_LOG_FILE
+LOG_HEADER_SIZE = 33
+LOG_LINE_SIZE = 34
+
+# {"/absolute/path/to/repository": (FILES_DIRECTORY mtime, {"hash sum": size})}
+_cache: dict[str, tuple[int, dict[str, int]]] = {}
+
+
+def get_stored_files(path: str = ".") -> dict[str, int]:
+	"""
+	Get all the files stored in a repository and their sizes
+
+	Format: {"hash sum": size}
+
+	The returned dict is shared for the whole command and must not be modified by the caller.
+	"""
+	from huge.repo.paths import FILES_DIRECTORY
+
+	key = os.path.abspath(path)
+	directory_mtime = os.stat(os.path.join(path, FILES_DIRECTORY)).st_mtime_ns
+
+	if key in _cache and _cache[key][0] == directory_mtime:
+		return _cache[key][1]
+
+	index_mtime, stored_files = _read_index(path)
+
+	if index_mtime != directory_mtime:
+		previous = stored_files
+		stored_files = _scan_storage(path, previous)
+		_write_index(path, directory_mtime, stored_files, previous)
+
+	_cache[key] = (directory_mtime, stored_files)
+
+	return stored_files
+
+
+def add_stored_files(file_hashes: set[str], path: str = ".") -> None:
+	"""
+	Register files that has been moved into FILES_DIRECTORY
+	"""
+	from huge.repo.metadata import record_stored
+	from huge.repo.paths import FILES_DIRECTORY
+
+	if not file_hashes:
+		return
+
+	# Read the directory mtime before the sizes, so that files changed by others in the meantime
+	# makes the index look outdated.
+	directory_mtime = os.stat(os.path.join(path, FILES_DIRECTORY)).st_mtime_ns
+
+	previous, stored_files = _get_previous(path, directory_mtime)
+
+	for file_hash in file_hashes:
+		stored_files[file_hash] = os.path.getsize(os.path.join(path, FILES_DIRECTORY, file_hash))
+
+	_write_index(path, directory_mtime, stored_files, previous)
+	_cache[os.path.abspath(path)] = (directory_mtime, stored_files)
+
+	record_stored(file_hashes, path)
+
+
+def remove_stored_files(file_hashes: set[str], path: str = ".") -> None:
+	"""
+	Unregister files that has been deleted from FILES_DIRECTORY
+	"""
+	from huge.repo.paths import FILES_DIRECTORY
+
+	if not file_hashes:
+		return
+
+	directory_mtime = os.stat(os.path.join(path, FILES_DIRECTORY)).st_mtime_ns
+
+	previous, current = _get_previous(path, directory_mtime)
+
+	stored_files = {
+		file_hash: size
+		for file_hash, size in current.items()
+		if file_hash not in file_hashes
+	}
+
+	_write_index(path, directory_mtime, stored_files, previous)
+	_cache[os.path.abspath(path)] = (directory_mtime, stored_files)
+
+
+def verify_storage_index(path: str = ".") -> tuple[set[str], set[str], set[str]]:
+	"""
+	Compare the index against the actual files in FILES_DIRECTORY
+
+	Returns: (files missing from storage, files missing from index, files with wrong size)
+	"""
+	from huge.repo.paths import FILES_DIRECTORY
+
+	_, indexed_files = _read_index(path)
+
+	actual_files: dict[str, int] = {
+		entry.name: entry.stat().st_size
+		for entry in os.scandir(os.path.join(path, FILES_DIRECTORY))
+		if is_file_hash(entry.name) and entry.is_file()
+	}
+
+	return (
+		set(indexed_files) - set(actual_files),
+		set(actual_files) - set(indexed_files),
+		{
+			file_hash
+			for file_hash, size in indexed_files.items()
+			if file_hash in actual_files and actual_files[file_hash] != size
+		},
+	)
+
+
+def rebuild_storage_index(path: str = ".") -> None:
+	"""
+	Throw away the index and create it from scratch
+	"""
+	from huge.repo.paths import FILES_DIRECTORY
+
+	_, previous = _read_index(path)
+
+	directory_mtime = os.stat(os.path.join(path, FILES_DIRECTORY)).st_mtime_ns
+	stored_files = _scan_storage(path, {})
+
+	_write_index(path, directory_mtime, stored_files, previous)
+	_cache[os.path.abspath(path)] = (directory_mtime, stored_files)
+
+
+def forget_stored_files() -> None:
+	_cache.clear()
+
+
+def is_file_hash(name: str) -> bool:
+	"""
+	Whether a name in FILES_DIRECTORY is a stored file, and not e.g a temporary file
+	"""
+	import re
+
+	return re.match("^[0-9a-f]{32}$", name) is not None
+
+
+@dataclass
+class StorageChanges:
+	"""
+	What was stored and deleted in a repository since a position in its STORAGE_LOG_FILE
+	"""
+	# Position in the log the changes go up to
+	epoch: str
+	sequence: int
+
+	added: set[str] = field(default_factory=set)
+	removed: set[str] = field(default_factory=set)
+
+	# All the stored files, when the changes could not be read from the position asked for
+	files: set[str] | None = None
+
+
+def get_storage_changes(epoch: str, sequence: int, path: str = ".") -> StorageChanges:
+	"""
+	Get the changes to the storage of a repository since a position in its log
+
+	Only the end of the log is read, unless the position is from another epoch, in which case all
+	the stored files are listed instead. Give an empty epoch to always get the files listed.
+	"""
+	from huge.repo.paths import FILES_DIRECTORY, STORAGE_INDEX_FILE
+
+	# Files put into FILES_DIRECTORY without us knowing are only found by listing it, see the top
+	index_path = os.path.join(path, STORAGE_INDEX_FILE)
+	index_mtime = None
+
+	if os.path.isfile(index_path):
+		with open(index_path) as f:
+			index_mtime = int(f.readline())
+
+	if index_mtime != os.stat(os.path.join(path, FILES_DIRECTORY)).st_mtime_ns:
+		get_stored_files(path)
+
+	current_epoch, current_sequence = _get_log_position(path)
+
+	if not epoch or epoch != current_epoch or sequence > current_sequence:
+		return StorageChanges(current_epoch, current_sequence, files=set(get_stored_files(path)))
+
+	with open(_log_path(path), "rb") as f:
+		f.seek(LOG_HEADER_SIZE + LOG_LINE_SIZE * sequence)
+		data = f.read(LOG_LINE_SIZE * (current_sequence - sequence))
+
+	return parse_storage_log(current_epoch, sequence, data)
+
+
+def parse_storage_log(epoch: str, sequence: int, data: bytes) -> StorageChanges:
+	"""
+	Read the entries of STORAGE_LOG_FILE following a sequence number
+
+	An incomplete entry at the end, still being written, is left for the next time.
+	"""
+	changes = StorageChanges(epoch, sequence)
+
+	for line in data.decode().splitlines(keepends=True):
+		if len(line) != LOG_LINE_SIZE:
+			break
+
+		file_hash = line[1:-1]
+
+		if line[0] == "+":
+			changes.added.add(file_hash)
+			changes.removed.discard(file_hash)
+		else:
+			changes.removed.add(file_hash)
+			changes.added.discard(file_hash)
+
+		changes.sequence += 1
+
+	return changes
+
+
+def compact_storage_log(path: str = ".") -> bool:
+	"""
+	Start the log over in a new epoch, if it has grown much longer than the index
+
+	Returns whether it was compacted.
+	"""
+	from huge.repo import atomic_write, create_hash
+
+	_, sequence = _get_log_position(path)
+
+	if sequence <= 2**16 + 4 * len(get_stored_files(path)):
+		return False
+
+	with atomic_write(_log_path(path)) as f:
+		f.write(f"{create_hash()}\n")
+
+	return True
+
+
+def _get_previous(path: str, directory_mtime: int) -> tuple[dict[str, int], dict[str, int]]:
+	"""
+	Get the index as it was before the caller moved files in or out of FILES_DIRECTORY, and a copy
+	of it brought up to date with the directory
+
+	The index read earlier by the command is used, when there is one. Unless the directory is as it
+	was then, it is listed again, as others might have moved files in or out too. Only new files are
+	asked for their size.
+	"""
+	if (key := os.path.abspath(path)) in _cache:
+		index_mtime, previous = _cache[key]
+	else:
+		index_mtime, previous = _read_index(path)
+
+	if index_mtime == directory_mtime:
+		return previous, dict(previous)
+
+	return previous, _scan_storage(path, previous)
+
+
+def _read_index(path: str) -> tuple[int | None, dict[str, int]]:
+	from huge.repo.paths import STORAGE_INDEX_FILE
+
+	if not os.path.isfile(os.path.join(path, STORAGE_INDEX_FILE)):
+		return None, {}
+
+	result: dict[str, int] = {}
+
+	with open(os.path.join(path, STORAGE_INDEX_FILE)) as f:
+		directory_mtime = int(f.readline())
+
+		for x in f:
+			file_hash, size = x.split("\t")
+			result[file_hash] = int(size)
+
+	return directory_mtime, result
+
+
+def _write_index(path: str, directory_mtime: int, stored_files: dict[str, int], previous: dict[str, int]) -> None:
+	from huge.repo import atomic_write
+	from huge.repo.paths import STORAGE_INDEX_FILE
+
+	# The log is written first, as a change missing from it would never be seen by the remotes
+	_append_log(path, stored_files.keys() - previous.keys(), previous.keys() - stored_files.keys())
+
+	with atomic_write(os.path.join(path, STORAGE_INDEX_FILE)) as f:
+		f.write(f"{directory_mtime}\n")
+		f.writelines(f"{file_hash}\t{size}\n" for file_hash, size in stored_files.items())
+
+
+def _append_log(path: str, added: set[str], removed: set[str]) -> None:
+	# Entries are of fixed length, so other names would shift all the following ones
+	added = {x for x in added if is_file_hash(x)}
+	removed = {x for x in removed if is_file_hash(x)}
+
+	if not (added or removed):
+		return
+
+	# Makes sure the log has an epoch
+	_, sequence = _get_log_position(path)
+
+	with open(_log_path(path), "a") as f:
+		# Cut off an entry left incomplete by a crash, which would shift all the following ones
+		f.truncate(LOG_HEADER_SIZE + LOG_LINE_SIZE * sequence)
+
+		f.writelines(f"-{x}\n" for x in removed)
+		f.writelines(f"+{x}\n" for x in added)
+
+
+def _get_log_position(path: str) -> tuple[str, int]:
+	"""
+	Get the epoch of the log and the sequence number of its next entry, starting a new log if needed
+	"""
+	from huge.repo import atomic_write, create_hash
+
+	log_path = _log_path(path)
+
+	if not os.path.isfile(log_path) or os.path.getsize(log_path) < LOG_HEADER_SIZE:
+		with atomic_write(log_path) as f:
+			f.write(f"{create_hash()}\n")
+
+	with open(log_path) as f:
+		epoch = f.readline().strip()
+
+	return epoch, (os.path.getsize(log_path) - LOG_HEADER_SIZE) // LOG_LINE_SIZE
+
+
+def _log_path(path: str) -> str:
+	from huge.repo.paths import STORAGE_LOG_FILE
+
+	return os.path.join(path, STORAGE_LOG_FILE)
+
+
+def _scan_storage(path: str, known_files: dict[str, int]) -> dict[str, int]:
+	"""
+	List FILES_DIRECTORY, only asking for the size of files we don't know about already
+
+	Anything not named by a hash sum, like temporary files, is not a stored file and is skipped.
+	"""
+	from huge.repo.paths import FILES_DIRECTORY
+
+	return {
+		entry.name: known_files[entry.name] if entry.name in known_files else entry.stat().st_size
+		for entry in os.scandir(os.path.join(path, FILES_DIRECTORY))
+		if is_file_hash(entry.name) and entry.is_file()
+	}
+
+
+@huge_test
+def test_storage_index() -> None:
+	from huge.repo import create_repository
+	from huge.repo.paths import FILES_DIRECTORY
+
+	create_repository()
+
+	assert get_stored_files() == {}
+
+	with open(os.path.join(FILES_DIRECTORY, "a" * 32), "w") as f:
+		f.write("Content")
+
+	add_stored_files({"a" * 32})
+
+	assert get_stored_files() == {"a" * 32: 7}
+	assert verify_storage_index() == (set(), set(), set())
+
+	# Someone else puts a file into storage without telling the index
+	with open(os.path.join(FILES_DIRECTORY, "b" * 32), "w") as f:
+		f.write("Other")
+
+	assert verify_storage_index() == (set(), {"b" * 32}, set())
+
+	assert get_stored_files() == {"a" * 32: 7, "b" * 32: 5}
+	assert verify_storage_index() == (set(), set(), set())
+
+	os.remove(os.path.join(FILES_DIRECTORY, "a" * 32))
+	remove_stored_files({"a" * 32})
+
+	assert get_stored_files() == {"b" * 32: 5}
+	assert verify_storage_index() == (set(), set(), set())
+
+	for x in "cd":
+		with open(os.path.join(FILES_DIRECTORY, x * 32), "w") as f:
+			f.write("Content")
+
+		add_stored_files({x * 32})
+
+	os.remove(os.path.join(FILES_DIRECTORY, "c" * 32))
+	remove_stored_files({"c" * 32})
+
+	assert get_stored_files() == {"b" * 32: 5, "d" * 32: 7}
+
+	# Files others put into storage while the command ran are not lost from the index
+	with open(os.path.join(FILES_DIRECTORY, "e" * 32), "w") as f:
+		f.write("Other")
+
+	with open(os.path.join(FILES_DIRECTORY, "f" * 32), "w") as f:
+		f.write("Content")
+
+	add_stored_files({"f" * 32})
+
+	assert get_stored_files() == {"b" * 32: 5, "d" * 32: 7, "e" * 32: 5, "f" * 32: 7}
+	assert verify_storage_index() == (set(), set(), set())
+
+
+@huge_test
+def test_storage_changes() -> None:
+	from huge.repo import create_repository
+	from huge.repo.paths import FILES_DIRECTORY
+
+	create_repository()
+
+	changes = get_storage_changes("", 0)
+	assert changes.files == set()
+
+	epoch, sequence = changes.epoch, changes.sequence
+
+	for x in "ab":
+		with open(os.path.join(FILES_DIRECTORY, x * 32), "w") as f:
+			f.write("Content")
+
+	add_stored_files({"a" * 32, "b" * 32})
+
+	os.remove(os.path.join(FILES_DIRECTORY, "a" * 32))
+	remove_stored_files({"a" * 32})
+
+	changes = get_storage_changes(epoch, sequence)
+	assert (changes.added, changes.removed, changes.files) == ({"b" * 32}, {"a" * 32}, None)
+	assert changes.sequence == sequence + 3
+
+	# Nothing changed since
+	assert get_storage_changes(epoch, changes.sequence) == StorageChanges(epoch, changes.sequence)
+
+	# Files put into storage by someone else are noticed too
+	with open(os.path.join(FILES_DIRECTORY, "c" * 32), "w") as f:
+		f.write("Content")
+
+	assert get_storage_changes(epoch, changes.sequence).added == {"c" * 32}
+
+	# An incomplete entry is not read, and is overwritten by the next one
+	with open(_log_path("."), "a") as f:
+		f.write("+ddd")
+
+	assert get_storage_changes(epoch, changes.sequence).sequence == changes.sequence + 1
+
+	os.remove(os.path.join(FILES_DIRECTORY, "c" * 32))
+	assert get_storage_changes(epoch, changes.sequence + 1).removed == {"c" * 32}
+
+	# Files not named by a hash sum, like temporary files, are neither stored files nor logged
+	with open(os.path.join(FILES_DIRECTORY, f"{'e' * 32}.tmp"), "w") as f:
+		f.write("Content")
+
+	assert get_storage_changes(epoch, changes.sequence + 2) == StorageChanges(epoch, changes.sequence + 2)
+	assert get_stored_files() == {"b" * 32: 7}
+
+	# Another epoch gets all the files
+	assert get_storage_changes("f" * 32, 0).files == {"b" * 32}
+
+	assert not compact_storage_log()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,139 @@
+"""
+Splitting transfers of many files into batches, and running several batches at the same time
+
+A batch is limited both by the number of files, "remote.batch-files", and by their total size,
+"remote.batch-size". Batches of tiny files are then not started one process each, while a very large
+file gets a batch of its own instead of holding up hundreds of small ones.
+
+The batches are ordered by alternating between the smallest and the largest ones, so that while some
+of the "remote.streams" streams are busy with large files, the others keep the small ones flowing.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Sequence, TypeVar
+from huge.testing import huge_test
+
+B = TypeVar("B")
+T = TypeVar("T")
+
+
+def make_batches(file_sizes: dict[str, int]) -> list[list[str]]:
+	"""
+	Split files into batches within the limits of the settings, ordered to be transferred
+	"""
+	from huge.repo.config import get_int_config, get_size_config
+
+	max_files = get_int_config("remote.batch-files")
+	max_bytes = get_size_config("remote.batch-size")
+
+	batches: list[list[str]] = []
+	batch: list[str] = []
+	batch_bytes = 0
+
+	for file_hash in sorted(file_sizes, key=lambda x: (file_sizes[x], x)):
+		if batch and (len(batch) == max_files or batch_bytes + file_sizes[file_hash] > max_bytes):
+			batches.append(batch)
+			batch = []
+			batch_bytes = 0
+
+		batch.append(file_hash)
+		batch_bytes += file_sizes[file_hash]
+
+	if batch:
+		batches.append(batch)
+
+	# Smallest, largest, second smallest, second largest...
+	return [
+		batches[i // 2] if i % 2 == 0 else batches[-1 - i // 2]
+		for i in range(len(batches))
+	]
+
+
+def run_batches(batches: Sequence[B], transfer: Callable[[B], T], streams: int | None = None) -> list[T]:
+	"""
+	Call transfer for each batch, "remote.streams" at the same time
+
+	If a transfer raises, the batches not started yet are skipped, and the first exception is
+	raised when the ones running are done.
+
+	Returns the results in the order of the batches.
+	"""
+	from huge.repo.config import get_int_config
+
+	if streams is None:
+		streams = get_int_config("remote.streams")
+
+	if not batches:
+		return []
+
+	with ThreadPoolExecutor(max_workers=max(1, min(streams, len(batches)))) as executor:
+		futures = [executor.submit(transfer, x) for x in batches]
+
+		try:
+			return [x.result() for x in futures]
+		finally:
+			for x in futures:
+				x.cancel()
+
+
+@huge_test
+def test_make_batches() -> None:
+	from huge.repo import create_repository
+	from huge.repo.config import set_config
+
+	create_repository()
+	set_config("remote.batch-files", "3")
+	set_config("remote.batch-size", "100")
+
+	file_sizes = {f"{i:02}": 1 for i in range(7)}
+	file_sizes["big"] = 1000
+	file_sizes["medium"] = 60
+
+	assert make_batches(file_sizes) == [
+		["00", "01", "02"],
+		["big"],
+		["03", "04", "05"],
+		["06", "medium"],
+	]
+
+	assert make_batches({}) == []
+
+
+def test_run_batches() -> None:
+	import threading
+
+	running = 0
+	most_running = 0
+	lock = threading.Lock()
+	barrier = threading.Barrier(2)
+
+	def transfer(batch: list[str]) -> int:
+		nonlocal running, most_running
+
+		with lock:
+			running += 1
+			most_running = max(most_running, running)
+
+		barrier.wait(timeout=5)
+
+		with lock:
+			running -= 1
+
+		return len(batch)
+
+	assert run_batches([["a"], ["b", "c"], ["d"], ["e"]], transfer, streams=2) == [1, 2, 1, 1]
+	assert most_running == 2
+
+	def failing(batch: list[str]) -> None:
+		raise ValueError(batch[0])
+
+	try:
+		run_batches([["a"], ["b"]], failing, streams=1)
+		assert False
+	except ValueError as exception:
+		assert str(exception) == "a"
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
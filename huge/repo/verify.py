@@ -0,0 +1,414 @@
+"""
+Verifying the integrity of the local repository
+
+Every file in FILES_DIRECTORY is hashed again and compared against its name, and the files of every
+commit are checked to exist either locally or on a remote.
+
+Hashing a large storage can take hours, so the files that has been checked are appended to
+VERIFY_FOLDER as the verification goes. If interrupted, the next run skips them. The folder is
+deleted when the verification finishes, and the result is written to VERIFY_REPORT_FILE as JSON.
+
+Storages too large to verify in one go can be scrubbed instead, see scrub_storage(). Each scrub
+hashes the files that were verified the longest time ago, within a time and byte budget, so that
+repeated scrubs covers the whole storage over time.
+"""
+import os
+from dataclasses import dataclass, field
+from huge.testing import huge_test
+
+
+@dataclass
+class ScrubResult:
+	files_checked: int = 0
+	bytes_checked: int = 0
+
+	# Stored files whose content does not match their name: {"hash sum": "actual hash sum"}
+	corrupt_files: dict[str, str] = field(default_factory=dict)
+
+	# When the file verified the longest time ago was verified, after the scrub. 0 if some files
+	# has never been verified.
+	oldest_verification: int = 0
+
+	# Files that has never been verified, after the scrub
+	unverified_files: int = 0
+
+
+@dataclass
+class VerifyReport:
+	files_checked: int = 0
+	bytes_checked: int = 0
+
+	# Stored files whose content does not match their name: {"hash sum": "actual hash sum"}
+	corrupt_files: dict[str, str] = field(default_factory=dict)
+
+	# Files that no one has, not even the remotes: {"hash sum": ["commit hash", ...]}
+	missing_files: dict[str, list[str]] = field(default_factory=dict)
+
+	# Commits whose list of files could not be read
+	invalid_commits: list[str] = field(default_factory=list)
+
+	# Disagreements between STORAGE_INDEX_FILE and FILES_DIRECTORY. Files in the index but missing
+	# from storage are lost, the other two only means the index is outdated, which it fixes itself.
+	index_missing_from_storage: list[str] = field(default_factory=list)
+	index_missing_files: list[str] = field(default_factory=list)
+	index_wrong_sizes: list[str] = field(default_factory=list)
+
+	@property
+	def ok(self) -> bool:
+		return not (
+			self.corrupt_files
+			or self.missing_files
+			or self.invalid_commits
+			or self.index_missing_from_storage
+		)
+
+
+def verify_repository(workers: int | None = None) -> VerifyReport:
+	"""
+	Verify the storage and the commits, continuing any interrupted verification
+
+	The report is also written to VERIFY_REPORT_FILE.
+	"""
+	import dataclasses
+	import json
+	import shutil
+	from huge.repo import atomic_write
+	from huge.repo.paths import VERIFY_FOLDER, VERIFY_REPORT_FILE
+	from huge.repo.storage import verify_storage_index
+
+	report = VerifyReport()
+
+	missing_from_storage, missing_from_index, wrong_sizes = verify_storage_index()
+	report.index_missing_from_storage = sorted(missing_from_storage)
+	report.index_missing_files = sorted(missing_from_index)
+	report.index_wrong_sizes = sorted(wrong_sizes)
+
+	_verify_storage(report, workers)
+	_verify_commits(report)
+
+	with atomic_write(VERIFY_REPORT_FILE) as f:
+		json.dump(dataclasses.asdict(report), f, indent="\t")
+
+	shutil.rmtree(VERIFY_FOLDER)
+
+	return report
+
+
+def scrub_storage(
+	budget: float | None,
+	max_bytes: int | None = None,
+	workers: int | None = None,
+) -> ScrubResult:
+	"""
+	Verify the files that were verified the longest time ago, until the budget is used up
+
+	budget is the number of seconds to spend and max_bytes how much to read, None meaning no limit.
+	Files that has never been verified goes first, the oldest stored first.
+	"""
+	import time
+	from concurrent.futures import ThreadPoolExecutor
+	from huge.repo.metadata import get_file_metadata, record_verified
+
+	deadline = None if budget is None else time.monotonic() + budget
+
+	metadata = get_file_metadata()
+
+	queue = sorted(metadata, key=lambda x: (metadata[x].verified_at, metadata[x].stored_at))
+	queue.reverse()
+
+	result = ScrubResult()
+
+	workers = workers or os.cpu_count() or 1
+	batch_size = workers * 4
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		while queue:
+			if deadline is not None and time.monotonic() >= deadline:
+				break
+
+			# Keep the workers busy, without reading much more than max_bytes
+			batch: list[str] = []
+			batch_bytes = 0
+
+			while queue and len(batch) < batch_size:
+				if max_bytes is not None and result.bytes_checked + batch_bytes >= max_bytes:
+					break
+
+				batch.append(queue.pop())
+				batch_bytes += metadata[batch[-1]].size
+
+			if not batch:
+				break
+
+			verified: set[str] = set()
+
+			for file_hash, actual_hash in executor.map(_hash_stored_file, batch):
+				if file_hash == actual_hash:
+					verified.add(file_hash)
+				else:
+					result.corrupt_files[file_hash] = actual_hash
+
+				result.files_checked += 1
+				result.bytes_checked += metadata[file_hash].size
+
+			record_verified(verified)
+
+	verify_times = [x.verified_at for x in get_file_metadata().values()]
+
+	result.oldest_verification = min(verify_times, default=0)
+	result.unverified_files = verify_times.count(0)
+
+	return result
+
+
+def _verify_storage(report: VerifyReport, workers: int | None) -> None:
+	"""
+	Hash all the stored files that has not been checked by a previous, interrupted run
+	"""
+	import time
+	from concurrent.futures import ThreadPoolExecutor
+	from huge import progress
+	from huge.repo.metadata import record_verified
+	from huge.repo.paths import FILES_DIRECTORY, VERIFY_FOLDER
+	from huge.repo.storage import is_file_hash
+
+	if not os.path.isdir(VERIFY_FOLDER):
+		os.mkdir(VERIFY_FOLDER)
+
+	checked_path = os.path.join(VERIFY_FOLDER, "checked")
+	corrupt_path = os.path.join(VERIFY_FOLDER, "corrupt")
+
+	checked = _read_lines(checked_path)
+
+	report.corrupt_files = dict(x.split("\t") for x in _read_lines(corrupt_path))
+
+	# Read the directory instead of the index, as the index might be wrong too. Leftovers like
+	# partly received or temporary files are not stored files.
+	pending: dict[str, int] = {
+		entry.name: entry.stat().st_size
+		for entry in os.scandir(FILES_DIRECTORY)
+		if entry.name not in checked and is_file_hash(entry.name) and entry.is_file()
+	}
+
+	report.files_checked = len(checked)
+
+	total_bytes = sum(pending.values())
+
+	# Correct files not yet recorded in VERIFIED_FILE
+	verified: set[str] = set()
+
+	started = time.monotonic()
+	last_print = started + .5
+	printed = ""
+
+	# hashlib releases the GIL while hashing, so threads are enough to use all the cores
+	with (
+		ThreadPoolExecutor(max_workers=workers) as executor,
+		open(checked_path, "a") as checked_file,
+		open(corrupt_path, "a") as corrupt_file,
+	):
+		for file_hash, actual_hash in executor.map(_hash_stored_file, pending):
+			if file_hash != actual_hash:
+				report.corrupt_files[file_hash] = actual_hash
+				corrupt_file.write(f"{file_hash}\t{actual_hash}\n")
+				corrupt_file.flush()
+
+			else:
+				verified.add(file_hash)
+
+			checked_file.write(f"{file_hash}\n")
+
+			report.files_checked += 1
+			report.bytes_checked += pending[file_hash]
+
+			if last_print < time.monotonic():
+				last_print = time.monotonic() + .1
+				checked_file.flush()
+
+				record_verified(verified)
+				verified.clear()
+
+				speed = report.bytes_checked / (time.monotonic() - started)
+				eta = int((total_bytes - report.bytes_checked) / speed) if speed else 0
+
+				printed = (
+					f"\rVerifying files: {int(report.bytes_checked/2**20)} of {int(total_bytes/2**20)} MB, "
+					f"{speed/2**20:.1f} MB/s, ETA {eta // 60}:{eta % 60:02}"
+				)
+				progress(printed)
+
+	record_verified(verified)
+
+	if printed:
+		progress(" " * len(printed) + "\r")
+
+
+def _verify_commits(report: VerifyReport) -> None:
+	"""
+	Find files that commits point at, but that neither we nor the remotes has
+	"""
+	from huge.repo.commit import get_commit_files
+	from huge.repo.coverage import get_remote_copies
+	from huge.repo.graph import get_commit_graph
+	from huge.repo.storage import get_stored_files
+
+	stored_files = get_stored_files()
+
+	# {"hash sum": ["commit hash", ...]}
+	not_stored: dict[str, list[str]] = {}
+
+	for commit_hash in sorted(get_commit_graph().parents):
+		try:
+			commit_files = get_commit_files(commit_hash)
+		except (ValueError, UnicodeDecodeError):
+			report.invalid_commits.append(commit_hash)
+			continue
+
+		for file_hash in set(commit_files.values()):
+			if file_hash not in stored_files or file_hash in report.corrupt_files:
+				not_stored.setdefault(file_hash, []).append(commit_hash)
+
+	for file_hash, copies in get_remote_copies(set(not_stored)).items():
+		if not copies:
+			report.missing_files[file_hash] = not_stored[file_hash]
+
+
+def _hash_stored_file(file_hash: str) -> tuple[str, str]:
+	from huge.repo.encoding import hash_stored
+	from huge.repo.paths import FILES_DIRECTORY
+
+	return file_hash, hash_stored(os.path.join(FILES_DIRECTORY, file_hash), file_hash)
+
+
+def _read_lines(path: str) -> set[str]:
+	if not os.path.isfile(path):
+		return set()
+
+	with open(path) as f:
+		return {x.rstrip("\n") for x in f if x.strip()}
+
+
+@huge_test
+def test_verify_repository() -> None:
+	import json
+	from huge.repo import create_repository
+	from huge.repo.commit import create_commit, get_commit_files, get_current_commit
+	from huge.repo.paths import FILES_DIRECTORY, VERIFY_FOLDER, VERIFY_REPORT_FILE
+	from huge.repo.stage import mark_as_staged
+	from huge.repo.storage import remove_stored_files
+
+	create_repository()
+
+	for name in "ab":
+		with open(name, "w") as f:
+			f.write(f"Content of {name}")
+
+	mark_as_staged(["a", "b"])
+	create_commit(None)
+
+	commit_hash = get_current_commit()
+	commit_files = get_commit_files(commit_hash)
+
+	# Leftovers in the storage are not verified
+	with open(os.path.join(FILES_DIRECTORY, f"{commit_files['a']}.tmp"), "w") as f:
+		f.write("Partial")
+
+	os.mkdir(os.path.join(FILES_DIRECTORY, "f" * 32))
+
+	report = verify_repository()
+	assert report.ok
+	assert report.files_checked == 2
+	assert not os.path.isdir(VERIFY_FOLDER)
+
+	os.remove(os.path.join(FILES_DIRECTORY, f"{commit_files['a']}.tmp"))
+	os.rmdir(os.path.join(FILES_DIRECTORY, "f" * 32))
+
+	# A file the index does not know about yet is only an outdated index
+	with open(os.path.join(FILES_DIRECTORY, _hash_text("Content of c")), "w") as f:
+		f.write("Content of c")
+
+	report = verify_repository()
+	assert report.ok
+	assert report.index_missing_files == [_hash_text("Content of c")]
+
+	os.remove(os.path.join(FILES_DIRECTORY, _hash_text("Content of c")))
+	remove_stored_files({_hash_text("Content of c")})
+
+	# Damage "a" without changing its size
+	with open(os.path.join(FILES_DIRECTORY, commit_files["a"]), "w") as f:
+		f.write("Content of c")
+
+	# An interrupted run had already checked "a", so only "b" is hashed
+	os.mkdir(VERIFY_FOLDER)
+	with open(os.path.join(VERIFY_FOLDER, "checked"), "w") as f:
+		f.write(f"{commit_files['a']}\n")
+
+	report = verify_repository()
+	assert report.ok
+	assert report.bytes_checked == len("Content of b")
+
+	os.remove(os.path.join(FILES_DIRECTORY, commit_files["b"]))
+
+	report = verify_repository()
+	assert not report.ok
+	assert set(report.corrupt_files) == {commit_files["a"]}
+	assert report.missing_files == {commit_files["a"]: [commit_hash], commit_files["b"]: [commit_hash]}
+	assert report.index_missing_from_storage == [commit_files["b"]]
+
+	with open(VERIFY_REPORT_FILE) as f:
+		assert json.load(f)["corrupt_files"] == report.corrupt_files
+
+
+@huge_test
+def test_scrub_storage() -> None:
+	from huge.repo import create_repository
+	from huge.repo.metadata import get_verify_times
+	from huge.repo.paths import FILES_DIRECTORY, STORED_FILE, VERIFIED_FILE
+	from huge.repo.storage import add_stored_files
+
+	create_repository()
+
+	content = {"First": 100, "Second": 200, "Third": 300}
+
+	for x in content:
+		with open(os.path.join(FILES_DIRECTORY, _hash_text(x)), "w") as f:
+			f.write(x)
+
+	add_stored_files({_hash_text(x) for x in content})
+
+	with open(STORED_FILE, "w") as f:
+		f.writelines(f"{_hash_text(x)}\t{y}\n" for x, y in content.items())
+
+	# "Third" was verified long ago, the others never
+	with open(VERIFIED_FILE, "w") as f:
+		f.write(f"{_hash_text('Third')}\t400\n")
+
+	# Only time to read a single file, the oldest stored of the never verified ones
+	result = scrub_storage(None, max_bytes=1, workers=1)
+	assert result.files_checked == 1
+	assert set(get_verify_times()) == {_hash_text("First"), _hash_text("Third")}
+	assert result.unverified_files == 1
+
+	with open(os.path.join(FILES_DIRECTORY, _hash_text("Third")), "w") as f:
+		f.write("Damaged")
+
+	result = scrub_storage(None, max_bytes=len("Second") + 1, workers=1)
+	assert result.files_checked == 2
+	assert set(result.corrupt_files) == {_hash_text("Third")}
+	assert result.unverified_files == 0
+	assert result.oldest_verification == 400
+
+	result = scrub_storage(0)
+	assert result.files_checked == 0
+
+
+def _hash_text(text: str) -> str:
+	import hashlib
+
+	return hashlib.md5(text.encode()).hexdigest()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")